@@ -0,0 +1,363 @@
+import os, json, threading
+from bisect import bisect_left, insort
+import numpy as np
+from indexing import versioning
+
+# Sorts after every character, closes the range of keys with a prefix
+_PREFIX_END = "\U0010ffff"
+
+
+def normalize(text):
+    """
+    Returns the key a text is matched on, lowercased with its whitespace
+    collapsed
+    """
+    return " ".join(str(text).lower().split())
+
+
+class SuggestionIndex:
+    """
+    Typeahead suggestions for the questions of one collection
+
+    Every distinct question text is an entry weighted by the documents it
+    comes from plus its popularity, the number of times it was picked.
+    Entries are matched on a prefix of the whole text and, with a lower
+    weight, on a prefix starting at any of its words
+
+    Lookups run on frozen arrays: the sorted keys, searched with bisect
+    for the range of a prefix, the entry of every key and the current
+    weight of every entry, of which the best are taken with numpy. Changes
+    never wait for a rebuild. The weight of an entry already frozen is
+    updated in place, new entries go to a small sorted delta merged at
+    lookup time. Once the delta holds more than rebuild_ratio of the
+    frozen keys, the arrays are rebuilt in a background thread and
+    swapped in
+
+    Attributes
+    ----------
+    entries : Dictionary
+        Maps a key to its display text, the weight contributed by every
+        document and its popularity
+    doc_keys : Dictionary
+        Maps a document id to the keys of its texts
+    word_weight : Float
+        The share of the weight of an entry used when it is matched from
+        one of its words instead of its start
+    """
+
+    def __init__(self, entries=None, word_weight=0.5, rebuild_ratio=0.1, \
+        min_rebuild=1000):
+        self.entries = entries or {}
+        self.doc_keys = {}
+        for key, entry in self.entries.items():
+            for doc_id in entry["docs"]:
+                self.doc_keys.setdefault(doc_id, []).append(key)
+        self.word_weight = word_weight
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild = min_rebuild
+
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.rebuilding = False
+        self.rebuild_thread = None
+        self.frozen = None
+        self.owner_weights = None
+        self.delta_keys = []
+        self.delta_entries = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match_keys(self, key):
+        """
+        Returns the (match key, weight factor) pairs of an entry, its key
+        and every suffix starting at one of its words
+        """
+        matches = [(key, 1.0)]
+        start = key.find(" ")
+        while start >= 0:
+            matches.append((key[start + 1:], self.word_weight))
+            start = key.find(" ", start + 1)
+        return matches
+
+    def entry_weight(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return -np.inf
+        return sum(entry["docs"].values()) + entry["popularity"]
+
+    def add(self, doc_id, texts):
+        """
+        Replaces the suggestions of a document
+
+        Inputs
+        ------
+        doc_id : String
+            The id of the document
+        texts : List
+            (text, weight) pairs, like the question and its variations
+        """
+        with self.lock:
+            self._remove(str(doc_id))
+            keys = []
+            for text, weight in texts:
+                key = normalize(text)
+                if not key:
+                    continue
+                entry = self.entries.setdefault(key, \
+                    {"text": " ".join(str(text).split()), "docs": {}, \
+                    "popularity": 0.0})
+                entry["docs"][str(doc_id)] = max(weight, \
+                    entry["docs"].get(str(doc_id), 0.0))
+                keys.append(key)
+                self._touch(key)
+            self.doc_keys[str(doc_id)] = keys
+        self.rebuild_if_needed()
+
+    def remove(self, doc_ids):
+        with self.lock:
+            for doc_id in doc_ids:
+                self._remove(str(doc_id))
+
+    def _remove(self, doc_id):
+        for key in self.doc_keys.pop(doc_id, []):
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            entry["docs"].pop(doc_id, None)
+            if not entry["docs"]:
+                del self.entries[key]
+            self._touch(key)
+
+    def _touch(self, key):
+        """
+        Brings the lookup structures up to date with the entry of key,
+        called with the lock held
+        """
+        if self.frozen is None:
+            return
+        owner = self.frozen[4].get(key)
+        if owner is not None:
+            self.owner_weights[owner] = self.entry_weight(key)
+        elif key in self.entries and key not in self.delta_entries:
+            self.delta_entries.add(key)
+            for match_key, factor in self.match_keys(key):
+                insort(self.delta_keys, (match_key, key, factor))
+
+    def record_selection(self, text, amount=1.0):
+        """
+        Raises the popularity of a suggestion which was picked
+        """
+        with self.lock:
+            key = normalize(text)
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["popularity"] += amount
+                self._touch(key)
+
+    def freeze(self):
+        """
+        Rebuilds the frozen arrays from the entries and swaps them in.
+        Lookups keep using the previous arrays in the meantime
+        """
+        with self.build_lock:
+            with self.lock:
+                keys = list(self.entries)
+            texts, match_keys, owners, factors = [], [], [], []
+            for owner, key in enumerate(keys):
+                for match_key, factor in self.match_keys(key):
+                    match_keys.append(match_key)
+                    owners.append(owner)
+                    factors.append(factor)
+
+            order = sorted(range(len(match_keys)), key=match_keys.__getitem__)
+            owner_ids = {key: owner for owner, key in enumerate(keys)}
+            frozen = (
+                [match_keys[x] for x in order],
+                np.array([owners[x] for x in order], dtype=np.int64),
+                np.array([factors[x] for x in order], dtype=np.float64),
+                keys,
+                owner_ids,
+            )
+
+            with self.lock:
+                # Entries changed during the build are caught up here
+                self.owner_weights = np.array([self.entry_weight(key) \
+                    for key in keys], dtype=np.float64)
+                self.frozen = frozen
+                self.delta_keys, self.delta_entries = [], set()
+                for key in self.entries:
+                    if key not in owner_ids:
+                        self._touch(key)
+                self.rebuilding = False
+            return frozen
+
+    def rebuild_if_needed(self):
+        """
+        Starts a background rebuild once the delta has grown too large
+        """
+        with self.lock:
+            if self.frozen is None or self.rebuilding or \
+                len(self.delta_keys) <= max(self.min_rebuild, \
+                    self.rebuild_ratio * len(self.frozen[0])):
+                return
+            self.rebuilding = True
+            self.rebuild_thread = threading.Thread(target=self.freeze, \
+                daemon=True)
+            self.rebuild_thread.start()
+
+    def join(self, timeout=None):
+        """
+        Waits for the background rebuild in progress, if any
+        """
+        with self.lock:
+            thread = self.rebuild_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def suggest(self, prefix, top_k=10):
+        """
+        Returns the top_k [text, weight] suggestions for a prefix, best
+        first
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        if self.frozen is None:
+            self.freeze()
+
+        with self.lock:
+            match_keys, owners, factors, keys, _ = self.frozen
+            owner_weights = self.owner_weights
+            start = bisect_left(self.delta_keys, (prefix,))
+            end = bisect_left(self.delta_keys, (prefix + _PREFIX_END,), start)
+            candidates = [(self.entry_weight(key) * factor, key) \
+                for _, key, factor in self.delta_keys[start:end] \
+                if key in self.entries]
+
+        start = bisect_left(match_keys, prefix)
+        end = bisect_left(match_keys, prefix + _PREFIX_END, start)
+        if start < end:
+            weights = owner_weights[owners[start:end]] * factors[start:end]
+            # An entry can match several times, from its start and its words
+            wanted = min(end - start, 4 * top_k)
+            best = np.arange(end - start)
+            if end - start > wanted:
+                best = np.argpartition(-weights, wanted - 1)[:wanted]
+            candidates.extend((weights[idx], keys[owners[start + idx]]) \
+                for idx in best if weights[idx] > -np.inf)
+
+        candidates.sort(key=lambda x: -x[0])
+        suggestions, seen = [], set()
+        for weight, key in candidates:
+            entry = self.entries.get(key)
+            if key in seen or entry is None:
+                continue
+            seen.add(key)
+            suggestions.append([entry["text"], float(weight)])
+            if len(suggestions) == top_k:
+                break
+        return suggestions
+
+    def lineage_view(self, lineage):
+        """
+        Returns a frozen index of the entries of the documents visible
+        from a version lineage with shared_versions, the copy of the
+        newest version of the lineage of every question. Ids of documents
+        without texts hide the older copies of their question
+        """
+        with self.lock:
+            exists = self.doc_keys.__contains__
+            entries = {}
+            for key, entry in self.entries.items():
+                docs = {doc_id: weight for doc_id, weight in \
+                    entry["docs"].items() if versioning.newest_visible_id(\
+                        doc_id, lineage, exists) == doc_id}
+                if docs:
+                    entries[key] = {"text": entry["text"], "docs": docs, \
+                        "popularity": entry["popularity"]}
+        view = SuggestionIndex(entries, word_weight=self.word_weight, \
+            rebuild_ratio=self.rebuild_ratio, min_rebuild=self.min_rebuild)
+        view.freeze()
+        return view
+
+    def save(self, path):
+        with self.lock:
+            data = json.dumps({"entries": self.entries})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f)["entries"])
+
+
+class SuggestionStore:
+    """
+    Holds the suggestion index of every collection, each loaded from its
+    snapshot on first use, and the views of shared collections restricted
+    to the lineage of a version
+
+    Attributes
+    ----------
+    snapshot_dir : String
+        The directory holding one <collection>.json file per collection
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.indexes = {}
+        self.views = {}
+        self.lock = threading.Lock()
+
+    def snapshot_path(self, collection):
+        return os.path.join(self.snapshot_dir, collection + ".json")
+
+    def get(self, collection):
+        with self.lock:
+            if collection not in self.indexes:
+                path = self.snapshot_path(collection)
+                self.indexes[collection] = SuggestionIndex.load(path) \
+                    if os.path.exists(path) else SuggestionIndex()
+            return self.indexes[collection]
+
+    def get_view(self, collection, lineage):
+        """
+        Returns the view of the suggestions of a collection restricted to
+        a version lineage, built on first use and rebuilt on every save
+        """
+        key = (collection, frozenset(lineage))
+        with self.lock:
+            view = self.views.get(key)
+        if view is None:
+            view = self.get(collection).lineage_view(key[1])
+            with self.lock:
+                view = self.views.setdefault(key, view)
+        return view
+
+    def join(self, timeout=None):
+        """
+        Waits for the background rebuilds of every index and view
+        """
+        with self.lock:
+            indexes = list(self.indexes.values()) + list(self.views.values())
+        for suggestion_index in indexes:
+            suggestion_index.join(timeout)
+
+    def save(self, collection):
+        """
+        Writes the suggestions of a collection and rebuilds their arrays
+        and lineage views, so that lookups do not wait for it
+        """
+        suggestion_index = self.get(collection)
+        suggestion_index.save(self.snapshot_path(collection))
+        suggestion_index.freeze()
+        with self.lock:
+            lineages = [key[1] for key in self.views if key[0] == collection]
+        for lineage in lineages:
+            view = suggestion_index.lineage_view(lineage)
+            with self.lock:
+                self.views[(collection, lineage)] = view
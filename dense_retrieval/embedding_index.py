@@ -0,0 +1,181 @@
+import os, json, threading
+import numpy as np
+
+
+class EmbeddingIndex:
+    """
+    The embeddings of the questions of one collection, stored as a memory
+    mapped float32 matrix with one row per embedded text
+
+    A document can have several rows, its question and its variations,
+    and is scored by its best row. Rows are appended to the matrix file,
+    the rows of a replaced or deleted document are only marked dead and
+    the file is rewritten once more than half of its rows are dead
+
+    Attributes
+    ----------
+    path : String
+        The matrix file, the row ids are kept next to it in path.json
+    dim : Integer
+        The number of dimensions of the embeddings
+    row_ids : List
+        The document id of every row, None for dead rows
+    """
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.row_ids = []
+        if os.path.exists(path + ".json"):
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            if meta["dim"] != dim:
+                raise ValueError("embeddings of " + path + " have " + \
+                    str(meta["dim"]) + " dimensions, the encoder has " + str(dim))
+            self.row_ids = meta["row_ids"]
+        self.doc_rows = {}
+        for row, doc_id in enumerate(self.row_ids):
+            if doc_id is not None:
+                self.doc_rows.setdefault(doc_id, []).append(row)
+        self.matrix = self.map_matrix()
+        self.layout = None
+
+    def map_matrix(self):
+        if not self.row_ids:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r", \
+            shape=(len(self.row_ids), self.dim))
+
+    def __len__(self):
+        return len(self.doc_rows)
+
+    def __contains__(self, doc_id):
+        return str(doc_id) in self.doc_rows
+
+    def add(self, doc_ids, vectors):
+        """
+        Appends the vectors of documents, row i of vectors belongs to
+        doc_ids[i]. The previous rows of these documents are dropped
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self.lock:
+            for doc_id in set(doc_ids):
+                self.drop(doc_id)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), \
+                exist_ok=True)
+            with open(self.path, "ab") as f:
+                # Bytes after the last known row were never committed
+                f.truncate(len(self.row_ids) * self.dim * 4)
+                f.write(vectors.tobytes())
+            for doc_id in doc_ids:
+                self.doc_rows.setdefault(str(doc_id), []).append(len(self.row_ids))
+                self.row_ids.append(str(doc_id))
+            self.matrix = self.map_matrix()
+            self.layout = None
+
+    def delete(self, doc_ids):
+        with self.lock:
+            for doc_id in doc_ids:
+                self.drop(str(doc_id))
+
+    def drop(self, doc_id):
+        for row in self.doc_rows.pop(str(doc_id), []):
+            self.row_ids[row] = None
+        self.layout = None
+
+    def get_layout(self):
+        """
+        Returns the matrix, the sorted live document ids and the position
+        of the document of every row in them, -1 for dead rows
+        """
+        with self.lock:
+            if self.layout is None:
+                doc_ids = sorted(self.doc_rows)
+                row_docs = np.full(len(self.row_ids), -1)
+                for idx, doc_id in enumerate(doc_ids):
+                    row_docs[self.doc_rows[doc_id]] = idx
+                self.layout = (self.matrix, doc_ids, row_docs)
+            return self.layout
+
+    def save(self):
+        """
+        Writes the row ids, compacting the matrix first if most of its
+        rows are dead
+        """
+        with self.lock:
+            live = [row for row, doc_id in enumerate(self.row_ids) \
+                if doc_id is not None]
+            if len(live) * 2 < len(self.row_ids):
+                vectors = np.array(self.matrix[live])
+                with open(self.path + ".tmp", "wb") as f:
+                    f.write(vectors.tobytes())
+                os.replace(self.path + ".tmp", self.path)
+                self.row_ids = [self.row_ids[row] for row in live]
+                self.doc_rows = {}
+                for row, doc_id in enumerate(self.row_ids):
+                    self.doc_rows.setdefault(doc_id, []).append(row)
+                self.matrix = self.map_matrix()
+                self.layout = None
+
+            with open(self.path + ".json.tmp", "w") as f:
+                json.dump({"dim": self.dim, "row_ids": self.row_ids}, f)
+            os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    def search(self, query_vectors, top_k=50, block_size=65536):
+        """
+        Returns, for every query vector, the top_k [score, id] pairs by
+        inner product, best first
+
+        The matrix is scanned in blocks of block_size rows for all the
+        queries at once, and a document keeps the score of its best row
+        """
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        matrix, doc_ids, row_docs = self.get_layout()
+        if not doc_ids:
+            return [[] for _ in query_vectors]
+
+        best = np.full((len(query_vectors), len(doc_ids)), -np.inf, \
+            dtype=np.float32)
+        for start in range(0, len(row_docs), block_size):
+            rows = row_docs[start:start + block_size]
+            live = rows >= 0
+            scores = query_vectors @ np.asarray(\
+                matrix[start:start + block_size]).T
+            for query, query_scores in enumerate(scores):
+                np.maximum.at(best[query], rows[live], query_scores[live])
+
+        results = []
+        top_k = min(top_k, len(doc_ids))
+        for query_best in best:
+            top = np.argpartition(-query_best, top_k - 1)[:top_k]
+            top = top[np.argsort(-query_best[top], kind="stable")]
+            results.append([[float(query_best[x]), doc_ids[x]] for x in top])
+        return results
+
+
+class EmbeddingStore:
+    """
+    Holds the embedding index of every collection
+
+    Attributes
+    ----------
+    snapshot_dir : String
+        The directory holding the <collection>.f32 matrix files
+    dim : Integer
+        The number of dimensions of the encoder
+    """
+
+    def __init__(self, snapshot_dir, dim):
+        self.snapshot_dir = snapshot_dir
+        self.dim = dim
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, collection):
+        with self.lock:
+            if collection not in self.indexes:
+                self.indexes[collection] = EmbeddingIndex(\
+                    os.path.join(self.snapshot_dir, collection + ".f32"), \
+                    self.dim)
+            return self.indexes[collection]
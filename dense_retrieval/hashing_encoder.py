@@ -0,0 +1,44 @@
+import hashlib
+import numpy as np
+
+from indexing.text_analysis import analyze
+
+
+class HashingEncoder:
+    """
+    A deterministic encoder hashing the words and character trigrams of
+    a text into a fixed number of dimensions
+
+    It needs no model, gives the same vectors in every process and is
+    used for tests. Texts sharing words or word pieces get close vectors
+
+    Attributes
+    ----------
+    dim : Integer
+        The number of dimensions of the vectors
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def features(self, text):
+        for token in analyze(text):
+            yield "w:" + token
+            padded = "#" + token + "#"
+            for idx in range(len(padded) - 2):
+                yield "c:" + padded[idx:idx + 3]
+
+    def encode(self, texts):
+        """
+        Returns the L2 normalised float32 vectors of a list of texts, one
+        row per text
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                digest = hashlib.md5(feature.encode()).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vectors[row, bucket] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
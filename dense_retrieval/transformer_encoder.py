@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModel
+
+
+class TransformerEncoder:
+    """
+    Encodes texts with a local transformer model, as the L2 normalised
+    mean of its last hidden states
+
+    Attributes
+    ----------
+    dim : Integer
+        The hidden size of the model
+    """
+
+    def __init__(self, path, max_length=64, batch_size=32, device="cpu"):
+        """
+        Inputs
+        ------
+        path : String
+            A directory or model name understood by transformers
+        max_length : Integer
+            Texts are truncated to max_length tokens
+        batch_size : Integer
+            The number of texts encoded at once
+        """
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.model = AutoModel.from_pretrained(path).to(device)
+        self.model.eval()
+        self.device = device
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts):
+        """
+        Returns the float32 vectors of a list of texts, one row per text
+        """
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer.batch_encode_plus(
+                texts[start:start + self.batch_size],
+                max_length=self.max_length,
+                pad_to_max_length=True,
+                return_tensors="pt")
+            batch = {key: value.to(self.device) for key, value in batch.items()}
+            with torch.no_grad():
+                hidden = self.model(**batch)[0]
+            mask = batch["attention_mask"].unsqueeze(-1).float()
+            mean = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1)
+            vectors.append(torch.nn.functional.normalize(mean, dim=1)\
+                .cpu().numpy())
+        if not vectors:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(vectors).astype(np.float32)
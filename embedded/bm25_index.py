@@ -0,0 +1,429 @@
+import os, json, math, threading
+import numpy as np
+
+import query_ast
+from indexing.text_analysis import analyze, analyze_values
+
+# The lucene 8 BM25 parameters used by the solr schema
+K1 = 1.2
+B = 0.75
+
+# Every text field is also indexed into the catch all field, which is
+# searched by unfielded clauses like the _text_ field of the solr schema
+CATCH_ALL_FIELD = "_text_"
+
+# Separates the values of a multi valued field so that phrases never
+# match across two values
+VALUE_GAP = -1
+
+# Fields which are matched exactly by solr and are not tokenized
+STRING_FIELD_SUFFIXES = ("_s", "_ss")
+UNINDEXED_FIELDS = ("id", "_version_", "score")
+
+
+def is_text_field(field, value):
+    if field in UNINDEXED_FIELDS or field.endswith(STRING_FIELD_SUFFIXES):
+        return False
+    if isinstance(value, (list, tuple)):
+        return all(isinstance(x, str) for x in value)
+    return isinstance(value, str)
+
+
+def solr_document(doc, score):
+    """
+    Returns a stored document shaped like a solr response, with text
+    fields as lists and its score
+    """
+    shaped = {}
+    for field, value in doc.items():
+        if is_text_field(field, value) and not isinstance(value, list):
+            value = [value]
+        shaped[field] = value
+    shaped['score'] = score
+    return shaped
+
+
+class FieldPostings:
+    """
+    The postings of one field, frozen into numpy arrays
+
+    Attributes
+    ----------
+    rows, tf : numpy.ndarray
+        The documents containing each term and the frequency of the term,
+        grouped by term
+    ptr : numpy.ndarray
+        The postings of term t are rows[ptr[t]:ptr[t+1]]
+    norms : numpy.ndarray
+        The BM25 length normalisation of every document
+    doc_count : Integer
+        The number of documents having the field
+    flat_tokens, flat_rows : numpy.ndarray
+        The token ids of every document one after the other, separated by
+        VALUE_GAP, and the document of every position. Phrases are
+        matched by scanning them
+    """
+
+    def __init__(self, tokens, num_rows, vocabulary_size):
+        lengths = np.zeros(num_rows)
+        row_ids, token_ids = [], []
+        for row, ids in tokens.items():
+            lengths[row] = np.count_nonzero(ids >= 0)
+            row_ids.append(np.full(len(ids) + 1, row, dtype=np.int64))
+            token_ids.append(ids)
+            token_ids.append(np.array([VALUE_GAP], dtype=np.int32))
+
+        keys = np.zeros(0, dtype=np.int64)
+        self.flat_tokens = np.zeros(0, dtype=np.int32)
+        self.flat_rows = np.zeros(0, dtype=np.int64)
+        if token_ids:
+            self.flat_rows = np.concatenate(row_ids)
+            self.flat_tokens = np.concatenate(token_ids)
+            keep = self.flat_tokens >= 0
+            keys = self.flat_tokens[keep].astype(np.int64) * num_rows + \
+                self.flat_rows[keep]
+        # One entry per (term, document), sorted by term
+        keys, counts = np.unique(keys, return_counts=True)
+
+        self.rows = keys % num_rows if num_rows else keys
+        self.tf = counts.astype(np.float64)
+        self.ptr = np.searchsorted(keys // max(num_rows, 1), \
+            np.arange(vocabulary_size + 1))
+        self.doc_count = len(tokens)
+        avg_length = lengths.sum() / self.doc_count if self.doc_count else 1.0
+        self.norms = K1 * (1 - B + B * lengths / max(avg_length, 1e-9))
+
+    def idf(self, term_id):
+        df = self.ptr[term_id + 1] - self.ptr[term_id]
+        return math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+
+    def phrase_frequencies(self, term_ids):
+        """
+        Returns the documents containing the terms in sequence and the
+        number of times they do
+        """
+        span = len(self.flat_tokens) - len(term_ids) + 1
+        if span <= 0:
+            return self.flat_rows[:0], self.tf[:0]
+        found = self.flat_tokens[:span] == term_ids[0]
+        for offset, term_id in enumerate(term_ids[1:], start=1):
+            found &= self.flat_tokens[offset:offset + span] == term_id
+        rows, freq = np.unique(self.flat_rows[:span][found], return_counts=True)
+        return rows, freq.astype(np.float64)
+
+    def postings(self, term_id):
+        if term_id is None or term_id + 1 >= len(self.ptr):
+            return self.rows[:0], self.tf[:0]
+        start, end = self.ptr[term_id], self.ptr[term_id + 1]
+        return self.rows[start:end], self.tf[start:end]
+
+
+class EmbeddedIndex:
+    """
+    An in memory inverted index of one collection, scored with BM25
+
+    Documents are kept as token id arrays per field, postings are frozen
+    into numpy arrays on the first search after a change. Rows of deleted
+    documents stay empty until the index is saved and loaded again.
+    Searches and updates are serialised by a lock
+
+    Methods
+    -------
+    add(docs):
+        Adds documents, replacing the documents with the same id
+
+    delete(ids):
+        Removes documents
+
+    search(node, top_n):
+        Scores a query_ast tree and returns the top_n (document, score)
+
+    search_edismax(q, qf, pf, bq, top_n):
+        Scores raw user text like the solr edismax parser
+
+    save(path), load(path):
+        Writes and reads a snapshot of the index
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.docs = []
+        self.rows = {}
+        self.terms = []
+        self.vocabulary = {}
+        # field -> {row : token ids}
+        self.tokens = {}
+        self.postings = {}
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def token_ids(self, values):
+        """
+        Returns the term ids of the tokens of every value, adding new
+        terms to the vocabulary
+        """
+        ids = []
+        for tokens in values:
+            if ids:
+                ids.append(VALUE_GAP)
+            for token in tokens:
+                term_id = self.vocabulary.get(token)
+                if term_id is None:
+                    term_id = self.vocabulary[token] = len(self.terms)
+                    self.terms.append(token)
+                ids.append(term_id)
+        return np.array(ids, dtype=np.int32)
+
+    def add(self, docs):
+        with self.lock:
+            for doc in docs:
+                doc_id = str(doc['id'])
+                if doc_id in self.rows:
+                    self.delete_row(self.rows[doc_id])
+
+                row = len(self.docs)
+                self.docs.append(dict(doc))
+                self.rows[doc_id] = row
+                catch_all = []
+                for field, value in doc.items():
+                    if not is_text_field(field, value):
+                        continue
+                    values = analyze_values(value)
+                    self.tokens.setdefault(field, {})[row] = \
+                        self.token_ids(values)
+                    self.dirty.add(field)
+                    catch_all.extend(values)
+                self.tokens.setdefault(CATCH_ALL_FIELD, {})[row] = \
+                    self.token_ids(catch_all)
+                self.dirty.add(CATCH_ALL_FIELD)
+
+    def delete(self, ids):
+        with self.lock:
+            for doc_id in ids:
+                if str(doc_id) in self.rows:
+                    self.delete_row(self.rows[str(doc_id)])
+
+    def delete_row(self, row):
+        del self.rows[str(self.docs[row]['id'])]
+        self.docs[row] = None
+        for field, tokens in self.tokens.items():
+            if tokens.pop(row, None) is not None:
+                self.dirty.add(field)
+
+    def documents(self):
+        return [doc for doc in self.docs if doc is not None]
+
+    def get_documents(self, ids):
+        """
+        Returns the stored documents of the given ids which exist
+        """
+        with self.lock:
+            return [self.docs[self.rows[str(x)]] for x in ids \
+                if str(x) in self.rows]
+
+    def content_hashes(self, field):
+        return {doc_id: self.docs[row].get(field) \
+            for doc_id, row in self.rows.items()}
+
+    def field_postings(self, field):
+        """
+        Returns the frozen postings of a field, rebuilding them if the
+        field changed
+        """
+        with self.lock:
+            if field in self.dirty or field not in self.postings:
+                self.dirty.discard(field)
+                self.postings[field] = FieldPostings(\
+                    dict(self.tokens.get(field, {})), len(self.docs), \
+                    len(self.terms))
+            return self.postings[field]
+
+    def resolve_fields(self, field):
+        """
+        Returns the fields matched by a field name, a name ending with *
+        matches every field with that prefix
+        """
+        if not field:
+            return [CATCH_ALL_FIELD]
+        if field.endswith("*"):
+            return [x for x in list(self.tokens) \
+                if x.startswith(field[:-1]) and x != CATCH_ALL_FIELD]
+        return [field]
+
+    def score_terms(self, field, text, scores, matched, boost=1.0):
+        """
+        Adds the BM25 score of the tokens of text in one field
+        """
+        postings = self.field_postings(field)
+        for token in analyze(text):
+            term_id = self.vocabulary.get(token)
+            rows, tf = postings.postings(term_id)
+            if len(rows):
+                scores[rows] += boost * postings.idf(term_id) * \
+                    tf / (tf + postings.norms[rows])
+                matched[rows] = True
+
+    def score_phrase(self, field, text, scores, matched, boost=1.0):
+        """
+        Adds the BM25 score of a phrase in one field, its frequency is
+        the number of times the tokens appear in sequence
+        """
+        term_ids = [self.vocabulary.get(x) for x in analyze(text)]
+        if len(term_ids) <= 1 or None in term_ids:
+            if term_ids and None not in term_ids:
+                self.score_terms(field, text, scores, matched, boost)
+            return
+        postings = self.field_postings(field)
+        rows, freq = postings.phrase_frequencies(term_ids)
+        if len(rows):
+            idf = sum(postings.idf(x) for x in term_ids)
+            scores[rows] += boost * idf * freq / (freq + postings.norms[rows])
+            matched[rows] = True
+
+    def score_node(self, node, scores, matched, field=None, boost=1.0):
+        """
+        Adds the score of a query tree. Clauses of a group are summed, a
+        field pattern matching several fields keeps the best field
+        """
+        field = node.field or field
+        if node.boost is not None:
+            boost = boost * node.boost
+
+        if isinstance(node, query_ast.Group):
+            for clause in node.clauses:
+                self.score_node(clause, scores, matched, field, boost)
+            return
+
+        score = self.score_phrase if isinstance(node, query_ast.Phrase) \
+            else self.score_terms
+        fields = self.resolve_fields(field)
+        if len(fields) == 1:
+            score(fields[0], node.text, scores, matched, boost)
+            return
+        best = np.zeros_like(scores)
+        for name in fields:
+            field_scores = np.zeros_like(scores)
+            score(name, node.text, field_scores, matched, boost)
+            np.maximum(best, field_scores, out=best)
+        scores += best
+
+    def top_documents(self, scores, matched, top_n):
+        rows = np.flatnonzero(matched)
+        if len(rows) > top_n:
+            rows = rows[np.argpartition(-scores[rows], top_n - 1)[:top_n]]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        return [(self.docs[row], float(scores[row])) for row in rows \
+            if self.docs[row] is not None]
+
+    def search(self, node, top_n=50):
+        """
+        Returns the top_n (document, score) of a query_ast tree
+        """
+        with self.lock:
+            scores = np.zeros(len(self.docs))
+            matched = np.zeros(len(self.docs), dtype=bool)
+            self.score_node(node, scores, matched)
+            return self.top_documents(scores, matched, top_n)
+
+    def search_edismax(self, q, qf, pf=(), bq=(), top_n=50):
+        """
+        Scores raw user text like the edismax parser. Every token keeps
+        its best field of qf, the whole text is boosted as a phrase on
+        its best field of pf, and the bq trees are added
+
+        Inputs
+        ------
+        q : String
+            The user text
+        qf, pf : List
+            Field names, optionally boosted like question^2
+        bq : List
+            query_ast trees added to the score
+        """
+        with self.lock:
+            return self.score_edismax(q, qf, pf, bq, top_n)
+
+    def score_edismax(self, q, qf, pf, bq, top_n):
+        scores = np.zeros(len(self.docs))
+        matched = np.zeros(len(self.docs), dtype=bool)
+
+        def boosted(fields):
+            for field in fields:
+                name, _, boost = field.partition("^")
+                yield name, float(boost) if boost else 1.0
+
+        for token in analyze(q):
+            best = np.zeros_like(scores)
+            for name, boost in boosted(qf):
+                field_scores = np.zeros_like(scores)
+                self.score_terms(name, token, field_scores, matched, boost)
+                np.maximum(best, field_scores, out=best)
+            scores += best
+
+        if pf and len(analyze(q)) > 1:
+            best = np.zeros_like(scores)
+            # Phrase boosts rank the matches but do not match on their own
+            phrase_matched = np.zeros_like(matched)
+            for name, boost in boosted(pf):
+                field_scores = np.zeros_like(scores)
+                self.score_phrase(name, q, field_scores, phrase_matched, boost)
+                np.maximum(best, field_scores, out=best)
+            scores += best
+
+        for node in bq:
+            self.score_node(node, scores, matched)
+        return self.top_documents(scores, matched, top_n)
+
+    def save(self, path):
+        """
+        Writes the live documents and their token arrays to path, an .npz
+        file replaced atomically
+        """
+        with self.lock:
+            live = [row for row, doc in enumerate(self.docs) if doc is not None]
+            new_row = {row: idx for idx, row in enumerate(live)}
+            fields = sorted(self.tokens)
+            arrays = {}
+            for idx, field in enumerate(fields):
+                tokens = self.tokens[field]
+                rows = sorted(row for row in tokens if row in new_row)
+                arrays["rows_" + str(idx)] = np.array(\
+                    [new_row[row] for row in rows], dtype=np.int32)
+                arrays["ptr_" + str(idx)] = np.cumsum(\
+                    [0] + [len(tokens[row]) for row in rows])
+                arrays["tokens_" + str(idx)] = np.concatenate(\
+                    [tokens[row] for row in rows] + [np.zeros(0, np.int32)])
+            meta = {
+                "docs": [self.docs[row] for row in live],
+                "terms": self.terms,
+                "fields": fields,
+            }
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads an index written by save
+        """
+        index = cls()
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            index.docs = meta["docs"]
+            index.rows = {str(doc['id']): row \
+                for row, doc in enumerate(index.docs)}
+            index.terms = meta["terms"]
+            index.vocabulary = {term: idx for idx, term in enumerate(index.terms)}
+            for idx, field in enumerate(meta["fields"]):
+                rows = data["rows_" + str(idx)]
+                ptr = data["ptr_" + str(idx)]
+                tokens = data["tokens_" + str(idx)]
+                index.tokens[field] = {int(row): tokens[ptr[x]:ptr[x + 1]] \
+                    for x, row in enumerate(rows)}
+                index.dirty.add(field)
+        return index
@@ -0,0 +1,45 @@
+import os, threading
+
+from embedded.bm25_index import EmbeddedIndex
+
+
+class EmbeddedStore:
+    """
+    Holds the embedded indexes of the collections served in process,
+    each loaded from its snapshot on first use
+
+    Attributes
+    ----------
+    snapshot_dir : String
+        The directory holding one <collection>.npz snapshot per collection
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def snapshot_path(self, collection):
+        return os.path.join(self.snapshot_dir, collection + ".npz")
+
+    def exists(self, collection):
+        return collection in self.indexes or \
+            os.path.exists(self.snapshot_path(collection))
+
+    def get(self, collection):
+        """
+        Returns the index of a collection, loading its snapshot or
+        creating an empty index
+        """
+        with self.lock:
+            if collection not in self.indexes:
+                path = self.snapshot_path(collection)
+                self.indexes[collection] = EmbeddedIndex.load(path) \
+                    if os.path.exists(path) else EmbeddedIndex()
+            return self.indexes[collection]
+
+    def save(self, collection):
+        """
+        Writes the snapshot of a collection
+        """
+        self.get(collection).save(self.snapshot_path(collection))
@@ -1,5 +1,6 @@
-import os
-from math import log, sqrt
+import os, json
+import numpy as np
+from scipy import sparse
 
 
 QUERY = "query.txt"
@@ -7,36 +8,153 @@ PSEUDO_RELEVANCE_BM_25_SCORE_LIST = "PSEUDO_RELEVANCE_BM25_SCORE_LIST.txt"
 CACM_REL = "cacm.rel.txt"
 INPUT_DIRECTORY = "CORPUS"
 INPUT_FOLDER = os.getcwd() + "/" + INPUT_DIRECTORY
+INDEX_FOLDER = os.getcwd() + "/rm3_index"
 k1 = 1.2
 k2 = 100
 b = 0.75
 ALPHA = 1
 BETA = 0.75
 GAMMA = 0.15
-N = len(os.listdir(INPUT_FOLDER))
-
-
-def generateInvertedIndex():
-    invertedIndex = {}
-    tokenDict = {}
-    files = os.listdir(INPUT_FOLDER)
-    for file in files:
-        contents = open(INPUT_DIRECTORY + "/" + file, "r").read()
-        words = contents.split()
-        length = len(words)
-        file = file[:-4]
-        tokenDict[file] = length
-        for i in range(length):
-            word = words[i]
-            if word not in invertedIndex.keys():
-                docIDCount = {file : 1}
-                invertedIndex[word] = docIDCount
-            elif file in invertedIndex[word].keys():
-                invertedIndex[word][file] += 1
-            else:
-                docIDCount = {file : 1}
-                invertedIndex[word].update(docIDCount)
-    return invertedIndex
+FEEDBACK_DOCS = 10 # top 10 documents to be taken as relevant
+EXPANSION_TERMS = 20
+
+
+class SparseIndex:
+    """
+    The corpus as a document x term matrix of term frequencies
+
+    Attributes
+    ----------
+    docNames : List
+        The name of every document, the file name without .txt
+    vocabulary : Dictionary
+        Maps a term to its column
+    terms : List
+        The term of every column
+    tf : scipy.sparse.csr_matrix
+        Term frequencies, one row per document
+    tfColumns : scipy.sparse.csc_matrix
+        The same matrix stored by column, to read the postings of a term
+    df : numpy.ndarray
+        The number of documents containing each term
+    docLengths : numpy.ndarray
+        The number of tokens of each document
+    """
+
+    def __init__(self, docNames, terms, tf, tfColumns=None, df=None, \
+        docLengths=None):
+        self.docNames = docNames
+        self.terms = terms
+        self.vocabulary = {term: idx for idx, term in enumerate(terms)}
+        self.tf = tf.tocsr()
+        self.tfColumns = tf.tocsc() if tfColumns is None else tfColumns
+        self.df = np.diff(self.tfColumns.indptr) if df is None else df
+        self.docLengths = np.asarray(self.tf.sum(axis=1)).ravel() \
+            if docLengths is None else docLengths
+        self.avgLength = self.docLengths.mean() if len(docNames) else 0.0
+        self.docIds = {doc: idx for idx, doc in enumerate(docNames)}
+
+
+def generateSparseIndex(inputFolder=INPUT_FOLDER):
+    """
+    Reads the corpus once and builds its document x term matrix
+    """
+    vocabulary = {}
+    docNames = []
+    rows, cols = [], []
+    for docIdx, file in enumerate(os.listdir(inputFolder)):
+        with open(os.path.join(inputFolder, file), "r") as f:
+            words = f.read().split()
+        docNames.append(file[:-4])
+        for word in words:
+            cols.append(vocabulary.setdefault(word, len(vocabulary)))
+        rows.extend([docIdx] * len(words))
+
+    # Duplicate (document, term) entries are summed into frequencies
+    tf = sparse.coo_matrix(
+        (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+        shape=(len(docNames), len(vocabulary))).tocsr()
+    tf.sum_duplicates()
+    return SparseIndex(docNames, list(vocabulary), tf)
+
+
+def corpusFingerprint(inputFolder=INPUT_FOLDER):
+    """
+    Describes the corpus by the name, size and modification time of its
+    files, so a saved index can be checked without reading the corpus
+    """
+    files = []
+    for file in sorted(os.listdir(inputFolder)):
+        stat = os.stat(os.path.join(inputFolder, file))
+        files.append([file, stat.st_size, int(stat.st_mtime)])
+    return files
+
+
+def saveSparseIndex(index, fingerprint, indexFolder=INDEX_FOLDER):
+    """
+    Writes the index as .npy arrays: the per document term vectors (csr),
+    the postings (csc), the document frequencies and document lengths,
+    plus the document names and the vocabulary
+    """
+    os.makedirs(indexFolder, exist_ok=True)
+    arrays = {
+        "tf_data": index.tf.data, "tf_indices": index.tf.indices,
+        "tf_indptr": index.tf.indptr,
+        "postings_data": index.tfColumns.data,
+        "postings_indices": index.tfColumns.indices,
+        "postings_indptr": index.tfColumns.indptr,
+        "df": index.df, "doc_lengths": index.docLengths,
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(indexFolder, name + ".npy"), array)
+
+    with open(os.path.join(indexFolder, "index.json"), "w") as f:
+        json.dump({
+            "docNames": index.docNames,
+            "terms": index.terms,
+            "fingerprint": fingerprint,
+        }, f)
+
+
+def loadSparseIndex(indexFolder=INDEX_FOLDER, fingerprint=None):
+    """
+    Loads an index written by saveSparseIndex, with its arrays memory
+    mapped. Returns None if there is no index or if it was built from a
+    corpus with a different fingerprint
+    """
+    manifest = os.path.join(indexFolder, "index.json")
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        meta = json.load(f)
+    if fingerprint is not None and meta["fingerprint"] != fingerprint:
+        return None
+
+    def load(name):
+        return np.load(os.path.join(indexFolder, name + ".npy"), mmap_mode="r")
+
+    shape = (len(meta["docNames"]), len(meta["terms"]))
+    tf = sparse.csr_matrix(
+        (load("tf_data"), load("tf_indices"), load("tf_indptr")), shape=shape)
+    tfColumns = sparse.csc_matrix(
+        (load("postings_data"), load("postings_indices"),
+        load("postings_indptr")), shape=shape)
+    return SparseIndex(meta["docNames"], meta["terms"], tf, tfColumns=tfColumns,
+        df=load("df"), docLengths=load("doc_lengths"))
+
+
+def loadOrBuildIndex(inputFolder=INPUT_FOLDER, indexFolder=INDEX_FOLDER):
+    """
+    Returns the saved index of the corpus, building and saving it first
+    if the corpus changed since it was saved
+    """
+    fingerprint = corpusFingerprint(inputFolder)
+    index = loadSparseIndex(indexFolder, fingerprint)
+    if index is None:
+        print("Building index of", inputFolder)
+        index = generateSparseIndex(inputFolder)
+        saveSparseIndex(index, fingerprint, indexFolder)
+    return index
 
 
 def queryParser(query):
@@ -47,206 +165,178 @@ def queryParser(query):
     return queries
 
 
-def queryFrequency(query, invertedIndex):
-    queryFreq = {}
+def queryVector(query, index):
+    """
+    Returns the indexed terms of a query, their columns and how often
+    each of them appears in the query
+    """
+    counts = {}
     for term in query:
-        if term in queryFreq.keys():
-            queryFreq[term] += 1
-        else:
-            queryFreq[term] = 1
-    for term in invertedIndex:
-        if term not in queryFreq.keys():
-            queryFreq[term] = 0
-    return queryFreq
-
-
-def calculateLength():
-    fileLengths = {}
-    files = os.listdir("CORPUS")
-    for file in files:
-        doc = open("CORPUS/" + file,'r').read()
-        file = file[:-4]
-        fileLengths[file] = len(doc.split())
-    return fileLengths
-
-
-def calculateAverageLength(fileLengths):
-    avgLength = 0
-    for file in fileLengths.keys():
-        avgLength += fileLengths[file]
-    return avgLength/N
-
-
-def calculateBM25(n, f, qf, r, N, dl, avdl, R):
-    K = k1 * ((1 - b) + b * (float(dl) / float(avdl)))
-    Q1 = log(((r + 0.5) / (R - r + 0.5)) / ((n - r + 0.5) / (N - n - R + r + 0.5)))
-    Q2 = ((k1 + 1) * f) / (K + f)
+        if term in index.vocabulary:
+            counts[term] = counts.get(term, 0) + 1
+    terms = list(counts)
+    columns = np.array([index.vocabulary[x] for x in terms], dtype=np.int64)
+    qf = np.array([counts[x] for x in terms], dtype=np.float64)
+    return terms, columns, qf
+
+
+def loadRelevance(path=CACM_REL):
+    """
+    Reads the qrels once and maps every query id to its relevant documents
+    """
+    qrels = {}
+    for line in open(path, "r").read().splitlines():
+        values = line.split()
+        if values:
+            qrels.setdefault(values[0], []).append(values[2])
+    return qrels
+
+
+def getRelevantList(queryID, index, qrels):
+    """
+    Returns a boolean mask of the documents judged relevant for a query
+    """
+    relevant = np.zeros(len(index.docNames), dtype=bool)
+    for doc in qrels.get(str(queryID), []):
+        if doc in index.docIds:
+            relevant[index.docIds[doc]] = True
+    return relevant
+
+
+def calculateBM25(index, columns, qf, relevant, k1=k1, b=b):
+    """
+    Scores every document against the query terms in one pass over their
+    postings
+
+    The relevance information (r, R) comes from the qrels of the query.
+    A term repeated in the query is counted once per occurrence, with qf
+    being its total count. k1 and b default to the module constants
+
+    Returns the score of every document and, for every document, the
+    position among columns of the first query term it contains, -1 if it
+    contains none
+    """
+    N = len(index.docNames)
+    scores = np.zeros(N)
+    matched = np.full(N, -1, dtype=np.int64)
+    if len(columns) == 0:
+        return scores, matched
+
+    postings = index.tfColumns[:, columns]
+    R = relevant.sum()
+    n = index.df[columns].astype(np.float64)
+    r = np.asarray((postings[relevant] > 0).sum(axis=0)).ravel()
+
+    Q1 = np.log(((r + 0.5) / (R - r + 0.5)) / ((n - r + 0.5) / (N - n - R + r + 0.5)))
     Q3 = ((k2 + 1) * qf) / (k2 + qf)
-    return Q1 * Q2 * Q3
-
-
-def findr(listOfDocs, relDocs):
-    count = 0
-    for doc in listOfDocs:
-        if doc in relDocs:
-            count += 1
-    return count
+    termWeight = qf * Q1 * Q3
 
+    # One entry per (document, query term) posting
+    docs = postings.indices
+    termOfEntry = np.repeat(np.arange(len(columns)), np.diff(postings.indptr))
+    f = postings.data
+    K = k1 * ((1 - b) + b * (index.docLengths[docs] / index.avgLength))
+    Q2 = ((k1 + 1) * f) / (K + f)
 
-def getRelevantList(queryID, docList):
-    file = open(CACM_REL, "r").read().splitlines()
-    relList = []
-    relDocs = []
-    for line in file:
-        values = line.split()
-        if values[0] == str(queryID):
-            relList.append(values[2])
-    for doc in docList.keys():
-        if doc in relList:
-            relDocs.append(doc)
-    return relDocs
-
-
-def findDocs(k, sortedBM25Score, invertedIndex, relevancy):
-    relIndex = {}
-    nonRelIndex = {}
-    if relevancy == "Relevant":
-        for i in range(0, k):
-            doc,doc_score = sortedBM25Score[i]
-            relIndex = calculateDocsCount(doc, relIndex, invertedIndex)
-        for term in invertedIndex:
-            if term not in relIndex.keys():
-                relIndex[term] = 0
-        return relIndex
-    elif relevancy == "Non-Relevant":
-        for i in range(k+1,len(sortedBM25Score)):
-            doc,doc_score = sortedBM25Score[i]
-            nonRelIndex = calculateDocsCount(doc, nonRelIndex, invertedIndex)
-        for term in invertedIndex:
-            if term not in nonRelIndex.keys():
-                nonRelIndex[term] = 0   
-        return nonRelIndex
-
-
-def calculateDocsCount(doc, docIndex, invertedIndex):
-    doc= open(INPUT_FOLDER + "/" + doc + ".txt").read()
-    for term in doc.split():
-        if term in docIndex.keys():
-            docIndex[term] += 1
-        else:
-            docIndex[term] = 1
-    return docIndex
-
-
-def findRelDocMagnitude(docIndex):
-    mag = 0
-    for term in docIndex:
-        mag += float(docIndex[term]**2)
-        mag = float(sqrt(mag))
-    return mag
-
-
-def findNonRelDocMagnitude(docIndex):
-    mag = 0
-    for term in docIndex:
-        mag += float(docIndex[term]**2)
-    mag = float(sqrt(mag))
-    return mag
-
-
-def findRocchioScore(term, queryFreq, relDocMag, relIndex, nonRelMag, nonRelIndex):
-    Q1 = ALPHA * queryFreq[term] 
-    Q2 = (BETA/relDocMag) * relIndex[term]
-    Q3 = (GAMMA/nonRelMag) * nonRelIndex[term]
-    rocchioScore = ALPHA * queryFreq[term] + (BETA/relDocMag) * relIndex[term] - (GAMMA/nonRelMag) * nonRelIndex[term]
-    return rocchioScore
-
-
-def findNewQuery(query, queryFreq, relDocMag, relIndex, nonRelMag, nonRelIndex, invertedIndex):
-    updatedQuery = {}
-    newQuery = query
-    for term in invertedIndex:
-        updatedQuery[term] = findRocchioScore(term, queryFreq, relDocMag, relIndex, nonRelMag, nonRelIndex)
-    sortedUpdatedQuery = sorted(updatedQuery.items(), key=lambda x:x[1], reverse=True)
-
-    # print(sortedUpdatedQuery)
-    if len(sortedUpdatedQuery)<20:
-        loopRange = len(sortedUpdatedQuery)
-    else:
-        loopRange = 20
-    for i in range(loopRange):
-        term,frequency = sortedUpdatedQuery[i]
-        
-        if term not in query:
-            # print(term)
-            newQuery +=  [term]
-    return newQuery
-
-
-def pseudoRelevanceFeedbackScores(sortedBM25Score, query, invertedIndex, fileLengths, relevant_list, queryID):
-    global feedbackFlag
-    feedbackFlag += 1
-    newQuery = query
-    oldQuery = query
-    k = 10 # top 10 documents to be taken as relevant
-    queryFreq = queryFrequency(query, invertedIndex)
-    relIndex = findDocs(k, sortedBM25Score, invertedIndex, "Relevant")
-    relDocMag = findRelDocMagnitude(relIndex)
-    nonRelIndex = findDocs(k, sortedBM25Score, invertedIndex, "Non-Relevant")
-    nonRelMag = findNonRelDocMagnitude(nonRelIndex)
-    newQuery = findNewQuery(query, queryFreq, relDocMag, relIndex, nonRelMag, nonRelIndex, invertedIndex)
+    scores = np.bincount(docs, weights=termWeight[termOfEntry] * Q2, minlength=N)
+    firstTerm = np.full(N, len(columns), dtype=np.int64)
+    np.minimum.at(firstTerm, docs, termOfEntry)
+    matched[docs] = firstTerm[docs]
+    return scores, matched
+
+
+def rankDocuments(scores, matched):
+    """
+    Returns the rows of the matched documents, best score first
+
+    Ties keep the order of the original dictionary based script, the
+    order in which documents are met going through the postings of the
+    query terms: by their first query term, then by row
+    """
+    rows = np.flatnonzero(matched >= 0)
+    return rows[np.lexsort((rows, matched[rows], -scores[rows]))]
+
+
+def findRocchioScores(index, columns, qf, ranking, k=FEEDBACK_DOCS, \
+    alpha=ALPHA, beta=BETA, gamma=GAMMA):
+    """
+    Computes the Rocchio score of every term of the vocabulary, with the
+    top k documents as relevant and the rest of the ranking as non relevant
+    """
+    relIndex = np.asarray(index.tf[ranking[:k]].sum(axis=0)).ravel()
+    nonRelIndex = np.asarray(index.tf[ranking[k+1:]].sum(axis=0)).ravel()
+    return combineRocchio(index, columns, qf, relIndex, nonRelIndex, \
+        alpha, beta, gamma)
+
+
+def combineRocchio(index, columns, qf, relIndex, nonRelIndex, \
+    alpha=ALPHA, beta=BETA, gamma=GAMMA):
+    """
+    Combines the query with the summed term frequencies of the relevant
+    and non relevant documents
+    """
+    queryFreq = np.zeros(len(index.terms))
+    queryFreq[columns] = qf
+
+    relDocMag = np.sqrt(np.square(relIndex).sum()) or 1.0
+    nonRelMag = np.sqrt(np.square(nonRelIndex).sum()) or 1.0
+
+    return alpha * queryFreq + (beta/relDocMag) * relIndex - (gamma/nonRelMag) * nonRelIndex
+
+
+def findNewQuery(query, rocchioScores, index, numTerms=EXPANSION_TERMS):
+    """
+    Adds the best scoring terms which are not already in the query
+
+    Ties are taken in vocabulary order, like the stable sort of the
+    original script, also at the cut off, which argpartition alone would
+    break arbitrarily
+    """
+    numTerms = min(numTerms, len(rocchioScores))
+    if not numTerms:
+        return list(query)
+    cutOff = -np.partition(-rocchioScores, numTerms - 1)[numTerms - 1]
+    best = np.flatnonzero(rocchioScores >= cutOff)
+    best = best[np.argsort(-rocchioScores[best], kind="stable")][:numTerms]
+    return query + [index.terms[x] for x in best if index.terms[x] not in query]
+
+
+def expandQuery(query, index, relevant):
+    """
+    Runs BM25 and returns the query expanded with Rocchio feedback from
+    the top documents
+    """
+    terms, columns, qf = queryVector(query, index)
+    scores, matched = calculateBM25(index, columns, qf, relevant)
+    ranking = rankDocuments(scores, matched)
+
+    rocchioScores = findRocchioScores(index, columns, qf, ranking)
+    return findNewQuery(query, rocchioScores, index)
+
+
+def pseudoRelevanceFeedbackScores(query, index, relevant):
+    """
+    Runs BM25, expands the query with Rocchio feedback from the top
+    documents and returns the BM25 scores of the expanded query
+    """
+    newQuery = expandQuery(query, index, relevant)
     print(newQuery)
     print('*'*80)
-    # import pdb
-    # pdb.set_trace()
-    PseudoRelevanceScoreList = findDocumentsForQuery(newQuery, invertedIndex, fileLengths, queryID)
-    return PseudoRelevanceScoreList
-
-
-def findDocumentsForQuery(query, invertedIndex, fileLengths, queryID):
-    global feedbackFlag
-    N = len(fileLengths.keys())
-    queryFreq = queryFrequency(query, invertedIndex)
-    avdl = calculateAverageLength(fileLengths)
-    BM25ScoreList = {}
-    relevantList = getRelevantList(queryID, fileLengths)
-    R = len(relevantList)
-    if type(query) != list:
-        query = query.split()
-    for term in query:
-        if term in invertedIndex.keys():
-            qf = queryFreq[term]
-            docDict = invertedIndex[term]
-            r = findr(invertedIndex[term], relevantList)
-            for doc in docDict:
-                n = len(docDict)
-                f = docDict[doc]
-                dl = fileLengths[doc]
-                BM25 = calculateBM25(n, f, qf, r, N, dl, avdl, R)
-                if doc in BM25ScoreList.keys():
-                    BM25ScoreList[doc] += BM25
-                else:
-                    BM25ScoreList[doc] = BM25
-    sortedBM25Score = sorted(BM25ScoreList.items(), key=lambda x:x[1], reverse=True)
-    if feedbackFlag == 1:
-        return pseudoRelevanceFeedbackScores(sortedBM25Score, query, invertedIndex , fileLengths, relevantList, queryID)
-    elif feedbackFlag == 2:
-        feedbackFlag = 1
-        return BM25ScoreList
-
-
-def writeToFile(queries, invertedIndex, fileLengths):
-    global feedbackFlag
+
+    terms, columns, qf = queryVector(newQuery, index)
+    return calculateBM25(index, columns, qf, relevant)
+
+
+def writeToFile(queries, index, qrels):
     queryID = 1
-    file = open(PSEUDO_RELEVANCE_BM_25_SCORE_LIST, "w")       
-    queryNames = open(QUERY, 'r').read().splitlines()
+    file = open(PSEUDO_RELEVANCE_BM_25_SCORE_LIST, "w")
     for query in queries:
-        feedbackFlag = 1
         print(query)
-        PSRBM25ScoreList = findDocumentsForQuery(query, invertedIndex, fileLengths, queryID)
-        sortedScoreList = sorted(PSRBM25ScoreList.items(), key=lambda x:x[1], reverse=True)
-        for rank in range(100):
-            text = str(queryID) +  "   " + "Q0" +  "   " + str(sortedScoreList[rank][0]) + "   " + str(rank+1) +  "   " + str(sortedScoreList[rank][1]) +  "   " + "PSR-BM25" +"\n"
+        relevant = getRelevantList(queryID, index, qrels)
+        scores, matched = pseudoRelevanceFeedbackScores(query, index, relevant)
+        ranking = rankDocuments(scores, matched)
+        for rank, doc in enumerate(ranking[:100]):
+            text = str(queryID) +  "   " + "Q0" +  "   " + str(index.docNames[doc]) + "   " + str(rank+1) +  "   " + str(scores[doc]) +  "   " + "PSR-BM25" +"\n"
             file.write(text)
         file.write("\n\n ---------------------------------------------------------------------------------------\n\n\n")
         print("Query" + str(queryID) + " Done!")
@@ -254,9 +344,45 @@ def writeToFile(queries, invertedIndex, fileLengths):
     file.close()
 
 
+def checkTieOrder():
+    """
+    Checks that ties are ranked like the original script: documents in
+    the order they are first met through the postings of the query terms
+    and expansion terms in vocabulary order
+    """
+    # "b" and "a" have the same statistics, "x" and "y" fill the documents
+    docs = [["b", "x"], ["a", "y"], ["x", "y"]]
+    terms = ["b", "x", "a", "y"]
+    rows = [doc for doc, words in enumerate(docs) for _ in words]
+    cols = [terms.index(word) for words in docs for word in words]
+    tf = sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), \
+        shape=(len(docs), len(terms)))
+    index = SparseIndex(["d0", "d1", "d2"], terms, tf)
+
+    terms, columns, qf = queryVector(["a", "b"], index)
+    scores, matched = calculateBM25(index, columns, qf, \
+        np.zeros(len(docs), dtype=bool))
+    assert scores[0] == scores[1]
+    assert list(rankDocuments(scores, matched)) == [1, 0]
+
+    vocabulary = ["t" + str(x) for x in range(60)]
+    index = SparseIndex(["d0"], vocabulary, \
+        sparse.csr_matrix(np.ones((1, len(vocabulary)))))
+    rocchioScores = np.array([x % 3 for x in range(len(vocabulary))], \
+        dtype=np.float64)
+    expected = sorted(range(len(vocabulary)), key=lambda x: rocchioScores[x], \
+        reverse=True)[:EXPANSION_TERMS]
+    assert findNewQuery([], rocchioScores, index) == \
+        [vocabulary[x] for x in expected]
+
+
 def main():
     queries = queryParser(QUERY)
-    invertedIndex = generateInvertedIndex()
-    fileLengths = calculateLength()
-    writeToFile(queries, invertedIndex, fileLengths)
-main()
\ No newline at end of file
+    index = loadOrBuildIndex()
+    qrels = loadRelevance()
+    writeToFile(queries, index, qrels)
+
+
+if __name__ == '__main__':
+    checkTieOrder()
+    main()
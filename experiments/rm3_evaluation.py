@@ -0,0 +1,159 @@
+"""
+Evaluates BM25 and pseudo relevance feedback runs of the RM3 experiment
+against the CACM qrels
+
+Queries are scored by a process pool, each worker memory maps the index
+built by RM3_query_exansion.loadOrBuildIndex. Every run is written as a
+TREC run file and MAP, P@k, MRR and nDCG@k are written to a summary
+
+Run from the experiments directory
+    python rm3_evaluation.py
+"""
+import os, json
+from multiprocessing import Pool
+import numpy as np
+
+from RM3_query_exansion import QUERY, INDEX_FOLDER, queryParser, \
+    loadOrBuildIndex, loadSparseIndex, loadRelevance, getRelevantList, \
+    queryVector, calculateBM25, rankDocuments, expandQuery
+
+RUN_FOLDER = os.getcwd() + "/runs"
+RUN_DEPTH = 1000
+CUTOFFS = (5, 10, 20)
+
+# name : (use pseudo relevance feedback, score with the qrels as relevance
+# information like the original PSR-BM25 run)
+RUNS = {
+    "BM25": (False, False),
+    "PRF-BM25": (True, False),
+    "PSR-BM25": (True, True),
+}
+
+# The index and qrels of a worker process, loaded once per process
+_index = None
+_qrels = None
+
+
+def initWorker(indexFolder):
+    global _index, _qrels
+    _index = loadSparseIndex(indexFolder)
+    _qrels = loadRelevance()
+
+
+def runQuery(task):
+    """
+    Scores one query and returns its top RUN_DEPTH documents and scores
+
+    Inputs
+    ------
+    task : Tuple
+        (queryID, query terms, use feedback, use relevance information)
+    """
+    queryID, query, feedback, useRelevance = task
+    if useRelevance:
+        relevant = getRelevantList(queryID, _index, _qrels)
+    else:
+        relevant = np.zeros(len(_index.docNames), dtype=bool)
+
+    if feedback:
+        query = expandQuery(query, _index, relevant)
+    terms, columns, qf = queryVector(query, _index)
+    scores, matched = calculateBM25(_index, columns, qf, relevant)
+    ranking = rankDocuments(scores, matched)[:RUN_DEPTH]
+    return queryID, [_index.docNames[x] for x in ranking], scores[ranking].tolist()
+
+
+def evaluate(rankings, qrels, cutoffs=CUTOFFS, depth=RUN_DEPTH):
+    """
+    Computes MAP, P@k, MRR and nDCG@k of a run
+
+    Queries without relevant documents in the qrels are left out, as
+    trec_eval does
+
+    Inputs
+    ------
+    rankings : Dictionary
+        Maps a query id to its ranked list of document names
+    qrels : Dictionary
+        Maps a query id to its relevant document names
+    """
+    queryIDs = [x for x in sorted(rankings, key=int) if qrels.get(str(x))]
+    if not queryIDs:
+        return {"queries": 0}
+
+    relevance = np.zeros((len(queryIDs), depth), dtype=bool)
+    numRelevant = np.zeros(len(queryIDs))
+    for row, queryID in enumerate(queryIDs):
+        relevantDocs = set(qrels[str(queryID)])
+        numRelevant[row] = len(relevantDocs)
+        docs = rankings[queryID][:depth]
+        relevance[row, :len(docs)] = [doc in relevantDocs for doc in docs]
+
+    ranks = np.arange(1, depth + 1)
+    hits = np.cumsum(relevance, axis=1)
+    precision = hits / ranks
+
+    averagePrecision = (precision * relevance).sum(axis=1) / numRelevant
+    firstHit = relevance.argmax(axis=1)
+    reciprocalRank = np.where(relevance.any(axis=1), 1.0 / (firstHit + 1), 0.0)
+
+    discount = 1.0 / np.log2(ranks + 1)
+    idealTable = np.concatenate([[0.0], np.cumsum(discount)])
+
+    summary = {
+        "queries": len(queryIDs),
+        "MAP": averagePrecision.mean(),
+        "MRR": reciprocalRank.mean(),
+    }
+    for k in cutoffs:
+        summary["P@" + str(k)] = (hits[:, k - 1] / k).mean()
+        dcg = (relevance[:, :k] * discount[:k]).sum(axis=1)
+        idcg = idealTable[np.minimum(numRelevant, k).astype(int)]
+        summary["nDCG@" + str(k)] = (dcg / idcg).mean()
+    return {key: float(value) for key, value in summary.items()}
+
+
+def writeRun(path, name, results):
+    """
+    Writes a run in the TREC format: qid Q0 doc rank score tag
+    """
+    with open(path, "w") as f:
+        for queryID in sorted(results, key=int):
+            docs, scores = results[queryID]
+            for rank, (doc, score) in enumerate(zip(docs, scores)):
+                f.write(str(queryID) + " Q0 " + doc + " " + str(rank + 1) + \
+                    " " + str(score) + " " + name + "\n")
+
+
+def main(processes=None):
+    queries = queryParser(QUERY)
+    # Built once here, the workers only memory map it
+    loadOrBuildIndex()
+    qrels = loadRelevance()
+    os.makedirs(RUN_FOLDER, exist_ok=True)
+
+    summaries = {}
+    with Pool(processes, initializer=initWorker, initargs=(INDEX_FOLDER,)) as pool:
+        for name, (feedback, useRelevance) in RUNS.items():
+            tasks = [(queryID, query, feedback, useRelevance) \
+                for queryID, query in enumerate(queries, start=1)]
+            results = {}
+            for queryID, docs, scores in pool.imap_unordered(runQuery, tasks):
+                results[queryID] = (docs, scores)
+
+            writeRun(os.path.join(RUN_FOLDER, name + ".run"), name, results)
+            summaries[name] = evaluate(\
+                {x: docs for x, (docs, _) in results.items()}, qrels)
+
+    with open(os.path.join(RUN_FOLDER, "summary.json"), "w") as f:
+        json.dump(summaries, f, indent=2)
+
+    metrics = [x for x in next(iter(summaries.values())) if x != "queries"]
+    print("run".ljust(12) + "".join(x.rjust(9) for x in metrics))
+    for name, summary in summaries.items():
+        print(name.ljust(12) + "".join(\
+            ("%.4f" % summary.get(x, 0)).rjust(9) for x in metrics))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+Sweeps the BM25 and Rocchio feedback parameters of the RM3 experiment
+
+The first stage BM25 ranking of every query and the term statistics of
+its feedback documents only depend on k1 and b, so they are computed once
+per (k1, b) and cached. Every feedback setting then only recomputes the
+Rocchio scores and rescores the expanded query, and expanded queries which
+come out identical for several settings are scored once
+
+Settings are evaluated by a process pool and ranked by MAP. The best one
+is printed as the defaults of the /anserini handler of
+solr_rm3/solrconfig.xml and the BM25 similarity of solr_rm3/managed-schema
+
+Run from the experiments directory
+    python rm3_sweep.py
+"""
+import os, json, itertools
+from functools import lru_cache
+from multiprocessing import Pool
+import numpy as np
+
+from RM3_query_exansion import QUERY, INDEX_FOLDER, queryParser, \
+    loadOrBuildIndex, loadSparseIndex, loadRelevance, getRelevantList, \
+    queryVector, calculateBM25, rankDocuments, combineRocchio, findNewQuery
+from rm3_evaluation import RUN_FOLDER, RUN_DEPTH, evaluate
+
+# The values tried for every parameter, the sweep covers every combination
+SWEEP_GRID = {
+    "k1": [0.9, 1.2, 1.5],
+    "b": [0.4, 0.75],
+    "alpha": [1],
+    "beta": [0.5, 0.75, 1.0],
+    "gamma": [0, 0.15],
+    "fbDocs": [5, 10, 20],
+    "fbTerms": [10, 20, 50],
+}
+FEEDBACK_PARAMS = ("alpha", "beta", "gamma", "fbDocs", "fbTerms")
+
+# Set by initWorker in every worker process
+_index = None
+_queries = None
+_relevant = None
+
+
+def initWorker(indexFolder, queries, useRelevance):
+    global _index, _queries, _relevant
+    _index = loadSparseIndex(indexFolder)
+    _queries = queries
+    qrels = loadRelevance()
+    noRelevance = np.zeros(len(_index.docNames), dtype=bool)
+    _relevant = [getRelevantList(queryID, _index, qrels) if useRelevance \
+        else noRelevance for queryID in range(1, len(queries) + 1)]
+
+
+class FirstStage:
+    """
+    The first stage ranking of a query and the term frequencies of its
+    feedback candidates, for one (k1, b)
+
+    Attributes
+    ----------
+    columns, qf : numpy.ndarray
+        The query vector
+    topTf : scipy.sparse.csr_matrix
+        The term frequencies of the top ranked documents, in rank order
+    rankedTf : numpy.ndarray
+        The term frequencies summed over the whole ranking
+    """
+
+    def __init__(self, columns, qf, ranking, maxDocs):
+        self.columns = columns
+        self.qf = qf
+        self.topTf = _index.tf[ranking[:maxDocs + 1]]
+        matched = np.zeros(len(_index.docNames))
+        matched[ranking] = 1
+        self.rankedTf = _index.tf.T @ matched
+
+    def feedbackStats(self, k):
+        """
+        Returns the summed term frequencies of the top k documents and of
+        the ranking after document k+1, as findRocchioScores does
+        """
+        relIndex = np.asarray(self.topTf[:k].sum(axis=0)).ravel()
+        skipped = np.asarray(self.topTf[k:k + 1].sum(axis=0)).ravel()
+        return relIndex, self.rankedTf - relIndex - skipped
+
+
+@lru_cache(maxsize=None)
+def firstStage(k1, b, maxDocs):
+    stages = []
+    for query, relevant in zip(_queries, _relevant):
+        terms, columns, qf = queryVector(query, _index)
+        scores, matched = calculateBM25(_index, columns, qf, relevant, k1, b)
+        stages.append(FirstStage(columns, qf, rankDocuments(scores, matched), maxDocs))
+    return stages
+
+
+@lru_cache(maxsize=1 << 16)
+def secondStage(queryIdx, k1, b, newQuery):
+    terms, columns, qf = queryVector(list(newQuery), _index)
+    scores, matched = calculateBM25(_index, columns, qf, _relevant[queryIdx], k1, b)
+    ranking = rankDocuments(scores, matched)[:RUN_DEPTH]
+    return [_index.docNames[x] for x in ranking]
+
+
+def evaluateSettings(task):
+    """
+    Evaluates a list of feedback settings sharing the same k1 and b
+
+    Inputs
+    ------
+    task : Tuple
+        (k1, b, largest number of feedback documents of the sweep,
+        list of feedback settings as dictionaries)
+    """
+    k1, b, maxDocs, settings = task
+    stages = firstStage(k1, b, maxDocs)
+    qrels = loadRelevance()
+    results = []
+    for setting in settings:
+        rankings = {}
+        for queryIdx, (query, stage) in enumerate(zip(_queries, stages)):
+            relIndex, nonRelIndex = stage.feedbackStats(setting["fbDocs"])
+            rocchio = combineRocchio(_index, stage.columns, stage.qf, \
+                relIndex, nonRelIndex, setting["alpha"], setting["beta"], \
+                setting["gamma"])
+            newQuery = findNewQuery(query, rocchio, _index, setting["fbTerms"])
+            rankings[queryIdx + 1] = secondStage(queryIdx, k1, b, tuple(newQuery))
+
+        params = dict(setting, k1=k1, b=b)
+        results.append((params, evaluate(rankings, qrels)))
+    return results
+
+
+def sweepTasks(grid, chunks):
+    """
+    Splits the grid into tasks sharing one (k1, b), with the feedback
+    settings of every (k1, b) spread over the given number of chunks
+    """
+    maxDocs = max(grid["fbDocs"])
+    settings = [dict(zip(FEEDBACK_PARAMS, values)) for values in \
+        itertools.product(*(grid[x] for x in FEEDBACK_PARAMS))]
+    tasks = []
+    for k1, b in itertools.product(grid["k1"], grid["b"]):
+        for idx in range(chunks):
+            if settings[idx::chunks]:
+                tasks.append((k1, b, maxDocs, settings[idx::chunks]))
+    return tasks
+
+
+def anseriniDefaults(params):
+    """
+    Maps sweep parameters to the defaults of the /anserini handler. The
+    handler runs RM3 rather than Rocchio, the weight of the original query
+    is taken as the share of alpha in alpha + beta
+    """
+    return {
+        "rm3.fbDocs": params["fbDocs"],
+        "rm3.fbTerms": params["fbTerms"],
+        "rm3.originalQueryWeight": \
+            round(params["alpha"] / (params["alpha"] + params["beta"]), 2),
+    }
+
+
+def main(grid=SWEEP_GRID, useRelevance=False, processes=None):
+    queries = queryParser(QUERY)
+    loadOrBuildIndex()
+    processes = processes or os.cpu_count() or 1
+    pairs = len(grid["k1"]) * len(grid["b"])
+    tasks = sweepTasks(grid, max(1, -(-processes // pairs)))
+
+    results = []
+    with Pool(processes, initializer=initWorker, \
+        initargs=(INDEX_FOLDER, queries, useRelevance)) as pool:
+        for taskResults in pool.imap_unordered(evaluateSettings, tasks):
+            results.extend(taskResults)
+
+    results.sort(key=lambda x: x[1].get("MAP", 0), reverse=True)
+    os.makedirs(RUN_FOLDER, exist_ok=True)
+    with open(os.path.join(RUN_FOLDER, "sweep.json"), "w") as f:
+        json.dump([{"params": p, "metrics": m} for p, m in results], f, indent=2)
+
+    print(len(results), "settings evaluated, top 10 by MAP")
+    for params, metrics in results[:10]:
+        print("MAP %.4f  P@10 %.4f  nDCG@10 %.4f  " % (metrics.get("MAP", 0), \
+            metrics.get("P@10", 0), metrics.get("nDCG@10", 0)), params)
+
+    best = anseriniDefaults(results[0][0])
+    print("\nBest settings for the /anserini handler")
+    for name, value in best.items():
+        print('  <str name="' + name + '">' + str(value) + '</str>')
+    print("and for the BM25 similarity of the field types of the schema")
+    for name in ("b", "k1"):
+        print('  <str name="' + name + '">' + str(results[0][0][name]) + '</str>')
+    return results
+
+
+if __name__ == '__main__':
+    main()
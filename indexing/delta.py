@@ -0,0 +1,94 @@
+import hashlib, json
+
+from indexing.near_duplicates import CLUSTER_FIELD
+from indexing.versioning import HIDDEN_IN_FIELD
+
+# Solr field holding the content hash, a string dynamic field
+CONTENT_HASH_FIELD = "content_hash_s"
+
+
+def content_hash(question):
+    """
+    Returns a hash of all the original fields of a question
+
+    Generated variations, rm3 copies of the question, the near duplicate
+    cluster, the versions hiding it and the hash itself are ignored, so
+    that a document copied from solr hashes the same as the question it
+    was created from
+
+    Inputs
+    ------
+    question : Dictionary
+        The question as it is passed to SolrSearchEngine.index
+    """
+    content = {}
+    for key, value in question.items():
+        if "variation" in key or key in (CONTENT_HASH_FIELD, "_version_", \
+            "para_text_bm", "para_text_ql", "score", CLUSTER_FIELD, \
+            HIDDEN_IN_FIELD):
+            continue
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        if value == "" or value == "-":
+            continue
+        content[key] = value
+
+    serialized = json.dumps(content, sort_keys=True, ensure_ascii=False, \
+        default=str)
+    return hashlib.sha1(serialized.encode()).hexdigest()
+
+
+class DeltaTracker:
+    """
+    Compares incoming questions against the hashes already present in a
+    collection, one question at a time so the questions can be streamed
+
+    Attributes
+    ----------
+    existing_hashes : Dictionary
+        Maps the id of every document in the collection to its hash
+    existing_clusters : Dictionary
+        Maps the id of every document to its stored near duplicate
+        cluster, None if clusters are not tagged
+    retagged : Dictionary
+        Maps the id of every unchanged question whose cluster is not the
+        stored one to its new cluster
+    unchanged : Integer
+        The number of questions seen which can be skipped
+    changed : Integer
+        The number of questions seen which are new or changed
+    """
+
+    def __init__(self, existing_hashes, existing_clusters=None):
+        self.existing_hashes = existing_hashes
+        self.existing_clusters = existing_clusters
+        self.retagged = {}
+        self.seen = set()
+        self.unchanged = 0
+        self.changed = 0
+
+    def is_unchanged(self, question):
+        """
+        Records a question, which must already have an id and a
+        CONTENT_HASH_FIELD, and returns True if it can be skipped
+        """
+        self.seen.add(question['id'])
+        if self.existing_hashes.get(question['id']) == \
+            question[CONTENT_HASH_FIELD]:
+            self.unchanged += 1
+            # The cluster is not hashed, it depends on the other questions
+            if self.existing_clusters is not None and \
+                CLUSTER_FIELD in question and question[CLUSTER_FIELD] != \
+                self.existing_clusters.get(question['id']):
+                self.retagged[question['id']] = question[CLUSTER_FIELD]
+            return True
+        self.changed += 1
+        return False
+
+    def removed(self):
+        """
+        Returns the ids present in the collection but in none of the
+        questions seen
+        """
+        return [doc_id for doc_id in self.existing_hashes \
+            if doc_id not in self.seen]
@@ -0,0 +1,229 @@
+import os, re, json, queue, threading
+from concurrent.futures import ThreadPoolExecutor
+
+JSON_EXTENSIONS = (".json", ".jsonl")
+
+# Marks the end of the documents of one file on the shared queue
+_FILE_DONE = object()
+
+# The start of an object wrapping an array of objects, like {"QA_Pairs": [{
+_WRAPPER_START = re.compile(\
+    r'\{\s*"(?:[^"\\]|\\.)*"\s*:\s*(?=\[\s*\{)')
+
+
+def iter_json_array(f, buf="", chunk_size=1 << 16):
+    """
+    Incrementally yields the elements of a json array read from the file
+    object f, without loading the whole array in memory. buf holds text
+    which was already read from f. Returns the text read after the array
+    """
+    decoder = json.JSONDecoder()
+    buf = buf + f.read(chunk_size)
+    pos = buf.index("[") + 1
+    eof = False
+
+    while True:
+        # Skip whitespace and separators between elements
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+
+        if pos >= len(buf):
+            return ""
+        if buf[pos] == "]":
+            return buf[pos + 1:]
+
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            more = f.read(chunk_size)
+            if not more:
+                raise
+            # Keep only the undecoded part of the buffer
+            buf, pos = buf[pos:] + more, 0
+            continue
+
+        yield element
+        pos = end
+
+
+def is_wrapped_array(f, buf, chunk_size):
+    """
+    Returns True if the rest of the file object f, starting with the
+    array whose beginning is in buf, is an array of documents closing the
+    object wrapping it. The array is decoded one element at a time and
+    discarded, so this takes no more memory than streaming it
+    """
+    elements = iter_json_array(f, buf, chunk_size)
+    while True:
+        try:
+            element = next(elements)
+        except StopIteration as stop:
+            return (stop.value + f.read()).strip() == "}"
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(element, dict):
+            return False
+
+
+def iter_json_file(path, chunk_size=1 << 16):
+    """
+    Yields the documents of a json file
+
+    Three layouts are supported
+        a single document                       {"question": ...}
+        an array of documents, or an object
+        wrapping one, like {"QA_Pairs": [...]}  [{...}, {...}]
+        json lines, one document per line       *.jsonl
+
+    Arrays are streamed. A wrapped array is streamed once a first pass
+    has checked that the wrapping object has no other member and that
+    every element is a document, any other object is loaded whole
+
+    Inputs
+    ------
+    path : String
+        The path of the file
+    chunk_size : Integer
+        The number of characters read at a time when streaming an array
+    """
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+
+        head = f.read(chunk_size).lstrip()
+        if head.startswith("["):
+            yield from iter_json_array(f, head, chunk_size)
+            return
+
+        wrapper = _WRAPPER_START.match(head)
+        if wrapper and is_wrapped_array(f, head[wrapper.end():], chunk_size):
+            f.seek(0)
+            head = f.read(chunk_size).lstrip()
+            yield from iter_json_array(f, \
+                head[_WRAPPER_START.match(head).end():], chunk_size)
+            return
+
+        f.seek(0)
+        document = json.loads(f.read())
+
+    wrapped = [x for x in document.values() if isinstance(x, list)] \
+        if isinstance(document, dict) else []
+    if len(wrapped) == 1 and len(document) == 1 and \
+        all(isinstance(x, dict) for x in wrapped[0]):
+        yield from wrapped[0]
+    else:
+        yield document
+
+
+def list_json_files(index_dir):
+    """
+    Returns the sorted paths of the json and jsonl files of a directory
+    """
+    return [os.path.join(index_dir, filename) \
+        for filename in sorted(os.listdir(index_dir)) \
+        if filename.endswith(JSON_EXTENSIONS)]
+
+
+def iter_json_folder(index_dir, num_workers=4, max_pending=1000):
+    """
+    Yields every document of the json files of a directory
+
+    Files are parsed by a thread pool which feeds a bounded queue, so at
+    most max_pending parsed documents are held in memory no matter how
+    many documents the folder contains. Documents of a file keep their
+    order, documents of different files may be interleaved
+
+    Inputs
+    ------
+    index_dir : String
+        The directory containing the json files
+    num_workers : Integer
+        The number of files parsed concurrently
+    max_pending : Integer
+        The maximum number of parsed documents waiting to be indexed
+    """
+    paths = list_json_files(index_dir)
+    if not paths:
+        return
+
+    pending = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up once the consumer has stopped, instead of blocking
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def parse(path):
+        try:
+            for document in iter_json_file(path):
+                if not put(document):
+                    return
+        except Exception as e:
+            put(ValueError("could not parse " + path + " : " + repr(e)))
+        finally:
+            put(_FILE_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        for path in paths:
+            executor.submit(parse, path)
+
+        files_left = len(paths)
+        while files_left:
+            item = pending.get()
+            if item is _FILE_DONE:
+                files_left -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Unblock workers if the consumer stopped early
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    test_dir = tempfile.mkdtemp()
+    cases = {
+        # A single document whose first member is an array
+        "document.json": ('{"variations": ["a", "b"], "question": "q"}',
+            [{"variations": ["a", "b"], "question": "q"}]),
+        # A wrapper with another member is one document, nothing streamed
+        "members.json": ('{"QA_Pairs": [{"q": 1}, {"q": 2}], "count": 2}',
+            [{"QA_Pairs": [{"q": 1}, {"q": 2}], "count": 2}]),
+        "wrapped.json": ('{"QA_Pairs": [{"q": 1}, {"q": [2]}]}',
+            [{"q": 1}, {"q": [2]}]),
+        "array.json": ('[{"q": 1}, {"q": 2}]', [{"q": 1}, {"q": 2}]),
+    }
+    for filename, (text, expected) in cases.items():
+        path = os.path.join(test_dir, filename)
+        with open(path, "w") as f:
+            f.write(text)
+        for chunk_size in (4, 1 << 16):
+            documents = list(iter_json_file(path, chunk_size=chunk_size))
+            assert documents == expected, (filename, chunk_size, documents)
+
+    path = "test_data/json_array_data/jsonArray.json"
+    if os.path.exists(path):
+        with open(path) as f:
+            assert list(iter_json_file(path, chunk_size=64)) == \
+                json.load(f)["QA_Pairs"]
+    print("json stream loader checks passed")
@@ -0,0 +1,135 @@
+import zlib
+import numpy as np
+
+from indexing.text_analysis import analyze
+
+# Field holding the id of the first question of a near duplicate cluster
+CLUSTER_FIELD = "near_duplicate_cluster_s"
+
+DEDUPE_MODES = ("merge", "tag")
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingles(text, size=4):
+    """
+    Returns the character shingles of the analyzed text. Questions are
+    short, so characters give more overlap than word shingles
+    """
+    normalized = " ".join(analyze(text))
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[idx:idx + size] \
+        for idx in range(len(normalized) - size + 1)}
+
+
+class NearDuplicateDetector:
+    """
+    Clusters near duplicate questions as they are indexed, with MinHash
+    signatures and locality sensitive hashing
+
+    A question is compared only to the questions sharing one of its LSH
+    bands, and joins the cluster of the first one whose estimated jaccard
+    similarity reaches the threshold. This is single linkage clustering in
+    roughly linear time, usable on a stream of questions
+
+    Attributes
+    ----------
+    threshold : Float
+        The estimated jaccard similarity of the shingles above which two
+        questions are near duplicates
+    num_perm : Integer
+        The number of MinHash permutations
+    bands : Integer
+        The number of LSH bands, num_perm must be a multiple of it
+    clusters : Dictionary
+        Maps the id of every question seen to the id of the first
+        question of its cluster
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, \
+        shingle_size=4, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        generator = np.random.RandomState(seed)
+        self.a = generator.randint(1, (1 << 61) - 1, size=num_perm, \
+            dtype=np.uint64)
+        self.b = generator.randint(0, (1 << 61) - 1, size=num_perm, \
+            dtype=np.uint64)
+
+        self.signatures = {}
+        self.buckets = {}
+        self.clusters = {}
+        self.cluster_sizes = {}
+
+    def signature(self, text):
+        """
+        Returns the MinHash signature of a text, None if it has no shingles
+        """
+        values = shingles(text, self.shingle_size)
+        if not values:
+            return None
+        hashes = np.array([zlib.crc32(x.encode()) for x in values], \
+            dtype=np.uint64)
+        # Overflow is expected, the permutations only need to be consistent
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME
+        return (permuted & _MAX_HASH).min(axis=0)
+
+    def add(self, doc_id, text):
+        """
+        Adds a question and returns the id of its cluster, which is its
+        own id unless it is a near duplicate of a question seen before
+        """
+        doc_id = str(doc_id)
+        if doc_id in self.clusters:
+            return self.clusters[doc_id]
+        signature = self.signature(text)
+        if signature is None:
+            self.clusters[doc_id] = doc_id
+            self.cluster_sizes[doc_id] = 1
+            return doc_id
+
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows]\
+            .tobytes()) for band in range(self.bands)]
+        cluster = None
+        checked = set()
+        for key in keys:
+            for other in self.buckets.get(key, ()):
+                if other in checked:
+                    continue
+                checked.add(other)
+                similarity = np.mean(self.signatures[other] == signature)
+                if similarity >= self.threshold:
+                    cluster = self.clusters[other]
+                    break
+            if cluster is not None:
+                break
+
+        cluster = cluster or doc_id
+        self.signatures[doc_id] = signature
+        self.clusters[doc_id] = cluster
+        self.cluster_sizes[cluster] = self.cluster_sizes.get(cluster, 0) + 1
+        for key in keys:
+            self.buckets.setdefault(key, []).append(doc_id)
+        return cluster
+
+    def summary(self):
+        """
+        Returns the number of questions seen, of clusters with near
+        duplicates, of near duplicates and the size of the largest cluster
+        """
+        sizes = [x for x in self.cluster_sizes.values() if x > 1]
+        return {
+            "questions": len(self.clusters),
+            "clusters": len(sizes),
+            "duplicates": sum(sizes) - len(sizes),
+            "largest_cluster": max(sizes, default=1),
+        }
@@ -0,0 +1,121 @@
+import json, zlib
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_line(doc):
+    """
+    Serializes a document into one line of newline delimited json, with
+    orjson when it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(doc) + b"\n"
+    return json.dumps(doc, ensure_ascii=False, separators=(",", ":"))\
+        .encode() + b"\n"
+
+
+def iter_ndjson(docs, chunk_size=1 << 16):
+    """
+    Yields the documents as newline delimited json, in chunks of roughly
+    chunk_size bytes, without building the whole payload
+    """
+    chunk = []
+    size = 0
+    for doc in docs:
+        line = dumps_line(doc)
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def iter_gzip(chunks, level=6):
+    """
+    Gzip compresses a stream of byte chunks incrementally
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class SolrUpdateStream:
+    """
+    Streams documents to the /update/json/docs handler of a collection as
+    newline delimited json, optionally gzip compressed
+
+    The request body is generated while it is sent, so neither the json
+    payload nor its compressed form is ever held in memory. Compressed
+    bodies need request inflation to be enabled in the jetty GzipHandler
+    of the solr nodes (inflateBufferSize)
+
+    Attributes
+    ----------
+    session : requests.Session
+        The session used to send the updates
+    compress : Bool
+        Wether request bodies are gzip compressed
+    """
+
+    def __init__(self, session=None, compress=True, compress_level=6, \
+        chunk_size=1 << 16):
+        """
+        Inputs
+        ------
+        session : requests.Session
+            The session used to send the updates, a new one by default
+        compress : Bool
+            Wether request bodies are gzip compressed
+        compress_level : Integer
+            The zlib compression level, lower is faster
+        chunk_size : Integer
+            The approximate number of bytes serialized at a time
+        """
+        self.session = session or requests.Session()
+        self.compress = compress
+        self.compress_level = compress_level
+        self.chunk_size = chunk_size
+
+    def add(self, index_url, docs, commit=False, commit_within=None):
+        """
+        Sends the documents to a collection
+
+        Inputs
+        ------
+        index_url : String
+            Url of the solr collection
+        docs : Iterable
+            The documents to add, consumed while the request is sent
+        commit : Bool
+            Wether solr must commit after the update
+        commit_within : Integer
+            Milliseconds within which solr must commit the update
+
+        Returns the json response of solr, raises requests.HTTPError if
+        the update failed
+        """
+        params = {"wt": "json"}
+        if commit:
+            params["commit"] = "true"
+        if commit_within is not None:
+            params["commitWithin"] = str(commit_within)
+
+        headers = {"Content-Type": "application/json"}
+        body = iter_ndjson(docs, self.chunk_size)
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+            body = iter_gzip(body, self.compress_level)
+
+        response = self.session.post(index_url + "/update/json/docs", \
+            params=params, headers=headers, data=body)
+        response.raise_for_status()
+        return response.json()
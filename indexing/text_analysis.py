@@ -0,0 +1,23 @@
+import re
+
+# Words are split the way the solr text_general field type does it, on
+# anything which is not a letter, a digit or an underscore
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def analyze(text):
+    """
+    Returns the lowercased tokens of a text, like the text_general
+    analyzer of the solr schema which has no stop words and no stemming
+    """
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def analyze_values(value):
+    """
+    Returns the tokens of every value of a single or multi valued field
+    as one list per value
+    """
+    if isinstance(value, (list, tuple)):
+        return [analyze(x) for x in value]
+    return [analyze(value)]
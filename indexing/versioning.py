@@ -0,0 +1,123 @@
+"""
+Helpers for keeping every version of a project in one shared collection
+
+Each document carries the version it was written for and the id it has
+within that version. A version which inherits older versions does not
+copy their documents, it is described by a small lineage document and
+searches filter on the whole lineage with a cached filter query
+"""
+
+# String dynamic fields, so they work with the default configsets
+VERSION_FIELD = "version_id_s"
+DOC_KEY_FIELD = "doc_key_s"
+INHERITS_FIELD = "inherits_ss"
+DOC_TYPE_FIELD = "doc_type_s"
+# Long dynamic field ordering the versions, the newest copy of a question
+# is the one with the largest value
+VERSION_ORDER_FIELD = "version_order_l"
+# Versions which removed an inherited copy, it is hidden from every
+# lineage containing one of them
+HIDDEN_IN_FIELD = "hidden_in_ss"
+
+LINEAGE_DOC_TYPE = "version_lineage"
+
+
+def shared_collection_name(project_id):
+    """
+    Returns the name of the collection shared by all versions of a project
+    """
+    return "qa_" + str(project_id)
+
+
+def versioned_id(version_id, doc_key):
+    """
+    Returns the id of the copy of a question in a version, its doc key
+    followed by the version. The doc key is the compositeId routing
+    prefix, so every copy of a question lands on the same shard, which
+    the collapse filter requires
+    """
+    return str(doc_key) + "!" + str(version_id)
+
+
+def split_versioned_id(doc_id):
+    """
+    Returns the doc key and the version of a versioned id
+    """
+    doc_key, _, version_id = str(doc_id).rpartition("!")
+    return doc_key, version_id
+
+
+def version_order(version_id):
+    """
+    Returns the value ordering a version, the newest version has the
+    largest one. Versions are ordered by their numeric id
+    """
+    try:
+        return int(str(version_id))
+    except ValueError:
+        raise ValueError("shared_versions needs integer version ids, got " \
+            + repr(version_id))
+
+
+def newest_visible_id(doc_id, lineage, exists):
+    """
+    Returns the id of the copy of a question which a search on a lineage
+    returns, the copy of the newest version of the lineage for which
+    exists(id) is True, or None if there is none
+    """
+    doc_key, _ = split_versioned_id(doc_id)
+    for version_id in sorted(lineage, key=version_order, reverse=True):
+        candidate = versioned_id(version_id, doc_key)
+        if exists(candidate):
+            return candidate
+    return None
+
+
+def lineage_doc_id(version_id):
+    """
+    Returns the id of the document describing which versions a version
+    inherits from
+    """
+    return "__version__" + str(version_id)
+
+
+def lineage_doc(version_id, inherited_versions):
+    """
+    Returns the document recording the versions that version_id inherits
+    """
+    return {
+        "id": lineage_doc_id(version_id),
+        DOC_TYPE_FIELD: LINEAGE_DOC_TYPE,
+        INHERITS_FIELD: [str(x) for x in inherited_versions],
+    }
+
+
+def version_filter(versions):
+    """
+    Returns a terms filter query matching documents of any of the versions
+
+    The filter only depends on the lineage, so solr answers it from its
+    filter cache for every query against the same version
+    """
+    return "{!terms f=" + VERSION_FIELD + "}" + \
+        ",".join(sorted(str(x) for x in versions))
+
+
+def hidden_filter(versions):
+    """
+    Returns a filter query dropping the copies removed by any of the
+    versions. It runs before the collapse filter, so an older copy of a
+    removed question is dropped as well rather than taking its place
+    """
+    return "-" + HIDDEN_IN_FIELD + ":(" + \
+        " OR ".join('"' + str(x) + '"' for x in sorted(versions)) + ")"
+
+
+def collapse_filter():
+    """
+    Returns a filter query keeping one document per question when it is
+    present in several versions of the lineage, the copy of the newest
+    version rather than the best scoring one
+    """
+    return "{!collapse field=" + DOC_KEY_FIELD + " max=" + \
+        VERSION_ORDER_FIELD + "}"
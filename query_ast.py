@@ -0,0 +1,314 @@
+"""
+A small query syntax tree shared by the solr search engine and the lucene
+query generator
+
+Queries are built from Term, Phrase and Group nodes, every node can be
+restricted to a field and boosted. A tree is turned into a query string
+by a serializer for the target
+
+    to_lucene(node)
+        Lucene classic query parser syntax, also used by the standard
+        solr query parser
+
+    to_solr_local_params(node, parser="lucene", **params)
+        The lucene syntax wrapped as the v parameter of solr local params
+        {!lucene q.op='OR' v='...'}
+"""
+
+# Characters with a meaning in the lucene query syntax
+LUCENE_SPECIAL_CHARACTERS = '\\+-!():^[]"{}~*?|&/'
+LUCENE_ESCAPE_TABLE = str.maketrans({
+    char: "\\" + char for char in LUCENE_SPECIAL_CHARACTERS
+})
+# Words the classic query parser reads as operators, even after a field
+LUCENE_RESERVED_WORDS = frozenset(("AND", "OR", "NOT"))
+PHRASE_ESCAPE_TABLE = str.maketrans({"\\": "\\\\", '"': '\\"'})
+LOCAL_PARAM_ESCAPE_TABLE = str.maketrans({"\\": "\\\\", "'": "\\'"})
+
+# Characters which are dropped from the user query before it is used
+QUERY_SANITIZER = str.maketrans("", "", "?()-\"'")
+
+
+class Node:
+    """
+    Base class of the query nodes
+
+    Attributes
+    ----------
+    field : String
+        The field the node is matched against, None uses the default field
+    boost : Float
+        The boost of the node, None leaves the node unboosted
+    """
+    __slots__ = ("field", "boost")
+
+    def __init__(self, field=None, boost=None):
+        self.field = field.replace(" ","_") if field else None
+        self.boost = boost
+
+    def __repr__(self):
+        values = [getattr(self, x) for x in self.__slots__]
+        return type(self).__name__ + repr((*values, self.field, self.boost))
+
+
+class Term(Node):
+    """
+    A single token
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text, field=None, boost=None):
+        Node.__init__(self, field, boost)
+        self.text = text
+
+
+class Phrase(Node):
+    """
+    A sequence of tokens which must appear together
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text, field=None, boost=None):
+        Node.__init__(self, field, boost)
+        self.text = text
+
+
+class Group(Node):
+    """
+    A disjunction of nodes, any of which may match
+    """
+    __slots__ = ("clauses",)
+
+    def __init__(self, clauses, field=None, boost=None):
+        Node.__init__(self, field, boost)
+        self.clauses = list(clauses)
+
+
+def token(text, field=None, boost=None):
+    """
+    Returns a Term for a single word and a Phrase for several words.
+    Surrounding quotes, as returned by the synonym expander, are removed
+    """
+    text = str(text).strip()
+    if len(text) > 1 and text[0] == '"' and text[-1] == '"':
+        text = text[1:-1].strip()
+    if " " in text:
+        return Phrase(text, field=field, boost=boost)
+    return Term(text, field=field, boost=boost)
+
+
+def format_boost(boost):
+    """
+    Formats a boost the way it has always been written, ie 1.05 or 0.5
+    """
+    return str(boost)
+
+
+def _write_lucene(node, out, top_level):
+    if node.field:
+        out.append(node.field)
+        out.append(":")
+
+    if isinstance(node, Term) and node.text not in LUCENE_RESERVED_WORDS:
+        out.append(node.text.translate(LUCENE_ESCAPE_TABLE))
+    elif isinstance(node, (Term, Phrase)):
+        # Reserved words are quoted, a one word phrase matches the term
+        out.append('"')
+        out.append(node.text.translate(PHRASE_ESCAPE_TABLE))
+        out.append('"')
+    else:
+        wrap = not top_level or node.field or node.boost is not None
+        if wrap:
+            out.append("(")
+        for idx, clause in enumerate(node.clauses):
+            if idx:
+                out.append(" OR ")
+            _write_lucene(clause, out, False)
+        if wrap:
+            out.append(")")
+
+    if node.boost is not None:
+        out.append("^")
+        out.append(format_boost(node.boost))
+
+
+def to_lucene(node):
+    """
+    Serializes a query tree into the lucene query syntax
+    """
+    if isinstance(node, Group) and not node.clauses:
+        return ""
+    out = []
+    _write_lucene(node, out, True)
+    return "".join(out)
+
+
+def to_solr_local_params(node, parser="lucene", **params):
+    """
+    Serializes a query tree into solr local params, with the lucene
+    syntax passed as the v parameter
+
+    For eg : Term("flu", field="question") with q_op="OR" gives
+        {!lucene q.op='OR' v='question:flu'}
+    """
+    out = ["{!", parser]
+    for key, value in params.items():
+        out.append(" ")
+        out.append(key.replace("_", "."))
+        out.append("='")
+        out.append(str(value).translate(LOCAL_PARAM_ESCAPE_TABLE))
+        out.append("'")
+    out.append(" v='")
+    out.append(to_lucene(node).translate(LOCAL_PARAM_ESCAPE_TABLE))
+    out.append("'}")
+    return "".join(out)
+
+
+def query_terms(query_string, field=None):
+    """
+    Splits a sanitized user query into one term per word
+    """
+    return [token(x, field=field) for x in query_string.split()]
+
+
+def boosting_clauses(boosting_tokens, boost_val):
+    """
+    Converts boosting tokens into boosted field clauses
+
+    The format of the boosting tokens is
+    boosting_tokens = {
+        "keywords":["love"],
+        "subject1":["care"]
+    }
+    """
+    return [
+        token(value, field=str(x), boost=boost_val) \
+        for x in boosting_tokens for value in boosting_tokens[x] \
+        if value != ""
+    ]
+
+
+def or_query(query_string, field=None, synonyms=None, \
+    synonyms_boost_val=None, boosting_tokens=None, boost_val=None):
+    """
+    Builds the OR query used by the search engine
+
+        field:word1 OR field:word2 ...
+        OR (field:synonym1 OR field:synonym2 ...)^synonyms_boost_val
+        OR boost_field:token^boost_val ...
+
+    Inputs
+    ------
+    query_string : String
+        The sanitized user query
+    field : String
+        The field the user query and synonyms are matched against, None
+        uses the default field of the parser
+    synonyms : List
+        The synonyms of the user query
+    boosting_tokens : Dictionary
+        The dictionary of tokens which must be boosted
+    """
+    clauses = query_terms(query_string, field=field)
+
+    synonym_clauses = [token(x, field=field) for x in synonyms or [] \
+        if str(x).strip('" ')]
+    if synonym_clauses:
+        clauses.append(Group(synonym_clauses, boost=synonyms_boost_val))
+
+    if boosting_tokens and boost_val:
+        clauses.extend(boosting_clauses(boosting_tokens, boost_val))
+
+    return Group(clauses)
+
+
+# Characters ending an unescaped term of a lucene query string
+_TERM_END = set(' \t\r\n():^"')
+_OPERATORS = ("OR", "AND", "||", "&&")
+
+
+def parse_lucene(query_string):
+    """
+    Parses the lucene syntax written by to_lucene back into a query tree
+
+    Fielded terms, phrases, groups and boosts are supported. Operators
+    and +/- prefixes are dropped, so every clause is optional as in the
+    OR queries built by the search engine. Always returns a Group
+    """
+    clauses, _ = _parse_clauses(query_string, 0)
+    return Group(clauses)
+
+
+def _parse_clauses(text, pos):
+    clauses = []
+    while pos < len(text):
+        char = text[pos]
+        if char.isspace():
+            pos += 1
+        elif char == ")":
+            return clauses, pos + 1
+        elif char in "+-" and pos + 1 < len(text) and \
+            not text[pos + 1].isspace():
+            pos += 1
+        else:
+            end = pos
+            while end < len(text) and not text[end].isspace():
+                end += 1
+            if text[pos:end] in _OPERATORS:
+                pos = end
+                continue
+            clause, pos = _parse_clause(text, pos)
+            if clause is not None:
+                clauses.append(clause)
+    return clauses, pos
+
+
+def _parse_clause(text, pos):
+    field = None
+    if text[pos] not in '("':
+        word, end = _read_term(text, pos)
+        if end < len(text) and text[end] == ":":
+            field, pos = word, end + 1
+        else:
+            return _parse_boost(text, end, Term(word) if word else None)
+
+    if pos >= len(text):
+        return None, pos
+    if text[pos] == "(":
+        clauses, pos = _parse_clauses(text, pos + 1)
+        node = Group(clauses, field=field)
+    elif text[pos] == '"':
+        out = []
+        pos += 1
+        while pos < len(text) and text[pos] != '"':
+            if text[pos] == "\\" and pos + 1 < len(text):
+                pos += 1
+            out.append(text[pos])
+            pos += 1
+        node = Phrase("".join(out), field=field)
+        pos += 1
+    else:
+        word, pos = _read_term(text, pos)
+        node = Term(word, field=field) if word else None
+    return _parse_boost(text, pos, node)
+
+
+def _read_term(text, pos):
+    out = []
+    while pos < len(text) and text[pos] not in _TERM_END:
+        if text[pos] == "\\" and pos + 1 < len(text):
+            pos += 1
+        out.append(text[pos])
+        pos += 1
+    return "".join(out), pos
+
+
+def _parse_boost(text, pos, node):
+    if pos < len(text) and text[pos] == "^":
+        end = pos + 1
+        while end < len(text) and (text[end].isdigit() or text[end] == "."):
+            end += 1
+        if node is not None and end > pos + 1:
+            node.boost = float(text[pos + 1:end])
+        pos = end
+    return node, pos
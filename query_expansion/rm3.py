@@ -0,0 +1,134 @@
+import threading, time
+from collections import Counter
+
+import query_ast
+from indexing.text_analysis import analyze
+
+
+class RM3Expander:
+    """
+    Expands a query with RM3 pseudo relevance feedback computed on the
+    client, from the top hits of the query and the cached document
+    frequencies of the collection
+
+    The feedback model weighs every term of a feedback document by its
+    frequency in the document times the normalised score of the document.
+    Terms present in more than max_df_ratio of the collection are left
+    out, the fb_terms best terms are normalised and interpolated with the
+    original query
+
+    Attributes
+    ----------
+    fb_docs : Integer
+        The number of top hits used as feedback
+    fb_terms : Integer
+        The number of expansion terms
+    original_query_weight : Float
+        The weight of the original query, the expansion terms share the
+        rest
+    field : String
+        The field the feedback text is read from and expansion terms are
+        matched against
+    max_df_ratio : Float
+        Terms in a larger share of the documents are not used
+    """
+
+    def __init__(self, fb_docs=10, fb_terms=20, original_query_weight=0.5, \
+        field="question", max_df_ratio=0.25):
+        self.fb_docs = fb_docs
+        self.fb_terms = fb_terms
+        self.original_query_weight = original_query_weight
+        self.field = field
+        self.max_df_ratio = max_df_ratio
+
+        self.lock = threading.Lock()
+        self.expansions = 0
+        self.feedback_seconds = 0.0
+        self.expansion_seconds = 0.0
+
+    def feedback_terms(self, feedback_docs, term_statistics):
+        """
+        Returns the expansion terms and their weights, best first
+
+        Inputs
+        ------
+        feedback_docs : List
+            (text, score) pairs of the top hits
+        term_statistics : TermStatistics
+            The document frequencies of the collection
+        """
+        feedback_docs = [(analyze(text), score) for text, score in \
+            feedback_docs[:self.fb_docs] if text]
+        total_score = sum(max(score, 0.0) for _, score in feedback_docs)
+        max_df = self.max_df_ratio * term_statistics.num_docs
+
+        weights = Counter()
+        for tokens, score in feedback_docs:
+            if not tokens:
+                continue
+            doc_weight = max(score, 0.0) / total_score if total_score \
+                else 1.0 / len(feedback_docs)
+            for term, count in Counter(tokens).items():
+                weights[term] += doc_weight * count / len(tokens)
+
+        if term_statistics.num_docs:
+            for term in list(weights):
+                if term_statistics.document_frequency(term) > max_df:
+                    del weights[term]
+
+        best = weights.most_common(self.fb_terms)
+        norm = sum(weight for _, weight in best)
+        return [(term, weight / norm) for term, weight in best if norm]
+
+    def expansion(self, feedback_docs, term_statistics):
+        """
+        Returns the expansion terms as a query_ast Group weighted by one
+        minus the original query weight, or None without expansion terms
+        """
+        started = time.perf_counter()
+        terms = self.feedback_terms(feedback_docs, term_statistics)
+        node = None
+        if terms:
+            node = query_ast.Group(\
+                [query_ast.Term(term, field=self.field, boost=round(weight, 4)) \
+                for term, weight in terms],
+                boost=round(1 - self.original_query_weight, 4))
+        with self.lock:
+            self.expansions += 1
+            self.expansion_seconds += time.perf_counter() - started
+        return node
+
+    def expand(self, query, expansion):
+        """
+        Adds an expansion to a query built by build_query. Lucene query
+        strings are wrapped with the original query weight, edismax
+        parameters get the expansion as an extra bq
+        """
+        if expansion is None:
+            return query
+        if isinstance(query, dict):
+            query = dict(query)
+            bq = query.get("bq", [])
+            query["bq"] = (bq if isinstance(bq, list) else [bq]) + \
+                [query_ast.to_lucene(expansion)]
+            return query
+        return "(" + query + ")^" + str(self.original_query_weight) + \
+            " OR " + query_ast.to_lucene(expansion)
+
+    def record_feedback(self, seconds):
+        with self.lock:
+            self.feedback_seconds += seconds
+
+    def stats(self):
+        """
+        Returns the number of expansions and their mean cost in
+        milliseconds, split between fetching the feedback hits and
+        computing the expansion
+        """
+        with self.lock:
+            count = max(self.expansions, 1)
+            return {
+                "expansions": self.expansions,
+                "feedback_ms": 1000 * self.feedback_seconds / count,
+                "expansion_ms": 1000 * self.expansion_seconds / count,
+            }
@@ -0,0 +1,114 @@
+import os, json, threading
+
+
+class TermStatistics:
+    """
+    The document frequencies of the terms of one collection, kept up to
+    date as documents are indexed and deleted
+
+    The terms of every document are remembered so that a replaced or
+    deleted document can be subtracted again
+
+    Attributes
+    ----------
+    df : Dictionary
+        Maps a term to the number of documents containing it
+    doc_terms : Dictionary
+        Maps a document id to its distinct terms
+    """
+
+    def __init__(self, df=None, doc_terms=None):
+        self.df = df or {}
+        self.doc_terms = doc_terms or {}
+        self.lock = threading.Lock()
+
+    @property
+    def num_docs(self):
+        return len(self.doc_terms)
+
+    def add(self, doc_id, tokens):
+        """
+        Counts the terms of a document, replacing its previous terms
+        """
+        terms = sorted(set(tokens))
+        with self.lock:
+            self._remove(str(doc_id))
+            self.doc_terms[str(doc_id)] = terms
+            for term in terms:
+                self.df[term] = self.df.get(term, 0) + 1
+
+    def remove(self, doc_ids):
+        with self.lock:
+            for doc_id in doc_ids:
+                self._remove(str(doc_id))
+
+    def _remove(self, doc_id):
+        for term in self.doc_terms.pop(doc_id, []):
+            self.df[term] -= 1
+            if not self.df[term]:
+                del self.df[term]
+
+    def document_frequency(self, term):
+        return self.df.get(term, 0)
+
+    def save(self, path):
+        """
+        Writes the statistics to a json file, replaced atomically
+        """
+        with self.lock:
+            data = json.dumps({"doc_terms": self.doc_terms})
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_doc_terms(json.load(f)["doc_terms"])
+
+    @classmethod
+    def from_doc_terms(cls, doc_terms):
+        """
+        Returns the statistics of documents given by their distinct terms
+        """
+        df = {}
+        for terms in doc_terms.values():
+            for term in terms:
+                df[term] = df.get(term, 0) + 1
+        return cls(df, doc_terms)
+
+
+class TermStatisticsStore:
+    """
+    Holds the term statistics of every collection, each loaded from its
+    snapshot on first use
+
+    Attributes
+    ----------
+    snapshot_dir : String
+        The directory holding one <collection>.json file per collection
+    """
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.statistics = {}
+        self.lock = threading.Lock()
+
+    def snapshot_path(self, collection):
+        return os.path.join(self.snapshot_dir, collection + ".json")
+
+    def exists(self, collection):
+        return collection in self.statistics or \
+            os.path.exists(self.snapshot_path(collection))
+
+    def get(self, collection):
+        with self.lock:
+            if collection not in self.statistics:
+                path = self.snapshot_path(collection)
+                self.statistics[collection] = TermStatistics.load(path) \
+                    if os.path.exists(path) else TermStatistics()
+            return self.statistics[collection]
+
+    def save(self, collection):
+        self.get(collection).save(self.snapshot_path(collection))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import sys, os, lucene
+import sys, os, lucene, threading
+from collections import OrderedDict
 
 from java.nio.file import Paths
 from org.apache.lucene.analysis.standard import StandardAnalyzer
@@ -10,6 +11,37 @@ from org.apache.lucene.store import SimpleFSDirectory
 from org.apache.lucene.search import IndexSearcher
 
 from synonym_expansion.synonym_expander import SynonymExpander
+from query_ast import QUERY_SANITIZER
+import query_ast
+
+
+class LRUCache:
+    """
+    A small thread safe least recently used cache with a bounded size
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
 
 class QueryGenerator:
     """
@@ -40,10 +72,14 @@ class QueryGenerator:
         Having the exact search terms is not a strict necessity
 
         This method generates a OR query for the given boosting tokens
+
+    get_boost_string(boosting_tokens, boost_val)
+        Returns the boosting fragment of an OR query. The fragment is
+        compiled once per distinct set of boosting tokens
     """
 
     def __init__(self, analyzer, synonyms_boost_val=0.5,\
-        synonym_config=None, debug=False):
+        synonym_config=None, debug=False, query_cache_size=1024):
         """ 
         Take a standard analyzer for query generation 
         
@@ -70,12 +106,20 @@ class QueryGenerator:
                 synlist_path 
                     This string is the path to the synlist to be used if 
                     use_synlist is set to true
+        query_cache_size : Integer
+            The number of parsed queries and boosting fragments that are
+            kept in memory
         """
         self.analyzer = analyzer
         self.synonyms_boost_val = None
         self.synonym_config = synonym_config
         self.debug = debug
 
+        self.query_cache = LRUCache(query_cache_size)
+        self.boost_string_cache = LRUCache(query_cache_size)
+        # Jvm attachment and query parsers are per worker thread
+        self.thread_state = threading.local()
+
         if synonym_config:
             use_wordnet, use_synlist, synlist_path = synonym_config
             self.synonym_expander = SynonymExpander(\
@@ -114,34 +158,75 @@ class QueryGenerator:
 
         # TODO : sanitize query string sp that false queries dont break
         # the system. Prevent sql njection type attacks
-        synonyms = None
-        query_string = query_string.replace("?","").replace("(","")\
-                .replace(")","").replace("-","").replace("\"","").replace("'","")
-        
-        if query_type == "OR_QUERY":
-            # TODO : add ability to have a per field unique boost value
-            if self.debug:
-                query_string, synonyms = \
-                    self.get_or_query_string(query_string, \
-                    boosting_tokens, boost_val=boost_val)
-            else:
-                query_string = \
-                    self.get_or_query_string(query_string, \
-                    boosting_tokens, boost_val=boost_val)
-
+        query_string = query_string.translate(QUERY_SANITIZER)
         field = field.replace(" ","_")
-        vm_env = lucene.getVMEnv()
-        vm_env.attachCurrentThread()
-        query = QueryParser(field, self.analyzer).parse(query_string)
+
+        cache_key = (query_string, self.get_boosting_key(boosting_tokens), \
+            query_type, field, boost_val)
+        cached = self.query_cache.get(cache_key)
+        if cached is None:
+            synonyms = None
+            if query_type == "OR_QUERY":
+                # TODO : add ability to have a per field unique boost value
+                if self.debug:
+                    query_string, synonyms = \
+                        self.get_or_query_string(query_string, \
+                        boosting_tokens, boost_val=boost_val)
+                else:
+                    query_string = \
+                        self.get_or_query_string(query_string, \
+                        boosting_tokens, boost_val=boost_val)
+
+            query = self.get_query_parser(field).parse(query_string)
+            cached = (query, synonyms)
+            self.query_cache.put(cache_key, cached)
 
         if self.debug:
-            return query, synonyms
-        return query
+            return cached
+        return cached[0]
+
+    def get_query_parser(self, field):
+        """
+        Returns a query parser for the field which belongs to the calling
+        thread. The thread is attached to the jvm the first time it asks
+        for a parser, as QueryParser instances are not thread safe
+        """
+        state = self.thread_state
+        if not getattr(state, "attached", False):
+            lucene.getVMEnv().attachCurrentThread()
+            state.attached = True
+            state.parsers = {}
+
+        if field not in state.parsers:
+            state.parsers[field] = QueryParser(field, self.analyzer)
+        return state.parsers[field]
+
+    def get_boosting_key(self, boosting_tokens):
+        """
+        Returns a hashable key describing the boosting tokens
+        """
+        return tuple((x, tuple(boosting_tokens[x])) for x in boosting_tokens)
+
+    def get_boost_string(self, boosting_tokens, boost_val):
+        """
+        Returns the " OR field:token^boost_val" fragment of the boosting
+        tokens, compiled once per distinct set of boosting tokens
+        """
+        cache_key = (self.get_boosting_key(boosting_tokens), boost_val)
+        boost_string = self.boost_string_cache.get(cache_key)
+        if boost_string is None:
+            # TODO : Boost a token according to a per field value
+            boost_string = "".join([" OR " + query_ast.to_lucene(clause) \
+                for clause in query_ast.boosting_clauses(\
+                    boosting_tokens, boost_val)])
+            self.boost_string_cache.put(cache_key, boost_string)
+        return boost_string
 
     def get_or_query_string(self, query_string, boosting_tokens, boost_val):
         """
         Converts the user query string and boosting tokens into a long 
-        OR query
+        OR query, built as a query_ast tree so that every token is
+        escaped the same way
         
         The format of the boosting tokens is
         boosting_tokens = {
@@ -161,30 +246,25 @@ class QueryGenerator:
             The amount of boosting that must be added per boosting token
         """
 
+        synonyms = []
+        #TODO : Check Better methods of generating queries
+        if self.synonym_config:
+            synonyms = self.synonym_expander.return_synonyms(query_string)
+
+        query = query_ast.or_query(query_string, synonyms=synonyms, \
+            synonyms_boost_val=self.synonyms_boost_val)
+        query_string = query_ast.to_lucene(query)
+
         if boost_val:
-            # TODO : Boost a token according to a per field value
-            boost_string = ""
-            for x in boosting_tokens:
-                for token in boosting_tokens[x]:
-                    if token == "":
-                        continue
-                    boost_string = boost_string + " OR " + \
-                    str(x).replace(" ","_") + ":" + str(token) + "^" + \
-                        str(boost_val)
-
-            #TODO : Check Better methods of generating queries
-            if self.synonym_config:
-                synonyms = self.synonym_expander.return_synonyms(query_string)
-                if len(synonyms) > 0:
-                    query_string = query_string + \
-                        " OR (" + " ".join(synonyms) + ")^" + \
-                        str(self.synonyms_boost_val)
-            
-                if self.debug:
-                    return (query_string + boost_string).replace('/','\/'), synonyms
+            boost_string = self.get_boost_string(boosting_tokens, boost_val)
+            if not query_string:
+                boost_string = boost_string[len(" OR "):]
+            query_string += boost_string
+
+        if self.debug:
+            return query_string, synonyms
+        return query_string
 
-            return (query_string + boost_string).replace('/','\/')
-            
 
 if __name__ == '__main__':
     lucene.initVM(vmargs=['-Djava.awt.headless=true'])
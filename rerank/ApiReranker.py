@@ -1,5 +1,6 @@
 import requests
 import json, os, pdb
+from collections import defaultdict, deque
 from typing import List, Mapping, Tuple, Union, Iterable, Optional, Any
 # Importing constants
 from dotenv import load_dotenv
@@ -35,6 +36,33 @@ class ApiReranker():
         except:
             return False
 
+    def rerank_ids(self, qry: str, txts: List[List[str]]) -> List[Any]:
+        """
+        Reranks [id, text] pairs and returns [score, id] pairs, best first
+
+        The reranking api answers with [score, text] pairs. Ids are
+        matched back in the order they were sent, so documents sharing
+        the same text each keep their own id. If the api echoes the id
+        as a third element it is used directly
+
+        Returns False if the reranker is rate limited or unavailable
+        """
+        scoreDocs = self.rerank(qry, txts)
+        if not scoreDocs:
+            return False
+
+        ids_by_text = defaultdict(deque)
+        for doc_id, text in txts:
+            ids_by_text[text].append(doc_id)
+
+        ranked = []
+        for scoreDoc in scoreDocs:
+            if len(scoreDoc) > 2:
+                ranked.append([scoreDoc[0], scoreDoc[2]])
+            elif ids_by_text[scoreDoc[1]]:
+                ranked.append([scoreDoc[0], ids_by_text[scoreDoc[1]].popleft()])
+        return ranked
+
 
 if __name__ == '__main__':    
     from rerank_config import RE_RANK_ENDPOINT
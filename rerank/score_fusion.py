@@ -0,0 +1,76 @@
+"""
+Fusion of the rankings produced by reranking several fields of the same
+documents
+
+Every ranking is a list of [score, id] pairs, best first, as returned by
+ApiReranker.rerank_ids. The fused ranking has the same format
+"""
+
+FUSION_METHODS = ("max", "weighted", "rrf")
+
+
+def fuse_max(rankings, weights=None):
+    """
+    Scores a document by its best score over all fields
+    """
+    fused = {}
+    for ranking in rankings.values():
+        for score, doc_id in ranking:
+            if doc_id not in fused or score > fused[doc_id]:
+                fused[doc_id] = score
+    return fused
+
+
+def fuse_weighted(rankings, weights=None):
+    """
+    Scores a document by the weighted sum of its scores, fields without a
+    weight count once
+    """
+    weights = weights or {}
+    fused = {}
+    for field, ranking in rankings.items():
+        weight = weights.get(field, 1.0)
+        for score, doc_id in ranking:
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+    return fused
+
+
+def fuse_reciprocal_rank(rankings, weights=None, k=60):
+    """
+    Scores a document by the sum of 1 / (k + rank) over all fields, which
+    ignores the scale of the scores of each field
+    """
+    weights = weights or {}
+    fused = {}
+    for field, ranking in rankings.items():
+        weight = weights.get(field, 1.0)
+        for rank, (_, doc_id) in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (k + rank + 1)
+    return fused
+
+
+def fuse_rankings(rankings, method="max", weights=None):
+    """
+    Fuses the rankings of several fields into one ranking
+
+    Inputs
+    ------
+    rankings : Dictionary
+        Maps a field name to its ranking, a list of [score, id] pairs
+    method : String
+        One of "max", "weighted" or "rrf" (reciprocal rank fusion)
+    weights : Dictionary
+        Maps a field name to its weight, used by "weighted" and "rrf"
+    """
+    if method == "max":
+        fused = fuse_max(rankings, weights)
+    elif method == "weighted":
+        fused = fuse_weighted(rankings, weights)
+    elif method == "rrf":
+        fused = fuse_reciprocal_rank(rankings, weights)
+    else:
+        raise ValueError("unknown fusion method " + str(method) + \
+            ", expected one of " + str(FUSION_METHODS))
+
+    return sorted([[score, doc_id] for doc_id, score in fused.items()], \
+        key=lambda x: x[0], reverse=True)
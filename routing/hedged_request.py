@@ -0,0 +1,138 @@
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class HedgedRequester:
+    """
+    Sends a request to a second replica when the first one is slow, and
+    returns whichever answer arrives first
+
+    The delay after which a request is hedged is a percentile of the
+    latencies observed recently, so only the slowest requests are sent
+    twice. A budget caps the fraction of requests which may be hedged so
+    that a slow cluster does not receive twice the load
+
+    Attributes
+    ----------
+    percentile : Float
+        The latency percentile after which a request is hedged
+    budget : Float
+        The maximum fraction of recent requests which may be hedged
+    """
+
+    def __init__(self, percentile=95, budget=0.05, initial_delay=0.1, \
+        min_delay=0.005, window=1000, max_workers=32):
+        """
+        Inputs
+        ------
+        percentile : Float
+            The latency percentile after which a request is hedged
+        budget : Float
+            The maximum fraction of recent requests which may be hedged
+        initial_delay : Float
+            Seconds to wait before hedging until enough latencies have
+            been observed
+        min_delay : Float
+            The smallest hedging delay in seconds
+        window : Integer
+            The number of recent requests used for the latency percentile
+            and the budget
+        max_workers : Integer
+            The number of requests which can be in flight at once
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+
+        self.latencies = deque(maxlen=window)
+        self.hedged = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def hedge_delay(self):
+        """
+        Returns the number of seconds to wait before hedging a request
+        """
+        with self.lock:
+            if len(self.latencies) < 20:
+                return self.initial_delay
+            ordered = sorted(self.latencies)
+        idx = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[idx])
+
+    def allow_hedge(self):
+        """
+        Returns True if hedging one more request stays within the budget
+        """
+        with self.lock:
+            if not self.hedged:
+                return True
+            return (sum(self.hedged) + 1) / len(self.hedged) <= self.budget
+
+    def record_latency(self, future, started):
+        if not future.cancelled() and future.exception() is None:
+            with self.lock:
+                self.latencies.append(time.time() - started)
+
+    def stats(self):
+        """
+        Returns the current hedging delay and the fraction of recent
+        requests which were hedged
+        """
+        delay = self.hedge_delay()
+        with self.lock:
+            rate = sum(self.hedged) / len(self.hedged) if self.hedged else 0
+        return {"hedge_delay": delay, "hedge_rate": rate}
+
+    def close(self, wait=True):
+        """
+        Shuts down the threads sending the requests, waiting for the
+        requests in flight unless wait is False
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def request(self, call, primary, secondary):
+        """
+        Calls call(primary), and call(secondary) as well if the first call
+        has not answered after the hedging delay
+
+        Inputs
+        ------
+        call : Function
+            Performs the request against the target it is given
+        primary, secondary : Any
+            The targets of the request, eg urls of two replicas
+
+        Returns the result of the first call which succeeds. The slower
+        call is cancelled if it has not started, otherwise its result is
+        discarded. If both calls fail, the first error is raised
+        """
+        started = time.time()
+        futures = [self.executor.submit(call, primary)]
+        # The delay is a percentile of the primary latencies, also when the
+        # hedge wins, else it would only ever shrink
+        futures[0].add_done_callback(lambda future: \
+            self.record_latency(future, started))
+        done, _ = wait(futures, timeout=self.hedge_delay())
+
+        hedged = False
+        if not done and self.allow_hedge():
+            futures.append(self.executor.submit(call, secondary))
+            hedged = True
+
+        with self.lock:
+            self.hedged.append(hedged)
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+                error = error or future.exception()
+        raise error
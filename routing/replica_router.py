@@ -0,0 +1,137 @@
+import threading, time, itertools
+from urllib.parse import urlparse
+
+
+class ReplicaRouter:
+    """
+    Spreads search requests over the live nodes of a solr cloud
+
+    The live nodes are discovered from the cluster state and refreshed
+    every refresh_interval seconds. Requests are sent to them round robin,
+    falling back to the configured solr url if no node is known
+
+    Attributes
+    ----------
+    solr_url : String
+        Url pointing to a solr server, used to read the cluster state
+
+    shards_preference : String
+        Value of the shards.preference parameter sent with every search,
+        eg "replica.location:local,replica.type:PULL"
+    """
+
+    def __init__(self, solr_url, session, shards_preference=None, \
+        refresh_interval=30):
+        """
+        Inputs
+        ------
+        solr_url : String
+            Url pointing to a solr server
+        session : requests.Session
+            The session used to read the cluster state
+        shards_preference : String
+            Value of the shards.preference parameter, None to let solr
+            pick replicas
+        refresh_interval : Integer
+            Seconds after which the live nodes are read again
+        """
+        self.solr_url = solr_url
+        self.session = session
+        self.shards_preference = shards_preference
+        self.refresh_interval = refresh_interval
+        self.scheme = urlparse(solr_url).scheme or "http"
+
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.node_urls = []
+        self.node_cycle = None
+        self.refreshed_at = 0
+
+    def node_url(self, node_name):
+        """
+        Converts a live node name, eg 10.0.0.1:8983_solr, to the base url
+        of its solr server, eg http://10.0.0.1:8983
+        """
+        host, _, context = node_name.partition("_")
+        url = self.scheme + "://" + host
+        # The context of the node is appended to urls as /solr already
+        if context and context != "solr":
+            url += "/" + context.replace("%2F", "/")
+        return url
+
+    def refresh(self):
+        """
+        Reads the live nodes from the cluster state
+        """
+        try:
+            status = self.session.get(
+                self.solr_url + "/solr/admin/collections",
+                params={"action": "CLUSTERSTATUS", "wt": "json"},
+                timeout=5).json()
+            live_nodes = sorted(status['cluster']['live_nodes'])
+        except Exception as e:
+            print("could not read live nodes :", repr(e))
+            live_nodes = []
+
+        with self.lock:
+            self.node_urls = [self.node_url(x) for x in live_nodes]
+            self.node_cycle = itertools.cycle(self.node_urls) \
+                if self.node_urls else None
+            self.refreshed_at = time.time()
+
+    def refresh_if_stale(self):
+        """
+        Refreshes the live nodes once they are older than refresh_interval.
+        Only one caller reads the cluster state, the others keep using the
+        nodes already known, or wait for the first refresh
+        """
+        if time.time() - self.refreshed_at <= self.refresh_interval:
+            return
+        blocking = self.refreshed_at == 0
+        if not self.refresh_lock.acquire(blocking=blocking):
+            return
+        try:
+            if time.time() - self.refreshed_at > self.refresh_interval:
+                self.refresh()
+        finally:
+            self.refresh_lock.release()
+
+    def next_url(self):
+        """
+        Returns the base url of the next node a request must be sent to
+        """
+        self.refresh_if_stale()
+        with self.lock:
+            if self.node_cycle is None:
+                return self.solr_url
+            return next(self.node_cycle)
+
+    def other_url(self, url):
+        """
+        Returns the base url of the next live node which is not the one
+        url points to, None if no other node is known
+        """
+        self.refresh_if_stale()
+        with self.lock:
+            for _ in range(len(self.node_urls)):
+                candidate = next(self.node_cycle)
+                if url != candidate and not url.startswith(candidate + "/"):
+                    return candidate
+        return None
+
+    def search_params(self, route_keys=None):
+        """
+        Returns the routing parameters of a search
+
+        Inputs
+        ------
+        route_keys : List
+            compositeId prefixes, eg ["3!"], restricting the search to the
+            shards holding them
+        """
+        params = {}
+        if self.shards_preference:
+            params["shards.preference"] = self.shards_preference
+        if route_keys:
+            params["_route_"] = ",".join(route_keys)
+        return params
@@ -0,0 +1,74 @@
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls made with the same key
+
+    The first caller of a key executes the function, callers arriving
+    while it runs wait for it and share its result, or its exception.
+    Nothing is cached once the call has finished
+
+    Attributes
+    ----------
+    executed : Integer
+        The number of calls which were actually executed
+    coalesced : Integer
+        The number of calls which shared the result of another call
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """
+        Returns fn(), executed at most once at a time per key
+
+        Inputs
+        ------
+        key : Hashable
+            Calls with equal keys are coalesced
+        fn : Function
+            The function computing the result, called without arguments
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
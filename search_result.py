@@ -0,0 +1,48 @@
+class SearchResult:
+    """
+    A search hit and its final score
+
+    Results used to be passed around as [document, score] lists, so a
+    SearchResult can still be indexed and unpacked the same way
+
+        document, score = result
+        result[0], result[1]
+
+    Attributes
+    ----------
+    doc : Dictionary
+        The solr document of the hit
+    score : Float
+        The reranker score, or the solr score if no reranker was used
+    """
+    __slots__ = ("doc", "score")
+
+    def __init__(self, doc, score):
+        self.doc = doc
+        self.score = score
+
+    @property
+    def id(self):
+        return self.doc['id']
+
+    def __getitem__(self, idx):
+        return (self.doc, self.score)[idx]
+
+    def __iter__(self):
+        yield self.doc
+        yield self.score
+
+    def __len__(self):
+        return 2
+
+    def __repr__(self):
+        return "SearchResult(" + repr(self.doc.get('id')) + ", " + \
+            repr(self.score) + ")"
+
+    def to_json(self):
+        """
+        Returns the document with its final score, ready to be serialized
+        """
+        doc = dict(self.doc)
+        doc['score'] = self.score
+        return doc
@@ -1,11 +1,34 @@
-import sys, os, json, requests, hashlib
+import sys, os, json, requests, hashlib, threading, time
 import pysolr
 import pdb
 
 from rerank.ApiReranker import ApiReranker
 from rerank.rerank_config import RE_RANK_ENDPOINT
 from variation_generation.variation_generator import VariationGenerator
+from variation_generation.variation_enricher import VariationEnricher
 from synonym_expansion.synonym_expander import SynonymExpander
+from indexing.delta import CONTENT_HASH_FIELD, content_hash, DeltaTracker
+from indexing.near_duplicates import CLUSTER_FIELD, DEDUPE_MODES, \
+    NearDuplicateDetector
+from indexing.json_stream_loader import iter_json_folder
+from indexing.solr_update_stream import SolrUpdateStream
+from indexing import versioning
+from routing.replica_router import ReplicaRouter
+from routing.hedged_request import HedgedRequester
+from routing.singleflight import SingleFlight
+import query_ast
+from search_result import SearchResult
+from embedded.embedded_store import EmbeddedStore
+from embedded.bm25_index import solr_document
+from query_expansion.rm3 import RM3Expander
+from query_expansion.term_statistics import TermStatisticsStore
+from indexing.text_analysis import analyze
+from dense_retrieval.hashing_encoder import HashingEncoder
+from dense_retrieval.embedding_index import EmbeddingStore
+from autocomplete.suggestion_index import SuggestionStore
+from spelling.symspell import SpellingStore, read_synlist
+from rerank.score_fusion import fuse_rankings
+from concurrent.futures import ThreadPoolExecutor
 
 # Importing constants
 from dotenv import load_dotenv
@@ -42,12 +65,25 @@ class SolrSearchEngine:
 
     get_json_to_add(question_pair):
 
-    
+    variation_enrichment_status():
+        Returns the progress and backlog of background variation
+        generation when async_variations is used
+
+    rm3_expansion_status():
+        Returns the number and mean cost of client side RM3 expansions
+
+    suggest(prefix, project_id, version_id, top_k=None):
+        Returns typeahead suggestions built from the indexed questions
+
     search(query, top_n=50):
         The main function used for searching an index. Intentionally kept
         to the bare minimum for latency reasons
 
         Returns the top n results according to the scoring function
+
+    close():
+        Stops the background threads and closes the http session, also
+        done when the engine is used as a context manager
     """
 
     def __init__(self,\
@@ -56,6 +92,28 @@ class SolrSearchEngine:
         debug=False,\
         use_markdown=False,\
         use_rm3=False,\
+        async_variations=False,\
+        edismax_param_set="qa_edismax",\
+        shared_versions=False,\
+        lineage_ttl=30,\
+        index_batch_size=500,\
+        update_stream_config=[False, True],\
+        configset_path=os.path.join(os.path.dirname(\
+            os.path.abspath(__file__)), "configs", "myconfigset.zip"),\
+        collection_ready_timeout=60,\
+        collection_config={},\
+        routing_config=[False, None, 30],\
+        hedging_config=[False, 95, 0.05],\
+        lean_results=False,\
+        rerank_fields_config=[["question"], "max", None],\
+        coalesce_searches=False,\
+        embedded_config=[[], "./embedded_indexes"],\
+        client_rm3_config=[False, 10, 20, 0.5, "question", "./term_statistics"],\
+        dense_config=[False, None, "./dense_indexes", 50],\
+        autocomplete_config=[False, "./suggestions", 10],\
+        dedupe_config=[None, 0.8],\
+        spelling_config=[False, ["question", "answer"], 2, 1000000, \
+            "./spelling_vocabularies"],\
         variation_generator_config=[False, None, [None]],\
         synonyms_boost_val=0.5,\
         synonym_config=[
@@ -77,6 +135,57 @@ class SolrSearchEngine:
         rerank : Bool
             A Flag for wether a simple ML reranker must be used as part
             of the pipeline
+        async_variations : Bool
+            If true, questions are written to solr with only their
+            original fields and variations are generated by a background
+            queue which applies them with atomic updates
+        edismax_param_set : String
+            The name of the solr param set holding the static part of
+            EDISMAX_QUERY requests. It is created once per collection
+        shared_versions : Bool
+            If true, all versions of a project share one collection.
+            Documents are tagged with their version, inheriting previous
+            versions only records a lineage and searches filter on it.
+            Inherited questions left out of a delta index are hidden from
+            the indexed version instead of being deleted
+        lineage_ttl : Float
+            Seconds after which the lineage of a version is read again
+            from solr, so that versions inherited by other processes are
+            picked up
+        embedded_config : List
+            The projects served by the in process BM25 backend instead of
+            solr, and the directory holding the snapshots of their
+            indexes. Each version of such a project has its own index
+        client_rm3_config : List
+            Whether queries are expanded with RM3 computed on the client,
+            the number of feedback hits, the number of expansion terms,
+            the weight of the original query, the field feedback terms
+            are read from and matched against, and the directory holding
+            the document frequencies cached per collection. Unlike
+            use_rm3 this runs on a stock solr
+        dense_config : List
+            Whether a dense first stage is used, the encoder (an object
+            with dim and encode(texts), a HashingEncoder if None), the
+            directory of the embedding matrices and the number of dense
+            candidates. Questions and their variations are embedded at
+            index time, dense candidates are fused with the lexical ones
+            by reciprocal rank before reranking
+        autocomplete_config : List
+            Whether typeahead suggestions are built from the question
+            and question_variation_N fields at index time, the directory
+            of their snapshots and the default number of suggestions
+        dedupe_config : List
+            How near duplicate questions of an index call are handled,
+            None, "merge" to index only the first question of a cluster
+            or "tag" to store the cluster in CLUSTER_FIELD and keep one
+            hit per cluster at search time, and the similarity above
+            which questions are near duplicates
+        spelling_config : List
+            Whether misspelled query words are corrected in build_query,
+            the fields whose words make up the vocabulary of a collection,
+            the largest number of edits corrected, the largest number of
+            entries of a deletion dictionary and the directory of the
+            vocabularies. The words of the synlist are always known
         """
         self.solr_server_link = solr_url
         self.rerank_endpoint = rerank_endpoint
@@ -104,7 +213,122 @@ class SolrSearchEngine:
         self.use_rm3 = use_rm3
         self.session = requests.Session()
 
+        self.edismax_param_set = edismax_param_set
+        self.collections_with_param_set = set()
+
+        self.shared_versions = shared_versions
+        self.lineage_ttl = lineage_ttl
+        self.index_batch_size = index_batch_size
+
+        self.configset_path = configset_path
+        self.configset_name = None
+        self.collection_ready_timeout = collection_ready_timeout
+        self.known_collections = set()
+        self.collection_lock = threading.Lock()
+        self.collection_locks = {}
+        self.collection_config = collection_config
+
+        use_replica_routing, shards_preference, refresh_interval = \
+            routing_config
+        self.replica_router = None
+        if use_replica_routing:
+            self.replica_router = ReplicaRouter(self.solr_server_link, \
+                self.session, shards_preference=shards_preference, \
+                refresh_interval=refresh_interval)
+
+        self.lean_results = lean_results
+        self.singleflight = SingleFlight() if coalesce_searches else None
+
+        embedded_projects, embedded_snapshot_dir = embedded_config
+        self.embedded_projects = set(str(x) for x in embedded_projects)
+        self.embedded_store = EmbeddedStore(embedded_snapshot_dir) \
+            if self.embedded_projects else None
+
+        use_client_rm3, fb_docs, fb_terms, original_query_weight, \
+            rm3_field, term_statistics_dir = client_rm3_config
+        self.rm3_expander = None
+        self.term_statistics = None
+        self.term_statistics_lock = threading.Lock()
+        if use_client_rm3:
+            self.rm3_expander = RM3Expander(fb_docs=fb_docs, \
+                fb_terms=fb_terms, \
+                original_query_weight=original_query_weight, \
+                field=rm3_field)
+            self.term_statistics = TermStatisticsStore(term_statistics_dir)
+
+        use_dense, dense_encoder, dense_dir, self.dense_top_k = dense_config
+        self.dense_encoder = None
+        self.embedding_store = None
+        if use_dense:
+            self.dense_encoder = dense_encoder or HashingEncoder()
+            self.embedding_store = EmbeddingStore(dense_dir, \
+                self.dense_encoder.dim)
+
+        use_autocomplete, suggestion_dir, self.suggestion_top_k = \
+            autocomplete_config
+        self.suggestion_store = SuggestionStore(suggestion_dir) \
+            if use_autocomplete else None
+
+        use_spelling, self.spelling_fields, max_edit_distance, \
+            max_spelling_entries, spelling_dir = spelling_config
+        self.spelling_store = None
+        if use_spelling:
+            synlist_words = set()
+            if synonym_config and synonym_config[1]:
+                synlist_words = read_synlist(synonym_config[2])
+            self.spelling_store = SpellingStore(spelling_dir, \
+                dictionary_words=synlist_words, \
+                max_edit_distance=max_edit_distance, \
+                max_entries=max_spelling_entries)
+
+        self.dedupe_mode, self.dedupe_threshold = dedupe_config
+        if self.dedupe_mode not in (None,) + DEDUPE_MODES:
+            raise ValueError("unknown dedupe mode " + str(self.dedupe_mode) \
+                + ", expected one of " + str(DEDUPE_MODES))
+
+        self.rerank_fields, self.fusion_method, self.fusion_weights = \
+            rerank_fields_config
+        self.rerank_executor = None
+        if len(self.rerank_fields) > 1:
+            self.rerank_executor = ThreadPoolExecutor(\
+                max_workers=4 * len(self.rerank_fields))
+
+        use_hedging, hedge_percentile, hedge_budget = hedging_config
+        self.hedged_requester = None
+        if use_hedging:
+            self.hedged_requester = HedgedRequester(\
+                percentile=hedge_percentile, budget=hedge_budget)
+
+        use_update_stream, compress_updates = update_stream_config
+        self.update_stream = None
+        if use_update_stream:
+            self.update_stream = SolrUpdateStream(\
+                session=self.session, compress=compress_updates)
+        self.version_lineage = {}
+
+        self.variation_enricher = None
+        if async_variations and self.variation_generator:
+            self.variation_enricher = VariationEnricher(\
+                self.variation_generator)
+
     def index_prev_versions(self, project_id, version_id, previous_versions):
+        if self.is_embedded(project_id):
+            docs_to_add = []
+            for prev_version in previous_versions:
+                collection = self.get_embedded_collection_name(\
+                    project_id, prev_version)
+                if self.embedded_store.exists(collection):
+                    docs_to_add.extend(dict(x) for x in \
+                        self.embedded_store.get(collection).documents())
+            print("Adding ", len(docs_to_add), "documents from old versions to new index")
+            self.index(project_id, version_id, docs_to_add)
+            return
+
+        if self.shared_versions:
+            self.inherit_prev_versions(project_id, version_id, \
+                previous_versions)
+            return
+
         # iterate over previous collections and add
         link = self.solr_server_link + "/solr/admin/collections"
         print(link, "is the prev link")
@@ -132,13 +356,55 @@ class SolrSearchEngine:
         for x in docs_to_add:
             x.pop('_version_')
             for key in x:
-                x[key]=x[key][0]
+                if isinstance(x[key], list):
+                    x[key]=x[key][0]
 
         print("Adding ", len(docs_to_add), "documents from old versions to new index")
         self.index(project_id,version_id,docs_to_add)
 
-    
-    def index(self, project_id, version_id, question_list):
+    def inherit_prev_versions(self, project_id, version_id, previous_versions):
+        """
+        With shared_versions, makes version_id inherit the documents of
+        previous_versions by writing its lineage document. No document
+        is copied, the lineage of every previous version is included
+        """
+        collection = self.ensure_collection_exists(project_id, version_id)
+        if not collection:
+            return
+        inherited = set()
+        for prev_version in previous_versions:
+            inherited.update(self.get_version_lineage(collection, prev_version))
+        inherited.discard(str(version_id))
+
+        client = pysolr.Solr(self.solr_server_link + "/solr/" + collection, \
+            always_commit=True)
+        client.add([versioning.lineage_doc(version_id, sorted(inherited))])
+        self.version_lineage[(collection, str(version_id))] = \
+            (frozenset(inherited) | {str(version_id)}, time.time())
+        print("version", version_id, "of", collection, "inherits", \
+            sorted(inherited))
+
+    def get_version_lineage(self, collection, version_id):
+        """
+        Returns the frozenset of versions whose documents are visible from
+        version_id, including version_id itself. It is read with a real
+        time get once the cached one is older than lineage_ttl
+        """
+        key = (collection, str(version_id))
+        cached = self.version_lineage.get(key)
+        if cached and time.time() - cached[1] <= self.lineage_ttl:
+            return cached[0]
+        response = self.session.get(
+            self.solr_server_link + "/solr/" + collection + "/get",
+            params={"id": versioning.lineage_doc_id(version_id), \
+                "wt": "json"})
+        doc = response.json().get("doc") or {}
+        lineage = frozenset(doc.get(versioning.INHERITS_FIELD, [])) | \
+            {str(version_id)}
+        self.version_lineage[key] = (lineage, time.time())
+        return lineage
+
+    def index(self, project_id, version_id, question_list, delta=False):
         """
         This function adds QA pairs to the search index after generating 
         variations
@@ -150,30 +416,763 @@ class SolrSearchEngine:
         
         version_id : String
             A string which states to the version being used
+
+        question_list : Iterable
+            The questions to index, any iterable of dictionaries. It is
+            consumed in batches of index_batch_size
+
+        delta : Bool
+            If true, question_list is treated as the complete content of
+            the collection. Only new or changed questions are sent,
+            questions missing from question_list are deleted and
+            unchanged questions skip variation generation
         """
+        if self.is_embedded(project_id):
+            return self.index_embedded(project_id, version_id, \
+                question_list, delta=delta)
+
         proj_exists = self.ensure_collection_exists(project_id,version_id)
         if proj_exists:
             index_url = self.solr_server_link + "/solr/" + proj_exists
             client = pysolr.Solr(index_url, always_commit=True)
 
+            tracker = None
+            if delta:
+                fq = None
+                if self.shared_versions:
+                    fq = versioning.VERSION_FIELD + ":" + \
+                        query_ast.to_lucene(query_ast.Term(str(version_id)))
+                tracker = self.get_delta_tracker(client, fq=fq)
+
+            hidden_in = {}
+            if self.shared_versions:
+                hidden_in = self.get_hidden_copies(client, version_id)
+
+            term_statistics = None
+            if self.term_statistics:
+                term_statistics = self.get_term_statistics(proj_exists, \
+                    index_url)
+
             to_add = []
+            deferred = []
+            sent = 0
+            detector = self.get_dedupe_detector()
             for question in question_list:
                 if 'id' not in question.keys():
                     question['id']=hashlib.sha512(question['question'].encode())\
                         .hexdigest()
+                if self.shared_versions:
+                    question[versioning.DOC_KEY_FIELD] = question.get(\
+                        versioning.DOC_KEY_FIELD, question['id'])
+                    question[versioning.VERSION_FIELD] = str(version_id)
+                    question[versioning.VERSION_ORDER_FIELD] = \
+                        versioning.version_order(version_id)
+                    question['id'] = versioning.versioned_id(version_id, \
+                        question[versioning.DOC_KEY_FIELD])
+                question[CONTENT_HASH_FIELD] = content_hash(question)
+
+                if detector and not self.dedupe_question(detector, question):
+                    continue
+                if tracker and tracker.is_unchanged(question):
+                    continue
+                if question['id'] in hidden_in:
+                    # Rewriting a copy must not show it again where it was
+                    # removed
+                    question[versioning.HIDDEN_IN_FIELD] = \
+                        hidden_in[question['id']]
 
                 if self.use_rm3:
                     question['para_text_bm']=question['question']
                     question['para_text_ql']=question['question']
                 
-                question_with_variation = self.preprocess_question(question)
+                if self.variation_enricher:
+                    for label, field in \
+                        self.get_uncached_variation_fields(question):
+                        deferred.append(\
+                            (question['id'], label, question[field]))
+
+                question_with_variation = self.preprocess_question(\
+                    question, defer_variations=bool(self.variation_enricher))
                 to_add.append(question_with_variation)
-            
-            print("sending to solr server", proj_exists)
-            client.add(to_add)
-            print("recieved by solr server", proj_exists)
+                if term_statistics:
+                    self.track_terms(term_statistics, question_with_variation)
+
+                # Questions are sent in batches so that streamed question
+                # lists are indexed with a bounded amount of memory
+                if len(to_add) >= self.index_batch_size:
+                    self.add_embeddings(proj_exists, to_add)
+                    self.add_suggestions(proj_exists, to_add)
+                    self.add_spelling(proj_exists, to_add)
+                    sent += self.send_batch(client, index_url, to_add, deferred)
+                    to_add, deferred = [], []
+
+            self.add_embeddings(proj_exists, to_add)
+            self.add_suggestions(proj_exists, to_add)
+            self.add_spelling(proj_exists, to_add)
+            sent += self.send_batch(client, index_url, to_add, deferred)
+            self.print_dedupe_summary(proj_exists, detector)
+
+            if tracker:
+                removed = tracker.removed()
+                print("delta for", proj_exists, ":", tracker.changed, \
+                    "changed,", tracker.unchanged, "unchanged,", \
+                    len(removed), "removed")
+                if removed:
+                    client.delete(id=removed, commit=False)
+                if tracker.retagged:
+                    client.add([{"id": doc_id, CLUSTER_FIELD: cluster} \
+                        for doc_id, cluster in tracker.retagged.items()], \
+                        fieldUpdates={CLUSTER_FIELD: "set"}, commit=False)
+                    print("retagged", len(tracker.retagged), \
+                        "near duplicates of", proj_exists)
+                if term_statistics:
+                    term_statistics.remove(removed)
+                self.delete_embeddings(proj_exists, removed)
+                self.delete_suggestions(proj_exists, removed)
+                self.delete_spelling(proj_exists, removed)
+                if self.shared_versions:
+                    dropped = self.hide_inherited_questions(client, \
+                        proj_exists, version_id, tracker.seen)
+                    self.add_tombstones(proj_exists, version_id, dropped)
+
+            client.commit()
+            if term_statistics:
+                self.term_statistics.save(proj_exists)
+            self.save_embeddings(proj_exists)
+            self.save_suggestions(proj_exists)
+            self.save_spelling(proj_exists)
+            print("recieved by solr server", proj_exists, ":", sent, "documents")
+
+    def is_embedded(self, project_id):
+        """
+        Returns True if a project is served by the in process backend
+        """
+        return str(project_id) in self.embedded_projects
+
+    def get_embedded_collection_name(self, project_id, version_id):
+        return "qa_"+str(project_id)+"_"+str(version_id)
+
+    def index_embedded(self, project_id, version_id, question_list, \
+        delta=False):
+        """
+        Adds questions to the in process index of a project version and
+        writes its snapshot, see index for the inputs. Variations are
+        generated before the questions are added
+        """
+        collection = self.get_embedded_collection_name(project_id, version_id)
+        embedded_index = self.embedded_store.get(collection)
+
+        tracker = None
+        if delta:
+            tracker = DeltaTracker(\
+                embedded_index.content_hashes(CONTENT_HASH_FIELD), \
+                embedded_index.content_hashes(CLUSTER_FIELD) \
+                    if self.dedupe_mode == "tag" else None)
+
+        term_statistics = None
+        if self.term_statistics:
+            term_statistics = self.get_term_statistics(collection)
+
+        to_add = []
+        sent = 0
+        detector = self.get_dedupe_detector()
+        for question in question_list:
+            if 'id' not in question.keys():
+                question['id']=hashlib.sha512(question['question'].encode())\
+                    .hexdigest()
+            question[CONTENT_HASH_FIELD] = content_hash(question)
+
+            if detector and not self.dedupe_question(detector, question):
+                continue
+            if tracker and tracker.is_unchanged(question):
+                continue
+
+            to_add.append(self.preprocess_question(question))
+            if term_statistics:
+                self.track_terms(term_statistics, to_add[-1])
+            if len(to_add) >= self.index_batch_size:
+                self.add_embeddings(collection, to_add)
+                self.add_suggestions(collection, to_add)
+                self.add_spelling(collection, to_add)
+                embedded_index.add(to_add)
+                sent, to_add = sent + len(to_add), []
+
+        self.add_embeddings(collection, to_add)
+        self.add_suggestions(collection, to_add)
+        self.add_spelling(collection, to_add)
+        embedded_index.add(to_add)
+        sent += len(to_add)
+        self.print_dedupe_summary(collection, detector)
+
+        if tracker:
+            removed = tracker.removed()
+            print("delta for", collection, ":", tracker.changed, \
+                "changed,", tracker.unchanged, "unchanged,", \
+                len(removed), "removed")
+            embedded_index.delete(removed)
+            if tracker.retagged:
+                embedded_index.add([dict(doc, **{CLUSTER_FIELD: \
+                    tracker.retagged[doc['id']]}) for doc in \
+                    embedded_index.get_documents(list(tracker.retagged))])
+                print("retagged", len(tracker.retagged), \
+                    "near duplicates of", collection)
+            if term_statistics:
+                term_statistics.remove(removed)
+            self.delete_embeddings(collection, removed)
+            self.delete_suggestions(collection, removed)
+            self.delete_spelling(collection, removed)
+
+        self.embedded_store.save(collection)
+        if term_statistics:
+            self.term_statistics.save(collection)
+        self.save_embeddings(collection)
+        self.save_suggestions(collection)
+        self.save_spelling(collection)
+        print("indexed in process", collection, ":", sent, "documents")
+
+    def search_embedded(self, query, project_id, version_id, top_n):
+        """
+        Searches the in process index of a project version with a query
+        built by build_query and returns solr shaped documents
+        """
+        collection = self.get_embedded_collection_name(project_id, version_id)
+        embedded_index = self.embedded_store.get(collection)
+
+        if isinstance(query, dict):
+            # The param set of the collection holds the edismax fields
+            params = self.get_edismax_param_set()
+            params.update(query)
+            hits = embedded_index.search_edismax(params["q"], \
+                params["qf"].split(), pf=params.get("pf", "").split(), \
+                bq=[query_ast.parse_lucene(x) for x in params.get("bq", [])], \
+                top_n=top_n)
+        else:
+            hits = embedded_index.search(query_ast.parse_lucene(query), \
+                top_n=top_n)
+        return [solr_document(doc, score) for doc, score in hits]
+
+    def get_dedupe_detector(self):
+        """
+        Returns a near duplicate detector for one index call, or None if
+        near duplicates are not handled
+        """
+        if not self.dedupe_mode:
+            return None
+        return NearDuplicateDetector(threshold=self.dedupe_threshold)
+
+    def dedupe_question(self, detector, question):
+        """
+        Assigns a question to its near duplicate cluster. Returns False
+        if the question is a near duplicate which must not be indexed
+        """
+        cluster = detector.add(question['id'], question.get('question', ''))
+        if self.dedupe_mode == "merge":
+            return cluster == str(question['id'])
+        question[CLUSTER_FIELD] = cluster
+        return True
+
+    def print_dedupe_summary(self, collection, detector):
+        if not detector:
+            return
+        summary = detector.summary()
+        print("near duplicates for", collection, ":", summary["questions"], \
+            "questions,", summary["clusters"], "clusters,", \
+            summary["duplicates"], "duplicates", \
+            ("merged," if self.dedupe_mode == "merge" else "tagged,"), \
+            "largest cluster", summary["largest_cluster"])
+
+    def collapse_near_duplicates(self, search_results_list):
+        """
+        Keeps the best hit of every near duplicate cluster
+        """
+        collapsed, seen = [], set()
+        for doc in search_results_list:
+            cluster = doc.get(CLUSTER_FIELD, doc['id'])
+            if isinstance(cluster, list):
+                cluster = cluster[0] if cluster else doc['id']
+            if cluster in seen:
+                continue
+            seen.add(cluster)
+            collapsed.append(doc)
+        return collapsed
+
+    def send_batch(self, client, index_url, to_add, deferred):
+        """
+        Sends a batch of processed questions to solr, then queues the
+        variations deferred to the variation enricher. Returns the number
+        of documents sent
+        """
+        if to_add and self.update_stream:
+            self.update_stream.add(index_url, to_add)
+        elif to_add:
+            client.add(to_add, commit=False)
+
+        # Variations are only applied once the documents exist
+        for doc_id, label, text in deferred:
+            self.variation_enricher.submit(index_url, doc_id, label, text)
+        if deferred:
+            print("queued", len(deferred), "fields for variation generation")
+        return len(to_add)
+
+    def get_hidden_copies(self, client, version_id):
+        """
+        Returns a dictionary mapping the id of every copy of version_id
+        hidden from some versions to these versions
+        """
+        fq = [
+            versioning.version_filter([str(version_id)]),
+            versioning.HIDDEN_IN_FIELD + ":*",
+        ]
+        return {doc['id']: doc[versioning.HIDDEN_IN_FIELD] for doc in \
+            self.iter_documents(client, "id," + versioning.HIDDEN_IN_FIELD, \
+                fq=fq)}
+
+    def hide_inherited_questions(self, client, collection, version_id, \
+        seen_ids):
+        """
+        With shared_versions, hides the inherited questions which a delta
+        index of version_id left out from version_id and the versions
+        inheriting it, by adding version_id to the HIDDEN_IN_FIELD of
+        their visible copies. Returns the doc keys of every inherited
+        question left out, including the ones hidden earlier
+
+        Inputs
+        ------
+        seen_ids : Set
+            The ids of the questions of version_id which were indexed
+        """
+        lineage = self.get_version_lineage(collection, version_id)
+        inherited = lineage - {str(version_id)}
+        if not inherited:
+            return []
+        kept = {versioning.split_versioned_id(x)[0] for x in seen_ids}
+        dropped = [doc for doc in self.iter_documents(client, ",".join(\
+            ["id", versioning.DOC_KEY_FIELD, versioning.HIDDEN_IN_FIELD]), \
+            fq=versioning.version_filter(inherited)) \
+            if doc[versioning.DOC_KEY_FIELD] not in kept]
+        hidden = [doc for doc in dropped \
+            if not lineage & set(doc.get(versioning.HIDDEN_IN_FIELD, []))]
+        if hidden:
+            client.add([{"id": doc['id'], \
+                versioning.HIDDEN_IN_FIELD: str(version_id)} \
+                for doc in hidden], \
+                fieldUpdates={versioning.HIDDEN_IN_FIELD: "add"}, commit=False)
+        print("hid", len({doc[versioning.DOC_KEY_FIELD] for doc in hidden}), \
+            "inherited questions of", collection, "from version", version_id)
+        return sorted({doc[versioning.DOC_KEY_FIELD] for doc in dropped})
+
+    def get_delta_tracker(self, client, fq=None):
+        """
+        Returns a DeltaTracker of the documents of a collection, optionally
+        restricted by the filter query fq. Tagged near duplicate clusters
+        are read in the same pass as the content hashes
+        """
+        if self.dedupe_mode != "tag":
+            return DeltaTracker(self.get_content_hashes(client, fq=fq))
+        hashes, clusters = {}, {}
+        for doc in self.iter_documents(client, ",".join(\
+            ["id", CONTENT_HASH_FIELD, CLUSTER_FIELD]), fq=fq):
+            hashes[doc['id']] = doc.get(CONTENT_HASH_FIELD)
+            clusters[doc['id']] = doc.get(CLUSTER_FIELD)
+        return DeltaTracker(hashes, clusters)
+
+    def get_content_hashes(self, client, fq=None, rows=5000):
+        """
+        Returns a dictionary mapping the id of every document of a
+        collection, optionally restricted by the filter query fq, to its
+        content hash, paging through it with a cursor
+        """
+        return {doc['id']: doc.get(CONTENT_HASH_FIELD) for doc in \
+            self.iter_documents(client, "id," + CONTENT_HASH_FIELD, fq=fq, \
+                rows=rows)}
+
+    def iter_documents(self, client, fl, fq=None, rows=5000):
+        """
+        Yields the fields fl of every document of a collection, optionally
+        restricted by the filter query fq, paging through it with a cursor
+        """
+        cursor = "*"
+        params = {"fq": fq} if fq else {}
+        while True:
+            results = client.search("*:*", fl=fl, rows=rows, sort="id asc", \
+                cursorMark=cursor, **params)
+            for doc in results:
+                yield doc
+            if results.nextCursorMark is None or \
+                results.nextCursorMark == cursor:
+                break
+            cursor = results.nextCursorMark
+
+    def get_field_text(self, doc, field):
+        """
+        Returns the text of a single or multi valued document field
+        """
+        value = doc.get(field, "")
+        if isinstance(value, list):
+            return " ".join(str(x) for x in value)
+        return str(value)
+
+    def track_terms(self, term_statistics, doc):
+        term_statistics.add(doc['id'], \
+            analyze(self.get_field_text(doc, self.rm3_expander.field)))
+
+    def get_term_statistics(self, collection, index_url=None):
+        """
+        Returns the cached term statistics of a collection used by client
+        side RM3. A collection indexed before its statistics were kept
+        has them built once from its documents
+        """
+        with self.term_statistics_lock:
+            if self.term_statistics.exists(collection):
+                return self.term_statistics.get(collection)
+
+            term_statistics = self.term_statistics.get(collection)
+            if self.embedded_store and self.embedded_store.exists(collection):
+                docs = self.embedded_store.get(collection).documents()
+            elif index_url:
+                docs = self.iter_documents(pysolr.Solr(index_url), \
+                    "id," + self.rm3_expander.field)
+            else:
+                docs = []
+            for doc in docs:
+                self.track_terms(term_statistics, doc)
+            self.term_statistics.save(collection)
+            return term_statistics
+
+    def expand_query_rm3(self, query, feedback, collection, started, \
+        index_url=None):
+        """
+        Expands a query built by build_query with client side RM3, from
+        its feedback hits fetched since started
+        """
+        self.rm3_expander.record_feedback(time.perf_counter() - started)
+        field = self.rm3_expander.field
+        expansion = self.rm3_expander.expansion(
+            [(self.get_field_text(doc, field), doc['score']) \
+                for doc in feedback],
+            self.get_term_statistics(collection, index_url))
+        return self.rm3_expander.expand(query, expansion)
+
+    def get_dense_texts(self, doc):
+        """
+        Returns the texts of a document which are embedded, its expanded
+        fields and their variations. Variations added later by the
+        variation enricher are not embedded
+        """
+        fields = [x for x in self.fields_to_expand if x] or ["question"]
+        texts = []
+        for field in fields:
+            for key in doc:
+                if key == field or key.startswith(field + "_variation_"):
+                    text = self.get_field_text(doc, key)
+                    if text.strip():
+                        texts.append(text)
+        return texts
+
+    def add_embeddings(self, collection, docs):
+        """
+        Embeds a batch of processed questions into the dense index of a
+        collection
+        """
+        if not self.embedding_store or not docs:
+            return
+        doc_ids, texts = [], []
+        for doc in docs:
+            for text in self.get_dense_texts(doc):
+                doc_ids.append(str(doc['id']))
+                texts.append(text)
+        if texts:
+            self.embedding_store.get(collection).add(doc_ids, \
+                self.dense_encoder.encode(texts))
+
+    def delete_embeddings(self, collection, doc_ids):
+        if self.embedding_store and doc_ids:
+            self.embedding_store.get(collection).delete(doc_ids)
+
+    def save_embeddings(self, collection):
+        if self.embedding_store:
+            self.embedding_store.get(collection).save()
+
+    def get_suggestion_texts(self, doc):
+        """
+        Returns the (text, weight) pairs a document is suggested by, its
+        question and, with half the weight, its variations
+        """
+        texts = []
+        for key in doc:
+            if key == "question":
+                texts.append((self.get_field_text(doc, key), 1.0))
+            elif key.startswith("question_variation_"):
+                texts.append((self.get_field_text(doc, key), 0.5))
+        return texts
+
+    def add_suggestions(self, collection, docs):
+        if not self.suggestion_store or not docs:
+            return
+        suggestion_index = self.suggestion_store.get(collection)
+        for doc in docs:
+            suggestion_index.add(doc['id'], self.get_suggestion_texts(doc))
+
+    def delete_suggestions(self, collection, doc_ids):
+        if self.suggestion_store and doc_ids:
+            self.suggestion_store.get(collection).remove(doc_ids)
+
+    def add_tombstones(self, collection, version_id, doc_keys):
+        """
+        Records the inherited questions left out of version_id as empty
+        copies of version_id, so that the lineage views of the suggestions
+        and spelling vocabularies hide their older copies like
+        hidden_filter does in solr
+        """
+        if not doc_keys:
+            return
+        tombstones = [versioning.versioned_id(version_id, doc_key) \
+            for doc_key in doc_keys]
+        if self.suggestion_store:
+            suggestion_index = self.suggestion_store.get(collection)
+            for doc_id in tombstones:
+                suggestion_index.add(doc_id, [])
+        if self.spelling_store:
+            corrector = self.spelling_store.get(collection, build=False)
+            for doc_id in tombstones:
+                corrector.add(doc_id, "")
+
+    def save_suggestions(self, collection):
+        if self.suggestion_store:
+            self.suggestion_store.save(collection)
+
+    def add_spelling(self, collection, docs):
+        if not self.spelling_store or not docs:
+            return
+        corrector = self.spelling_store.get(collection, build=False)
+        for doc in docs:
+            corrector.add(doc['id'], " ".join(self.get_field_text(doc, x) \
+                for x in self.spelling_fields))
+
+    def delete_spelling(self, collection, doc_ids):
+        if self.spelling_store and doc_ids:
+            self.spelling_store.get(collection, build=False).remove(doc_ids)
+
+    def save_spelling(self, collection):
+        if self.spelling_store:
+            self.spelling_store.save(collection)
+            print("spelling dictionary for", collection, ":", \
+                self.spelling_store.get(collection).stats())
+
+    def correct_spelling(self, query_string, project_id, version_id):
+        """
+        Returns the query string with the words missing from the
+        vocabulary of the project version replaced by their closest known
+        word. With shared_versions the vocabulary is the one of the
+        questions visible from the version
+        """
+        if not self.spelling_store:
+            return query_string
+        collection = self.get_serving_collection_name(project_id, version_id)
+        if self.shared_versions and not self.is_embedded(project_id):
+            corrector = self.spelling_store.get_view(collection, \
+                self.get_version_lineage(collection, version_id))
+        else:
+            corrector = self.spelling_store.get(collection)
+        query_string, corrections = corrector.correct(query_string)
+        if self.debug and corrections:
+            print("spelling corrections :", corrections)
+        return query_string
+
+    def get_serving_collection_name(self, project_id, version_id):
+        """
+        Returns the name of the solr collection or in process index
+        serving a project version, without contacting solr
+        """
+        if self.is_embedded(project_id):
+            return self.get_embedded_collection_name(project_id, version_id)
+        return self.get_collection_name(project_id, version_id)
+
+    def suggest(self, prefix, project_id, version_id, top_k=None):
+        """
+        Returns the typeahead suggestions of a prefix as [text, weight]
+        pairs, best first. With shared_versions only the questions visible
+        from the version are suggested, like a search of the version
+
+        Inputs
+        ------
+        prefix : String
+            What the user typed so far
+        top_k : Int
+            The number of suggestions, the default of autocomplete_config
+            if None
+        """
+        if not self.suggestion_store:
+            return []
+        return self.get_suggestion_index(project_id, version_id).suggest(\
+            prefix, top_k=top_k or self.suggestion_top_k)
+
+    def get_suggestion_index(self, project_id, version_id):
+        """
+        Returns the suggestions of a project version, with shared_versions
+        the view of the collection restricted to the lineage of the version
+        """
+        collection = self.get_serving_collection_name(project_id, version_id)
+        if not self.shared_versions or self.is_embedded(project_id):
+            return self.suggestion_store.get(collection)
+        return self.suggestion_store.get_view(collection, \
+            self.get_version_lineage(collection, version_id))
+
+    def record_suggestion(self, text, project_id, version_id):
+        """
+        Raises the popularity of a suggestion picked by a user. It is
+        written with the next snapshot of the collection
+        """
+        if self.suggestion_store:
+            collection = self.get_serving_collection_name(project_id, \
+                version_id)
+            self.suggestion_store.get(collection).record_selection(text)
+            if self.shared_versions and not self.is_embedded(project_id):
+                self.get_suggestion_index(project_id, version_id)\
+                    .record_selection(text)
+
+    def get_documents_by_id(self, collection, index_url, doc_ids, \
+        embedded=False):
+        """
+        Returns the documents of the given ids, from the in process index
+        or with one solr real time get request
+        """
+        if not doc_ids:
+            return []
+        if embedded:
+            return [solr_document(doc, 0.0) for doc in \
+                self.embedded_store.get(collection).get_documents(doc_ids)]
+        fl = self.get_lean_fl() if self.lean_results else '*'
+        response = self.send_search(
+            lambda url: self.session.get(url + '/get', params={
+                "ids": ",".join(doc_ids),
+                "fl": fl,
+                "wt": "json"
+            }),
+            collection, index_url)
+        return response.json()['response']['docs']
+
+    def fuse_dense_candidates(self, query_string, search_results_list, \
+        collection, index_url, top_n, embedded=False, lineage=None):
+        """
+        Adds the dense candidates of the user query to the lexical ones
+        and orders them by reciprocal rank fusion, keeping top_n.
+        Candidates only found by the dense stage are fetched by id
+
+        With shared_versions, a dense candidate is only kept if it is the
+        copy of its question which the collapse filter returns for the
+        lineage, the copy of the newest version of the lineage
+        """
+        embedding_index = self.embedding_store.get(collection)
+        dense = embedding_index.search(\
+            self.dense_encoder.encode([query_string]), self.dense_top_k)[0]
+        if lineage is not None:
+            dense = [[score, doc_id] for score, doc_id in dense \
+                if versioning.newest_visible_id(doc_id, lineage, \
+                    lambda x: x in embedding_index) == doc_id]
+
+        lexical = [[x['score'], x['id']] for x in search_results_list]
+        fused = fuse_rankings({"lexical": lexical, "dense": dense}, \
+            method="rrf")[:top_n]
+
+        docs = {x['id']: x for x in search_results_list}
+        missing = [doc_id for _, doc_id in fused if doc_id not in docs]
+        for doc in self.get_documents_by_id(collection, index_url, missing, \
+            embedded=embedded):
+            # Copies removed in the lineage are left out like by hidden_filter
+            if lineage is not None and \
+                lineage & set(doc.get(versioning.HIDDEN_IN_FIELD, [])):
+                continue
+            docs[doc['id']] = doc
+
+        fused_docs = []
+        for score, doc_id in fused:
+            if doc_id in docs:
+                docs[doc_id]['score'] = score
+                fused_docs.append(docs[doc_id])
+        return fused_docs
+
+    def is_not_present(self, search_results_list):
+        """
+        Returns True if the best hit of a search scores too low for the
+        answer to be in the collection. With client side RM3 this is
+        checked on the unexpanded feedback search, since the expanded
+        query weighs the original one down
+        """
+        return bool(search_results_list) and \
+            search_results_list[0]['score'] < 3
+
+    def rm3_expansion_status(self):
+        """
+        Returns the number and mean cost of client side RM3 expansions,
+        or None if client side RM3 is not used
+        """
+        if not self.rm3_expander:
+            return None
+        return self.rm3_expander.stats()
+
+    def close(self):
+        """
+        Waits for the queued variations and suggestion rebuilds, then
+        shuts down the thread pools and closes the http session. The
+        engine must not be used afterwards
+        """
+        if self.variation_enricher:
+            self.variation_enricher.close()
+        if self.suggestion_store:
+            self.suggestion_store.join()
+        if self.rerank_executor:
+            self.rerank_executor.shutdown()
+        if self.hedged_requester:
+            self.hedged_requester.close()
+        # Also the session of the update stream
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def variation_enrichment_status(self):
+        """
+        Returns the progress and backlog of the background variation
+        generation, or None if async_variations is not used
+        """
+        if not self.variation_enricher:
+            return None
+        return self.variation_enricher.status()
+
+    def get_uncached_variation_fields(self, question):
+        """
+        Returns (label, field) pairs of fields which must be expanded but
+        do not have their variations present in the question yet
+        """
+        uncached = []
+        if not self.variation_generator:
+            return uncached
+
+        for x in question.keys():
+            if question[x]=="" or question[x] =="-" or "variation" in x:
+                continue
+            label = x.replace(" ","_")
+            if label not in self.fields_to_expand:
+                continue
+            field_names = [label + "_variation_"+str(idx) for idx in \
+                range(self.variation_generator.num_variations)]
+            if not all(name in question.keys() for name in field_names):
+                uncached.append((label, x))
+        return uncached
+
+    def preprocess_question(self, question, defer_variations=False):
+        """
+        Drops empty fields and adds variations of the fields which must
+        be expanded
 
-    def preprocess_question(self, question):
+        If defer_variations is set, variations which are not already
+        present in the question are not generated, so that they can be
+        added later by the variation enricher
+        """
         processed_question = {}
         for x in question.keys():
             if question[x]=="" or question[x] =="-":
@@ -194,6 +1193,8 @@ class SolrSearchEngine:
 
                     if cached:
                         variations = [question[key] for key in field_names]
+                    elif defer_variations:
+                        variations = []
                     else:
                         variations = self.variation_generator.\
                             get_variations(question[x])
@@ -205,6 +1206,14 @@ class SolrSearchEngine:
 
         return processed_question
 
+    def get_collection_name(self, project_id, version_id):
+        """
+        Returns the name of the collection holding a project version
+        """
+        if self.shared_versions:
+            return versioning.shared_collection_name(project_id)
+        return "qa_"+str(project_id)+"_"+str(version_id)
+
     def check_collection_exists(self, project_id, version_id):
         collection_url = self.solr_server_link + "/solr/admin/collections"
         # Check collection names
@@ -218,76 +1227,168 @@ class SolrSearchEngine:
 
         all_collections = collection_json['collections']
 
-        new_name = "qa_"+str(project_id)+"_"+str(version_id)
+        new_name = self.get_collection_name(project_id, version_id)
 
         return new_name in all_collections
 
     def ensure_collection_exists(self, project_id, version_id):
+        """
+        Returns the name of the collection of a project version, creating
+        it if it does not exist. Returns False if solr could not list or
+        create the collection
+
+        A created collection is only returned once all of its replicas
+        are active, so that it can be indexed right away. Only callers
+        of the same collection wait for it
+        """
+        new_name = self.get_collection_name(project_id, version_id)
+        if new_name in self.known_collections:
+            return new_name
+
         collection_url = self.solr_server_link + "/solr/admin/collections"
-        # Check collection names
-        collection_json = requests.get(\
-            collection_url,{"action":"LIST","wt":"json"})#.json()
-        
-        collection_json = collection_json.json()
-        
-        if collection_json['responseHeader']['status'] != 0:
-            return False
+        with self.collection_lock:
+            lock = self.collection_locks.setdefault(new_name, threading.Lock())
+        with lock:
+            if new_name in self.known_collections:
+                return new_name
+            # Check collection names
+            collection_json = self.session.get(\
+                collection_url,{"action":"LIST","wt":"json"})#.json()
+            
+            collection_json = collection_json.json()
+            
+            if collection_json['responseHeader']['status'] != 0:
+                return False
 
-        all_collections = collection_json['collections']
+            all_collections = collection_json['collections']
+            self.known_collections.update(all_collections)
 
-        new_name = "qa_"+str(project_id)+"_"+str(version_id)
-        if new_name not in all_collections:
-            # Create a collection if collection doesnt exist
-            if self.use_rm3:
-                #First create a custom configset
-                headers = {
-                    'Content-Type': 'application/octet-stream',
-                }
-                configName = new_name
-                params = (
-                    ('action', 'UPLOAD'),
-                    ('name', configName),
-                )
-                
-                data = open('/usr/src/WHOA-FAQ-Answer-Project/WHO-FAQ-Search-Engine/configs/myconfigset.zip', 'rb').read()
-                response = requests.post(self.solr_server_link \
-                    +'/solr/admin/configs', 
-                    headers=headers, 
-                    params=params, 
-                    data=data)
-                # pdb.set_trace()
-
-                x = requests.get(collection_url,\
-                {
-                    "action":"CREATE","name":new_name,"numShards":"1",
-                    "collection.configName":configName, "replicationFactor":"4"
-                })
-                # pdb.set_trace()
-            else:
-                x = requests.get(collection_url,\
-                    {"action":"CREATE","name":new_name,"numShards":"1", "replication_factor":"2"})
+            if new_name not in all_collections:
+                # Create a collection if collection doesnt exist
+                params = self.get_collection_params(project_id)
+                if self.use_rm3:
+                    with self.collection_lock:
+                        configName = self.ensure_configset()
+                    if not configName:
+                        return False
+                    params["collection.configName"] = configName
+
+                params.update({"action":"CREATE","name":new_name,"wt":"json"})
+                response = self.session.get(collection_url, params=params)
+                if response.status_code != 200 or \
+                    response.json()['responseHeader']['status'] != 0:
+                    print("could not create collection", new_name, \
+                        response.text)
+                    return False
+
+                if not self.wait_for_collection(new_name):
+                    print("collection", new_name, "was not ready after", \
+                        self.collection_ready_timeout, "seconds")
+                    return False
+                self.known_collections.add(new_name)
         return new_name
+
+    def get_collection_params(self, project_id):
+        """
+        Returns the shard and replica parameters used to create the
+        collections of a project
+        """
+        params = {
+            "numShards": "1",
+            "replicationFactor": "4" if self.use_rm3 else "2",
+        }
+        if self.shared_versions:
+            # Copies of a question are routed to one shard by their doc key
+            params["router.name"] = "compositeId"
+        project_params = self.collection_config.get(str(project_id), {})
+        if any(x in project_params for x in \
+            ("nrtReplicas", "tlogReplicas", "pullReplicas")):
+            params.pop("replicationFactor")
+        params.update({key: str(value) for key, value in \
+            project_params.items()})
+        return params
+
+    def ensure_configset(self):
+        """
+        Uploads the rm3 configset unless a configset with the same
+        checksum already exists, and returns its name
+
+        The name is derived from the sha1 of the zip, so every collection
+        created from the same zip reuses one configset
+        """
+        if self.configset_name:
+            return self.configset_name
+
+        with open(self.configset_path, 'rb') as f:
+            data = f.read()
+        configName = "qa_rm3_" + hashlib.sha1(data).hexdigest()[:12]
+
+        configs_url = self.solr_server_link + '/solr/admin/configs'
+        existing = self.session.get(configs_url, \
+            params={"action":"LIST","wt":"json"}).json()
+        if configName not in existing.get('configSets', []):
+            headers = {
+                'Content-Type': 'application/octet-stream',
+            }
+            params = (
+                ('action', 'UPLOAD'),
+                ('name', configName),
+                ('wt', 'json'),
+            )
+            response = self.session.post(configs_url, 
+                headers=headers, 
+                params=params, 
+                data=data)
+            if response.status_code != 200:
+                print("could not upload configset", configName, response.text)
+                return False
+            print("uploaded configset", configName)
+
+        self.configset_name = configName
+        return configName
+
+    def wait_for_collection(self, collection, poll_interval=0.5):
+        """
+        Polls CLUSTERSTATUS until every replica of the collection is
+        active on a live node. Returns False after collection_ready_timeout
+        seconds
+        """
+        collection_url = self.solr_server_link + "/solr/admin/collections"
+        deadline = time.time() + self.collection_ready_timeout
+        while time.time() < deadline:
+            status = self.session.get(collection_url, params={
+                "action":"CLUSTERSTATUS","collection":collection,"wt":"json"
+            }).json()
+            cluster = status.get('cluster', {})
+            live_nodes = set(cluster.get('live_nodes', []))
+            shards = cluster.get('collections', {}).get(collection, {})\
+                .get('shards', {})
+
+            replicas = [replica for shard in shards.values() \
+                for replica in shard.get('replicas', {}).values()]
+            if replicas and all(replica.get('state') == 'active' and \
+                replica.get('node_name') in live_nodes \
+                for replica in replicas):
+                return True
+            time.sleep(poll_interval)
+        return False
     
-    def indexFolder(self, indexDir,project_id=10, version_id=20):
+    def indexFolder(self, indexDir,project_id=10, version_id=20, \
+        num_workers=4):
         """
-        Adds all the json files present in indexDir to the index
+        Adds all the json and jsonl files present in indexDir to the index
+
+        A file can contain a single document, an array of documents or
+        one document per line. Files are parsed by num_workers threads
+        and streamed to index, so the folder is never held in memory
         """
         print( 'Writing directory to index')
-        question_list = []
-        for filename in sorted(os.listdir(indexDir)):
-            if not filename.endswith('.json'):
-                continue            
-            # print("adding", filename)
-            
-            f = open(os.path.join(indexDir,filename),)
-            question = json.load(f)
-            question_list.append(question)
-
-        # pdb.set_trace()
-        self.index(project_id,version_id,question_list)
+        self.index(project_id, version_id, \
+            iter_json_folder(indexDir, num_workers=num_workers, \
+                max_pending=2 * self.index_batch_size))
 
     def build_query(self, query_string, boosting_tokens, query_type, \
-        field="contents", boost_val=1.05):
+        field="contents", boost_val=1.05, project_id=None, version_id=None):
         """
         First, the user query is matched againt the field specifiec in 
         "field", then the boosting tokens are matched against the keys 
@@ -310,38 +1411,36 @@ class SolrSearchEngine:
         query_type : String
             The query type is the string which specifies what type of
             lucene query we should use
+        project_id, version_id : String
+            The project version searched. If given, misspelled words of
+            the query string are corrected against its vocabulary
         """
 
         # TODO : sanitize query string sp that false queries dont break
         # the system. Prevent sql njection type attacks
-        query_string = query_string.replace("?","").replace("(","")\
-                .replace(")","").replace("-","").replace("\"","").replace("'","").strip()
+        query_string = query_string.translate(query_ast.QUERY_SANITIZER)\
+            .strip()
+        if project_id is not None:
+            query_string = self.correct_spelling(query_string, project_id, \
+                version_id)
+        synonyms = None
 
         if query_type == "OR_QUERY":
-            synonyms = None
-
-            # Ask against field
-            new_field = field+":"
-            qs = ""
-            for x in query_string.split(" "):
-                qs+= new_field + "\""+ x + "\" "
-
-            query_string = qs
             # TODO : add ability to have a per field unique boost value
-            if self.debug:
-                query_string, synonyms = \
-                    self.get_or_query_string(query_string,
-                    boosting_tokens, boost_val=boost_val, field=field)
-            else:
-                query_string, _ = \
-                    self.get_or_query_string(query_string,
-                    boosting_tokens, boost_val=boost_val, field=field)
+            query_string, synonyms = \
+                self.get_or_query_string(query_string,
+                boosting_tokens, boost_val=boost_val, field=field)
 
         if query_type == "RM3_QUERY":
             query_string, synonyms = self.get_rm3_query_string(
                 query_string,
                 boosting_tokens)
 
+        if query_type == "EDISMAX_QUERY":
+            query_string, synonyms = self.get_edismax_query_params(
+                query_string,
+                boosting_tokens, boost_val=boost_val, field=field)
+
         if self.debug:
             return query_string, synonyms
         return query_string
@@ -376,10 +1475,95 @@ class SolrSearchEngine:
 
         return (query_string + boost_string).replace('/','\/'), False
 
+    def get_edismax_query_params(self, query_string, boosting_tokens, \
+        boost_val, field):
+        """
+        Converts the user query string and boosting tokens into the
+        parameters of an edismax request
+
+        Instead of spelling out every token against every field, the raw
+        user text is sent as q. The fields it is matched against (qf, pf)
+        live in the param set of the collection, so only the boosting
+        tokens and synonyms are sent per request, as bq parameters
+
+        Returns a dictionary of request parameters which is passed as the
+        query to search
+        """
+        synonyms = []
+        if self.synonym_config:
+            synonyms = self.synonym_expander.return_synonyms(query_string)
+
+        bq = []
+        if boost_val:
+            bq = [query_ast.to_lucene(clause) for clause in \
+                query_ast.boosting_clauses(boosting_tokens, boost_val)]
+
+        synonym_clauses = [query_ast.token(x, field=field) for x in synonyms \
+            if str(x).strip('" ')]
+        if synonym_clauses:
+            bq.append(query_ast.to_lucene(query_ast.Group(synonym_clauses, \
+                boost=self.synonyms_boost_val)))
+
+        params = {
+            "q": query_string,
+            "useParams": self.edismax_param_set,
+        }
+        if bq:
+            params["bq"] = bq
+        return params, synonyms
+
+    def get_edismax_param_set(self):
+        """
+        Returns the static edismax parameters of a collection. The user
+        query is matched against every expanded field and its variations
+        """
+        num_variations = self.variation_generator.num_variations \
+            if self.variation_generator else 3
+        fields = [x for x in self.fields_to_expand if x] or ["question"]
+
+        qf = []
+        for field in fields:
+            qf.append(field)
+            qf.extend([field + "_variation_" + str(idx) \
+                for idx in range(num_variations)])
+
+        return {
+            "defType": "edismax",
+            "q.op": "OR",
+            "qf": " ".join(qf),
+            "pf": " ".join(fields),
+        }
+
+    def ensure_param_set(self, collection):
+        """
+        Creates the edismax param set of a collection through the solr
+        config api, once per collection. Returns False if it could not be
+        created, it is tried again by the next search
+        """
+        if collection in self.collections_with_param_set:
+            return True
+        try:
+            response = self.session.post(
+                self.solr_server_link + "/solr/" + collection + \
+                    "/config/params",
+                json={"set": {self.edismax_param_set: \
+                    self.get_edismax_param_set()}})
+        except requests.RequestException as e:
+            print("could not create param set", self.edismax_param_set, \
+                "of", collection, ":", repr(e))
+            return False
+        if response.status_code != 200:
+            print("could not create param set", self.edismax_param_set, \
+                "of", collection, ":", response.status_code, response.text)
+            return False
+        self.collections_with_param_set.add(collection)
+        return True
+
     def get_or_query_string(self, query_string, boosting_tokens, boost_val, field):
         """
         Converts the user query string and boosting tokens into a long 
-        OR query
+        OR query, built as a query_ast tree so that every token is
+        escaped the same way
         
         The format of the boosting tokens is
         boosting_tokens = {
@@ -397,36 +1581,152 @@ class SolrSearchEngine:
             the field while the value is the token
         boost_val : Float
             The amount of boosting that must be added per boosting token
+        field : String
+            The field against which the user query and its synonyms
+            are matched
         """
-
-        boost_string = ""
-        if boost_val:
-            # TODO : Boost a token according to a per field value
-            for x in boosting_tokens:
-                for token in boosting_tokens[x]:
-                    if token == "":
-                        continue
-                    boost_string = boost_string + " OR " + \
-                    str(x).replace(" ","_") + ":\"" + str(token) + "\"^" + \
-                        str(boost_val)
-
+        synonyms = []
         #TODO : Check Better methods of generating queries
         if self.synonym_config:
             synonyms = self.synonym_expander.return_synonyms(query_string)
-            if len(synonyms) > 0:
-                qs = ""
-                new_field = field+":"
-                for x in synonyms:
-                    qs+= new_field + x + " "
 
-                query_string = query_string + \
-                    " OR (" + qs + ")^" + \
-                    str(self.synonyms_boost_val)
+        # TODO : Boost a token according to a per field value
+        query = query_ast.or_query(query_string,
+            field=field,
+            synonyms=synonyms,
+            synonyms_boost_val=self.synonyms_boost_val,
+            boosting_tokens=boosting_tokens,
+            boost_val=boost_val)
+
+        return query_ast.to_lucene(query), synonyms
+
+    def get_search_url(self, collection):
+        """
+        Returns the url of the collection a search is sent to, spread
+        over the live nodes when replica routing is used
+        """
+        if self.replica_router:
+            return self.replica_router.next_url() + "/solr/" + collection
+        return self.solr_server_link + "/solr/" + collection
 
-        return (query_string + boost_string).replace('/','\/'), synonyms
+    def get_lean_fl(self):
+        """
+        Returns the fl parameter fetching only what reranking needs
+        """
+        fl = ['id', 'score']
+        if self.dedupe_mode == "tag":
+            fl.append(CLUSTER_FIELD)
+        if self.shared_versions:
+            fl.append(versioning.HIDDEN_IN_FIELD)
+        for field in self.rerank_fields:
+            if field.endswith("_variation_best"):
+                field = field[:-len("best")] + "*"
+            fl.append(field)
+        return ",".join(fl)
+
+    def get_rerank_text(self, document, field, query_tokens):
+        """
+        Returns the text of a document field sent to the reranker, or None
+        if the document does not have the field
+        """
+        if field.endswith("_variation_best"):
+            prefix = field[:-len("best")]
+            best, best_overlap = None, -1
+            for key in document:
+                if not key.startswith(prefix):
+                    continue
+                value = document[key][0] if isinstance(document[key], list) \
+                    else document[key]
+                overlap = len(query_tokens & set(value.lower().split()))
+                if overlap > best_overlap:
+                    best, best_overlap = value, overlap
+            return best
+
+        value = document.get(field)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        return value
+
+    def rerank_candidates(self, query_string, search_results_list):
+        """
+        Reranks the candidates on every field of rerank_fields and fuses
+        the scores. The fields are reranked concurrently, so this costs
+        about one reranker round trip
+
+        Returns [score, id] pairs best first, or False if the reranker
+        could not rank any field
+        """
+        query_tokens = set(query_string.lower().split())
+        texts = {}
+        for field in self.rerank_fields:
+            text = []
+            for document in search_results_list:
+                value = self.get_rerank_text(document, field, query_tokens)
+                if value:
+                    text.append([document['id'], value])
+            if text:
+                texts[field] = text
+
+        if len(texts) <= 1 or not self.rerank_executor:
+            rankings = {field: self.reranker.rerank_ids(query_string, text) \
+                for field, text in texts.items()}
+        else:
+            futures = {field: self.rerank_executor.submit(\
+                self.reranker.rerank_ids, query_string, text) \
+                for field, text in texts.items()}
+            rankings = {field: future.result() \
+                for field, future in futures.items()}
+
+        # Fields which were rate limited are left out
+        rankings = {field: ranking for field, ranking in rankings.items() \
+            if ranking}
+        if not rankings:
+            return False
+        if len(rankings) == 1:
+            return next(iter(rankings.values()))
+        return fuse_rankings(rankings, method=self.fusion_method, \
+            weights=self.fusion_weights)
+
+    def fetch_stored_fields(self, collection, index_url, return_docs):
+        """
+        Replaces the lean documents of search results by their full
+        stored fields, fetched with one real time get request
+        """
+        if not return_docs:
+            return return_docs
+
+        response = self.send_search(
+            lambda url: self.session.get(url + '/get', params={
+                "ids": ",".join(doc['id'] for doc, _ in return_docs),
+                "wt": "json"
+            }),
+            collection, index_url)
+        stored = {doc['id']: doc for doc in \
+            response.json()['response']['docs']}
+
+        full_docs = []
+        for doc, score in return_docs:
+            full_doc = stored.get(doc['id'], doc)
+            full_doc['score'] = doc['score']
+            full_docs.append(SearchResult(full_doc, score))
+        return full_docs
+
+    def send_search(self, call, collection, index_url):
+        """
+        Performs call(index_url). With hedging, the same call is sent to
+        another live node if the first one is slow. Without replica
+        routing no other node is known and calls are not hedged
+        """
+        if not self.hedged_requester or not self.replica_router:
+            return call(index_url)
+        other_url = self.replica_router.other_url(index_url)
+        if not other_url:
+            return call(index_url)
+        return self.hedged_requester.request(call, index_url, \
+            other_url + "/solr/" + collection)
 
     def search(self, query, project_id, version_id, top_n=50, return_json=False, \
-        query_string=None, query_field=None):
+        query_string=None, query_field=None, final_top_k=None):
         """
         This function takes a lucene query which can be created from
         the lucene query parser class and performs a search on the index
@@ -436,30 +1736,83 @@ class SolrSearchEngine:
         ------
         query : Lucene Query
             A query create by the QueryGenerator class present in 
-            query_generator.py
+            query_generator.py, or the dictionary of request parameters
+            built by build_query for an EDISMAX_QUERY
         top_n : Int
             The number of top results we want our search to return
         return_json : Bool
-            If true, the search results are jsonified and returned
-            else the search results are return in the Lucene Document format
+            If true, the search results are returned as documents with
+            their final score, else as SearchResult objects
         query_string : String
             The string entered by the user
         rerank_fiels : String
             The name of the field against which the reranker must be run
+        final_top_k : Int
+            The number of results returned after reranking, all of the
+            top_n candidates if None
+
+        With coalesce_searches, concurrent calls with the same query,
+        normalized query string and options share one execution and the
+        same result objects, which callers must not modify
+        """
+        if not self.singleflight:
+            return self.execute_search(query, project_id, version_id, \
+                top_n=top_n, return_json=return_json, \
+                query_string=query_string, query_field=query_field, \
+                final_top_k=final_top_k)
+
+        # Identical in flight searches wait for one execution
+        key = (
+            str(project_id), str(version_id),
+            tuple(sorted((k, str(v)) for k, v in query.items())) \
+                if isinstance(query, dict) else str(query),
+            " ".join(str(query_string).lower().split()),
+            query_field, top_n, return_json, final_top_k,
+        )
+        return self.singleflight.do(key, lambda: self.execute_search(\
+            query, project_id, version_id, top_n=top_n, \
+            return_json=return_json, query_string=query_string, \
+            query_field=query_field, final_top_k=final_top_k))
+
+    def execute_search(self, query, project_id, version_id, top_n=50, \
+        return_json=False, query_string=None, query_field=None, \
+        final_top_k=None):
+        """
+        Performs a search, see search for the inputs
         """
         # Field names do not contain spaces
         query_field = query_field.replace(" ","_")
 
-        proj_exists = self.ensure_collection_exists(project_id,version_id)
-        if proj_exists:
-            index_url = self.solr_server_link + "/solr/" + proj_exists
-
-        if not proj_exists:
-            return 400
-
-        if self.use_rm3 and index_url:
-            new_url = index_url + '/anserini'
-            response = self.session.get(new_url,data={"q":query})
+        embedded = self.is_embedded(project_id)
+        proj_exists = index_url = None
+        if not embedded:
+            proj_exists = self.ensure_collection_exists(project_id,version_id)
+            if proj_exists:
+                index_url = self.get_search_url(proj_exists)
+
+            if not proj_exists:
+                return 400
+        collection = self.get_embedded_collection_name(project_id, \
+            version_id) if embedded else proj_exists
+
+        if embedded:
+            if self.rm3_expander:
+                started = time.perf_counter()
+                feedback = self.search_embedded(query, project_id, \
+                    version_id, self.rm3_expander.fb_docs)
+                if self.is_not_present(feedback):
+                    return "Not present"
+                query = self.expand_query_rm3(query, feedback, collection, \
+                    started)
+            search_results_list = self.search_embedded(query, project_id, \
+                version_id, top_n)
+            if not self.rm3_expander and \
+                self.is_not_present(search_results_list):
+                return "Not present"
+        elif self.use_rm3 and index_url:
+            response = self.send_search(
+                lambda url: self.session.get(url + '/anserini',data={"q":query}),
+                proj_exists, index_url)
             data = response.json()
             docs = data['docs']['docs']
             
@@ -485,14 +1838,57 @@ class SolrSearchEngine:
             )
             """          
         else:
-            client = pysolr.Solr(index_url, always_commit=True)
-            search_results = client.search(query,fl='*,score',rows=top_n)
+            params = {}
+            edismax = isinstance(query, dict)
+            if edismax:
+                # edismax queries carry their own request parameters
+                params = dict(query)
+                query = params.pop("q")
+                if not self.ensure_param_set(proj_exists):
+                    # Without the param set solr would silently use the
+                    # default parser, so its parameters are sent inline
+                    params.pop("useParams", None)
+                    params.update(self.get_edismax_param_set())
+            if self.shared_versions:
+                lineage = self.get_version_lineage(proj_exists, version_id)
+                params["fq"] = [
+                    versioning.version_filter(lineage),
+                    versioning.hidden_filter(lineage),
+                    versioning.collapse_filter(),
+                ]
+            if self.replica_router:
+                params.update(self.replica_router.search_params())
+
+            if self.rm3_expander:
+                # The top hits of the unexpanded query are the feedback
+                started = time.perf_counter()
+                feedback = self.send_search(
+                    lambda url: pysolr.Solr(url).search(query, \
+                        fl="id,score," + self.rm3_expander.field, \
+                        rows=self.rm3_expander.fb_docs, **params),
+                    proj_exists, index_url)
+                if self.is_not_present(feedback.docs):
+                    return "Not present"
+                if edismax:
+                    params = self.expand_query_rm3(dict(params, q=query), \
+                        feedback, proj_exists, started, index_url)
+                    query = params.pop("q")
+                else:
+                    query = self.expand_query_rm3(query, feedback, \
+                        proj_exists, started, index_url)
+
+            # Reranking only needs the reranked fields of the candidates
+            fl = self.get_lean_fl() if self.lean_results else '*,score'
+            search_results = self.send_search(
+                lambda url: pysolr.Solr(url, always_commit=True).search(\
+                    query,fl=fl,rows=top_n,**params),
+                proj_exists, index_url)
             search_results_list = [x for x in search_results]
             
             if search_results.raw_response['response']['numFound'] > 0:
                 max_score = search_results.raw_response['response']['docs'][0]['score']
                 
-                if max_score < 3:
+                if max_score < 3 and not self.rm3_expander:
                     return "Not present"
                 """
                 the resonse contains these keys
@@ -518,33 +1914,44 @@ class SolrSearchEngine:
             else:
                 search_results_list = []
         
+        if self.embedding_store and query_string and \
+            (embedded or not self.use_rm3):
+            lineage = None
+            if self.shared_versions and not embedded:
+                lineage = self.get_version_lineage(proj_exists, version_id)
+            search_results_list = self.fuse_dense_candidates(query_string, \
+                search_results_list, collection, index_url, top_n, \
+                embedded=embedded, lineage=lineage)
+
+        if self.dedupe_mode == "tag":
+            search_results_list = self.collapse_near_duplicates(\
+                search_results_list)
+
         # print("reranking")
-        # TODO : Add support for reranking multiple fields
         if self.rerank_endpoint is not None and query_string and query_field:
-            ids = {}
-            text = []
-
-            # pdb.set_trace()
-            for document in search_results_list:
-                ids[document['question'][0]]=document['id']
-                text.append([document['id'],document['question'][0]])
-
-            scoreDocs = self.reranker.rerank(query_string, text)
+            rankedIds = self.rerank_candidates(query_string, \
+                search_results_list)
 
             # case where gpu is rate limited
-            if not scoreDocs:
-                return_docs = [[x,x['score']] for x in search_results_list]
+            if not rankedIds:
+                return_docs = [SearchResult(x,x['score']) \
+                    for x in search_results_list]
             else:
-                return_docs = []
-                for x in scoreDocs:
-                    for y in search_results_list:
-                        if x[1]==y['question'][0]:
-                            return_docs.append([y,x[0]])
-                            break
+                docs_by_id = {x['id']: x for x in search_results_list}
+                return_docs = [SearchResult(docs_by_id[doc_id],score) \
+                    for score, doc_id in rankedIds if doc_id in docs_by_id]
         else:
             #TODO:setup so that score is correct
             # return document as well as score
-            return_docs = [[x,x['score']] for x in search_results_list]
+            return_docs = [SearchResult(x,x['score']) \
+                for x in search_results_list]
+
+        if final_top_k is not None:
+            return_docs = return_docs[:final_top_k]
+
+        if self.lean_results and not self.use_rm3 and not embedded:
+            return_docs = self.fetch_stored_fields(proj_exists, index_url, \
+                return_docs)
 
         if self.debug:
             scoreDocs=[]
@@ -569,7 +1976,11 @@ class SolrSearchEngine:
 
                 scoreDocs.append([doc[1],text])
 
-        return scoreDocs
+            return scoreDocs
+
+        if return_json:
+            return [doc.to_json() for doc in return_docs]
+        return return_docs
 
 # TODO : Write Tests
 if __name__ == '__main__':
@@ -665,4 +2076,68 @@ if __name__ == '__main__':
         project_id="10", 
         version_id="30",
         query_field="question*",
-        query_string=query_string)
\ No newline at end of file
+        query_string=query_string)
+
+    # Shared versions Test, the edited copy of a question in the newest
+    # version must win over the better scoring copy it replaces
+    SearchEngineTest = SolrSearchEngine(
+            variation_generator_config=[None, ["question"]],
+            synonym_config=False,
+            shared_versions=True,
+            autocomplete_config=[True, "./suggestions", 10],
+            spelling_config=[True, ["question", "answer"], 2, 1000000, \
+                "./spelling_vocabularies"],
+        )
+
+    stale = {
+        "id": "flu_shot",
+        "question": "Am I required to have a flu shot?",
+        "answer": "No",
+    }
+    edited = dict(stale, question="Is a flu shot mandatory for staff?", \
+        answer="Yes, once a year")
+    SearchEngineTest.index("11", "1", [stale])
+    SearchEngineTest.index_prev_versions("11", "2", ["1"])
+    SearchEngineTest.index("11", "2", [edited])
+
+    collection = versioning.shared_collection_name("11")
+    lineage = SearchEngineTest.get_version_lineage(collection, "2")
+    results = pysolr.Solr(SearchEngineTest.solr_server_link + "/solr/" + \
+        collection).search("question:(required to have a flu shot)", \
+        fl="id,answer", fq=[versioning.version_filter(lineage), \
+        versioning.hidden_filter(lineage), versioning.collapse_filter()])
+    assert [x['id'] for x in results] == \
+        [versioning.versioned_id("2", "flu_shot")], list(results)
+    print("newest version wins :", list(results))
+
+    # A delta index of version 3 leaving out a question inherited from
+    # version 1 removes it from version 3 only
+    mask = {
+        "id": "mask_rule",
+        "question": "Do I have to wear a mask at work?",
+        "answer": "Yes",
+    }
+    SearchEngineTest.index("11", "1", [stale, mask], delta=True)
+    SearchEngineTest.index_prev_versions("11", "3", ["1"])
+    SearchEngineTest.index("11", "3", [stale], delta=True)
+
+    for version, expected in [
+        ("1", [versioning.versioned_id("1", "mask_rule")]),
+        ("3", []),
+    ]:
+        lineage = SearchEngineTest.get_version_lineage(collection, version)
+        results = pysolr.Solr(SearchEngineTest.solr_server_link + "/solr/" + \
+            collection).search("question:(wear a mask)", fl="id", \
+            fq=[versioning.version_filter(lineage), \
+            versioning.hidden_filter(lineage), versioning.collapse_filter()])
+        assert [x['id'] for x in results] == expected, list(results)
+    print("dropped inherited question is hidden :", list(results))
+
+    assert SearchEngineTest.suggest("wear a mask", "11", "3") == []
+    print("suggestions of version 1 :", \
+        SearchEngineTest.suggest("wear a mask", "11", "1"))
+
+    assert SearchEngineTest.correct_spelling("maks", "11", "1") == "mask"
+    assert SearchEngineTest.correct_spelling("maks", "11", "3") == "maks"
+    print("spelling is corrected from the lineage of the version")
+    SearchEngineTest.close()
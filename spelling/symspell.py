@@ -0,0 +1,316 @@
+import os, threading
+from itertools import combinations
+
+from indexing import versioning
+from indexing.text_analysis import TOKEN_PATTERN, analyze
+from query_expansion.term_statistics import TermStatistics
+
+
+def deletes(word, max_distance):
+    """
+    Returns the strings obtained from a word by deleting up to
+    max_distance of its characters, the word itself included
+    """
+    results = {word}
+    for distance in range(1, min(max_distance, len(word)) + 1):
+        for positions in combinations(range(len(word)), distance):
+            results.add("".join(x for idx, x in enumerate(word) \
+                if idx not in positions))
+    return results
+
+
+def edit_distance(first, second, max_distance):
+    """
+    Returns the optimal string alignment distance of two words, counting
+    a transposition of adjacent characters as one edit, or
+    max_distance + 1 once it is known to be larger than max_distance
+    """
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        current = [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, \
+                previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] \
+                and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def read_synlist(path):
+    """
+    Returns the words of a synlist file, one comma separated set of
+    synonyms per line
+    """
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(analyze(f.read()))
+
+
+class SpellingCorrector:
+    """
+    Corrects the misspelled words of queries against the vocabulary of
+    one collection, with a precomputed SymSpell deletion dictionary
+
+    Every vocabulary word is stored under the strings obtained by deleting
+    up to max_edit_distance characters of its first prefix_length
+    characters. A query word is corrected by looking up its own deletes,
+    so that candidates are found without scanning the vocabulary, and
+    taking the closest candidate, the most frequent one on ties
+
+    Words are added to the dictionary from the most frequent down until it
+    holds max_entries deletes, less frequent words are still known, and
+    never corrected, but are not suggested
+
+    Changes to the vocabulary do not touch the dictionary in use, build
+    computes a new one and swaps it in, so lookups never wait for it
+
+    Attributes
+    ----------
+    vocabulary : TermStatistics
+        The document frequencies of the indexed words
+    dictionary_words : Set
+        Words always known, like the words of the synlist
+    max_edit_distance : Integer
+        The largest number of edits corrected. Words shorter than four
+        characters are not corrected and words shorter than eight get at
+        most one edit
+    max_entries : Integer
+        The largest number of (delete, word) entries of the dictionary
+    """
+
+    def __init__(self, vocabulary=None, dictionary_words=(), \
+        max_edit_distance=2, prefix_length=7, max_entries=1000000):
+        self.vocabulary = vocabulary or TermStatistics()
+        self.dictionary_words = set(dictionary_words)
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Reentrant, get_table builds with it held
+        self.build_lock = threading.RLock()
+        self.table = None
+        self.counts = {}
+        self.entries = 0
+        self.left_out = 0
+
+    def add(self, doc_id, text):
+        self.vocabulary.add(doc_id, [x for x in analyze(text) \
+            if x.isalpha()])
+
+    def remove(self, doc_ids):
+        self.vocabulary.remove(doc_ids)
+
+    def get_table(self):
+        """
+        Returns the deletion dictionary in use and the word counts it was
+        built from, building them on first use
+        """
+        with self.lock:
+            table, counts = self.table, self.counts
+        if table is not None:
+            return table, counts
+        with self.build_lock:
+            # Lookups waiting for the first build do not build it again
+            with self.lock:
+                if self.table is not None:
+                    return self.table, self.counts
+            return self.build()
+
+    def build(self):
+        """
+        Builds the deletion dictionary of the current vocabulary and swaps
+        it in, lookups keep using the previous one in the meantime
+        """
+        with self.build_lock:
+            counts = dict.fromkeys(self.dictionary_words, 1)
+            with self.vocabulary.lock:
+                for word, count in self.vocabulary.df.items():
+                    counts[word] = counts.get(word, 0) + count
+
+            table, entries, left_out = {}, 0, 0
+            for word in sorted(counts, key=lambda x: (-counts[x], x)):
+                if len(word) < 4:
+                    continue
+                word_deletes = deletes(word[:self.prefix_length], \
+                    self.max_edit_distance)
+                if entries + len(word_deletes) > self.max_entries:
+                    left_out += 1
+                    continue
+                entries += len(word_deletes)
+                for key in word_deletes:
+                    table.setdefault(key, []).append(word)
+
+            with self.lock:
+                self.table, self.counts = table, counts
+                self.entries, self.left_out = entries, left_out
+            return table, counts
+
+    def correct_word(self, word):
+        """
+        Returns the correction of a lowercased word, the word itself if it
+        is known or has no candidate close enough
+        """
+        table, counts = self.get_table()
+        max_distance = min(self.max_edit_distance, len(word) // 4)
+        if not max_distance or word in counts or not word.isalpha():
+            return word
+
+        best, best_key = word, None
+        checked = set()
+        for key in deletes(word[:self.prefix_length], max_distance):
+            for candidate in table.get(key, ()):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                distance = edit_distance(word, candidate, max_distance)
+                if distance > max_distance:
+                    continue
+                candidate_key = (distance, -counts[candidate], candidate)
+                if best_key is None or candidate_key < best_key:
+                    best, best_key = candidate, candidate_key
+        return best
+
+    def correct(self, text):
+        """
+        Returns a text with its misspelled words corrected and the list of
+        (word, correction) pairs. Everything but the corrected words is
+        kept as it is
+        """
+        corrections = []
+
+        def replace(match):
+            word = match.group(0)
+            correction = self.correct_word(word.lower())
+            if correction == word.lower():
+                return word
+            corrections.append((word, correction))
+            return correction
+
+        return TOKEN_PATTERN.sub(replace, text), corrections
+
+    def lineage_view(self, lineage):
+        """
+        Returns a built corrector of the vocabulary of the documents
+        visible from a version lineage with shared_versions, the copy of
+        the newest version of the lineage of every question. Ids of
+        documents without words hide the older copies of their question
+        """
+        with self.vocabulary.lock:
+            exists = self.vocabulary.doc_terms.__contains__
+            doc_terms = {doc_id: terms for doc_id, terms in \
+                self.vocabulary.doc_terms.items() \
+                if versioning.newest_visible_id(doc_id, lineage, exists) \
+                    == doc_id}
+        view = SpellingCorrector(TermStatistics.from_doc_terms(doc_terms), \
+            self.dictionary_words, max_edit_distance=self.max_edit_distance, \
+            prefix_length=self.prefix_length, max_entries=self.max_entries)
+        view.build()
+        return view
+
+    def stats(self):
+        self.get_table()
+        return {
+            "words": len(self.counts),
+            "entries": self.entries,
+            "left_out": self.left_out,
+        }
+
+
+class SpellingStore:
+    """
+    Holds the spelling corrector of every collection. Their vocabularies
+    are loaded from snapshots on first use, the deletion dictionaries are
+    built from them and never written. Shared collections also get a
+    corrector per version lineage, restricted to the questions the
+    version sees
+
+    Dictionaries are built outside the lock of the store, so that loading
+    one collection does not hold up the queries of the others
+
+    Attributes
+    ----------
+    snapshot_dir : String
+        The directory holding one <collection>.json vocabulary per
+        collection
+    dictionary_words : Set
+        Words known in every collection
+    """
+
+    def __init__(self, snapshot_dir, dictionary_words=(), \
+        max_edit_distance=2, max_entries=1000000):
+        self.snapshot_dir = snapshot_dir
+        self.dictionary_words = set(dictionary_words)
+        self.max_edit_distance = max_edit_distance
+        self.max_entries = max_entries
+        self.correctors = {}
+        self.views = {}
+        self.lock = threading.Lock()
+
+    def snapshot_path(self, collection):
+        return os.path.join(self.snapshot_dir, collection + ".json")
+
+    def _load(self, collection):
+        """
+        Returns the corrector of a collection, loading its vocabulary
+        without building its dictionary
+        """
+        with self.lock:
+            if collection not in self.correctors:
+                path = self.snapshot_path(collection)
+                self.correctors[collection] = SpellingCorrector(\
+                    TermStatistics.load(path) if os.path.exists(path) \
+                        else None,
+                    self.dictionary_words,
+                    max_edit_distance=self.max_edit_distance,
+                    max_entries=self.max_entries)
+            return self.correctors[collection]
+
+    def get(self, collection, build=True):
+        """
+        Returns the corrector of a collection, with its dictionary built
+        when loaded rather than by the first query unless build is False,
+        like when only its vocabulary is changed
+        """
+        corrector = self._load(collection)
+        if build:
+            corrector.get_table()
+        return corrector
+
+    def get_view(self, collection, lineage):
+        """
+        Returns the corrector of a collection restricted to a version
+        lineage, built on first use and rebuilt on every save
+        """
+        key = (collection, frozenset(lineage))
+        with self.lock:
+            view = self.views.get(key)
+        if view is None:
+            view = self._load(collection).lineage_view(key[1])
+            with self.lock:
+                view = self.views.setdefault(key, view)
+        return view
+
+    def save(self, collection):
+        """
+        Writes the vocabulary of a collection and rebuilds its deletion
+        dictionary and lineage views once, so that queries do not wait
+        for it
+        """
+        corrector = self._load(collection)
+        corrector.vocabulary.save(self.snapshot_path(collection))
+        corrector.build()
+        with self.lock:
+            lineages = [key[1] for key in self.views if key[0] == collection]
+        for lineage in lineages:
+            view = corrector.lineage_view(lineage)
+            with self.lock:
+                self.views[(collection, lineage)] = view
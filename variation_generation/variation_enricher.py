@@ -0,0 +1,194 @@
+import threading, queue, time
+import pysolr
+
+
+class VariationEnricher:
+    """
+    Generates question variations in the background and applies them to
+    already indexed documents with solr atomic updates
+
+    This lets a question become searchable as soon as its original fields
+    are written, while the slow T5 variation generation catches up
+
+    Attributes
+    ----------
+    variation_generator : VariationGenerator
+        The generator used to create the variations of a field
+
+    commit_within : Integer
+        Milliseconds within which solr must make an atomic update visible
+
+
+    Methods
+    -------
+    submit(index_url, doc_id, label, text):
+        Queues the generation of variations of text which are written to
+        the fields label_variation_N of the document doc_id
+
+    status():
+        Returns the progress and backlog of the enrichment queue
+
+    join(timeout=None):
+        Blocks until the backlog is drained or the timeout expires
+
+    close(timeout=None):
+        Stops the workers once the backlog is drained
+    """
+
+    def __init__(self, variation_generator, num_workers=1, \
+        commit_within=1000, max_backlog=0, report_every=50):
+        """
+        Inputs
+        ------
+        variation_generator : VariationGenerator
+            The generator used to create the variations of a field
+        num_workers : Integer
+            The number of background threads generating variations. The
+            T5 model is shared between them, so this should usually stay 1
+        commit_within : Integer
+            Milliseconds within which solr must make an update visible
+        max_backlog : Integer
+            The maximum number of queued tasks, 0 means unbounded
+        report_every : Integer
+            Progress is printed every report_every completed tasks
+        """
+        self.variation_generator = variation_generator
+        self.commit_within = commit_within
+        self.report_every = report_every
+
+        self.tasks = queue.Queue(maxsize=max_backlog)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.pending_per_collection = {}
+        self.last_error = None
+        self.started_at = time.time()
+        self.closed = False
+
+        self.workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, index_url, doc_id, label, text):
+        """
+        Queues a document field for variation generation
+
+        Inputs
+        ------
+        index_url : String
+            Url of the solr collection containing the document
+        doc_id : String
+            The id of the document that must be updated
+        label : String
+            The field name, variations are written to label_variation_N
+        text : String
+            The text from which variations are generated
+        """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("the variation enricher is closed")
+            self.submitted += 1
+            self.pending_per_collection[index_url] = \
+                self.pending_per_collection.get(index_url, 0) + 1
+        self.tasks.put((index_url, doc_id, label, text))
+
+    def status(self):
+        """
+        Returns a dictionary describing the progress of the enrichment
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.started_at, 1e-9)
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "backlog": self.submitted - self.completed - self.failed,
+                "backlog_per_collection": {
+                    url: count for url, count in \
+                        self.pending_per_collection.items() if count > 0
+                },
+                "docs_per_second": self.completed / elapsed,
+                "last_error": self.last_error,
+            }
+
+    def join(self, timeout=None):
+        """
+        Waits for the backlog to be drained
+
+        Returns True if the backlog is empty, False if the timeout expired
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.status()["backlog"] > 0:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Stops the workers after the tasks already queued. Returns True if
+        every worker stopped, False if the timeout expired
+        """
+        with self.lock:
+            if self.closed:
+                return not any(x.is_alive() for x in self.workers)
+            self.closed = True
+        # Queued after the backlog, one per worker
+        for _ in self.workers:
+            self.tasks.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers:
+            worker.join(None if deadline is None else \
+                max(0.0, deadline - time.time()))
+        return not any(x.is_alive() for x in self.workers)
+
+    def _get_client(self, index_url):
+        if index_url not in self.clients:
+            self.clients[index_url] = pysolr.Solr(index_url)
+        return self.clients[index_url]
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self.tasks.task_done()
+                return
+            index_url, doc_id, label, text = task
+            try:
+                variations = self.variation_generator.get_variations(text)
+
+                update = {"id": doc_id}
+                field_updates = {}
+                for idx, variation in enumerate(variations):
+                    field_name = label + "_variation_" + str(idx)
+                    update[field_name] = variation
+                    field_updates[field_name] = "set"
+
+                self._get_client(index_url).add(
+                    [update],
+                    fieldUpdates=field_updates,
+                    commitWithin=self.commit_within)
+                succeeded = True
+            except Exception as e:
+                self.last_error = repr(e)
+                succeeded = False
+            finally:
+                self.tasks.task_done()
+
+            with self.lock:
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self.pending_per_collection[index_url] -= 1
+                done = self.completed + self.failed
+                backlog = self.submitted - done
+
+            if done % self.report_every == 0 or backlog == 0:
+                print("variation enrichment :", done, "done,", \
+                    backlog, "in backlog")